@@ -0,0 +1,347 @@
+"""POS 终端 HTTP/JSON 接口
+
+基于标准库 ThreadingHTTPServer，与 Streamlit 界面共用同一数据库和业务函数。
+每个请求从连接池取一个数据库会话，处理完成后提交并归还；门店下的接口（/api/stores/{门店ID}/...）
+在分库模式下使用该门店的门店库。变更订阅接口（/api/stores/{门店ID}/changes/...）使用只读连接，
+返回 NDJSON 或 Parquet。
+"""
+import sys
+import os
+import re
+import json
+import argparse
+from urllib.parse import parse_qsl
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 添加项目路径
+sys.path.insert(0, os.path.dirname(__file__))
+
+from sqlalchemy import select
+from sqlalchemy.orm.exc import StaleDataError
+from tea_house import (
+    get_db, get_store_db, Member, Product, Table, Session, SessionItem, Order, PaymentMethod,
+    OperationConflictError, InsufficientBalanceError, InsufficientStockError, ReservationConflictError,
+    open_table, seat_party, submit_session_order, checkout_session, receive_stock, transfer_between_stores,
+    init_database, start_outbox_worker, read_changes, CHANGE_STREAMS, CHANGE_FORMATS, CHANGE_BATCH_SIZE
+)
+
+# 业务冲突：请求本身合法，但目标状态已被其他终端改变或余额、库存不足
+CONFLICT_ERRORS = (StaleDataError, OperationConflictError, InsufficientBalanceError, InsufficientStockError,
+                   ReservationConflictError)
+
+
+class ApiError(Exception):
+    """返回给终端的错误响应"""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class RawResponse:
+    """非JSON响应体（变更订阅的 NDJSON / Parquet）"""
+    def __init__(self, content_type, data, headers=None):
+        self.content_type = content_type
+        self.data = data
+        self.headers = headers or {}
+
+
+CHANGE_CONTENT_TYPES = {"ndjson": "application/x-ndjson; charset=utf-8", "parquet": "application/vnd.apache.parquet"}
+
+
+# ==================== 序列化 ====================
+def table_to_dict(table):
+    return {"id": table.id, "name": table.name, "store_id": table.store_id, "capacity": table.capacity,
+            "status": table.status.value, "version": table.version}
+
+
+def session_to_dict(db, session):
+    items = db.execute(select(
+        SessionItem.id, SessionItem.product_id, SessionItem.quantity, SessionItem.unit_price, SessionItem.subtotal
+    ).where(SessionItem.session_id == session.id).order_by(SessionItem.id)).all()
+    return {
+        "id": session.id, "table_id": session.table_id, "store_id": session.store_id,
+        "member_id": session.member_id, "status": session.status.value,
+        "start_time": session.start_time.isoformat(), "total_amount": session.total_amount,
+        "version": session.version,
+        "items": [{"id": i.id, "product_id": i.product_id, "quantity": i.quantity,
+                   "unit_price": i.unit_price, "subtotal": i.subtotal} for i in items]
+    }
+
+
+def order_to_dict(order):
+    return {"id": order.id, "order_no": order.order_no, "store_id": order.store_id, "member_id": order.member_id,
+            "total_amount": order.total_amount, "payment_method": order.payment_method.value,
+            "created_at": order.created_at.isoformat()}
+
+
+# ==================== 参数解析 ====================
+def require(body, name, kind=int):
+    """取必填参数并转换类型"""
+    if body.get(name) is None:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"缺少参数 {name}")
+    try:
+        return kind(body[name])
+    except (TypeError, ValueError):
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"参数 {name} 格式错误")
+
+
+def optional(body, name, kind=int):
+    return None if body.get(name) is None else require(body, name, kind)
+
+
+def parse_lines(db, lines):
+    """商品明细 [{"product_id" 或 "code", "quantity"}] 合并为 {商品ID: 数量}"""
+    if not isinstance(lines, list) or not lines:
+        raise ApiError(HTTPStatus.BAD_REQUEST, "商品明细不能为空")
+    codes = {line.get("code") for line in lines if isinstance(line, dict) and line.get("product_id") is None}
+    product_ids = dict(db.execute(select(Product.code, Product.id).where(Product.code.in_(codes))).all()) if codes else {}
+    merged = {}
+    for number, line in enumerate(lines, 1):
+        if not isinstance(line, dict):
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"第 {number} 行明细格式错误")
+        quantity = require(line, "quantity")
+        product_id = optional(line, "product_id") or product_ids.get(line.get("code"))
+        if product_id is None or quantity <= 0:
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"第 {number} 行商品不存在或数量不是正整数")
+        merged[product_id] = merged.get(product_id, 0) + quantity
+    known = set(db.execute(select(Product.id).where(Product.id.in_(merged))).scalars())
+    if len(known) < len(merged):
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"商品不存在：{sorted(set(merged) - known)}")
+    return merged
+
+
+def get_or_404(db, model, object_id, name, store_id):
+    """取门店下的桌台或会话，不存在或不属于该门店时返回404"""
+    obj = db.get(model, object_id)
+    if obj is None or obj.store_id != store_id:
+        raise ApiError(HTTPStatus.NOT_FOUND, f"{name}不存在")
+    return obj
+
+
+# ==================== 接口 ====================
+def api_health(db, body):
+    return HTTPStatus.OK, {"status": "ok"}
+
+
+def api_store_tables(db, body, store_id):
+    """门店桌台状态"""
+    tables = db.query(Table).filter(Table.store_id == store_id).order_by(Table.id).all()
+    return HTTPStatus.OK, {"tables": [table_to_dict(t) for t in tables]}
+
+
+def api_seat_party(db, body, store_id):
+    """按人数分配桌台并开台"""
+    seated = seat_party(db, store_id, require(body, "party_size"), member_id=optional(body, "member_id"),
+                        idempotency_key=optional(body, "idempotency_key", str))
+    if seated is None:
+        raise ApiError(HTTPStatus.CONFLICT, "没有合适的空闲桌台")
+    table, session = seated
+    return HTTPStatus.CREATED, {"table": table_to_dict(table), "session": session_to_dict(db, session)}
+
+
+def api_open_table(db, body, store_id, table_id):
+    """开台"""
+    get_or_404(db, Table, table_id, "桌台", store_id)
+    session, created = open_table(db, table_id, member_id=optional(body, "member_id"),
+                                  idempotency_key=optional(body, "idempotency_key", str),
+                                  version=optional(body, "version"))
+    return HTTPStatus.CREATED if created else HTTPStatus.OK, {"session": session_to_dict(db, session)}
+
+
+def api_get_session(db, body, store_id, session_id):
+    """会话及消费明细"""
+    return HTTPStatus.OK, {"session": session_to_dict(db, get_or_404(db, Session, session_id, "会话", store_id))}
+
+
+def api_order_items(db, body, store_id, session_id):
+    """点单，成交价按会员等级和价格规则计算"""
+    session = get_or_404(db, Session, session_id, "会话", store_id)
+    member_level = db.query(Member.level).filter(Member.id == session.member_id).scalar() if session.member_id else None
+    cart = parse_lines(db, body.get("items"))
+    short = submit_session_order(db, session_id, session.store_id, cart, member_level=member_level,
+                                 version=optional(body, "version"))
+    db.refresh(session)
+    return HTTPStatus.OK, {"session": session_to_dict(db, session), "insufficient_stock": short}
+
+
+def api_checkout(db, body, store_id, session_id):
+    """结账"""
+    get_or_404(db, Session, session_id, "会话", store_id)
+    try:
+        payment_method = PaymentMethod(require(body, "payment_method", str))
+    except ValueError:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"支付方式只能是 {[m.value for m in PaymentMethod]}")
+    order, created = checkout_session(db, session_id, payment_method,
+                                      idempotency_key=optional(body, "idempotency_key", str),
+                                      version=optional(body, "version"))
+    return HTTPStatus.CREATED if created else HTTPStatus.OK, {"order": order_to_dict(order)}
+
+
+def api_stock_in(db, body, store_id):
+    """批量入库"""
+    count = receive_stock(db, store_id, parse_lines(db, body.get("lines")), optional(body, "remark", str))
+    return HTTPStatus.OK, {"products": count}
+
+
+def api_stock_transfer(db, body):
+    """门店间调拨（分库模式两个门店库各自提交，由 transfer_between_stores 处理）"""
+    count = transfer_between_stores(require(body, "from_store_id"), require(body, "to_store_id"),
+                                    parse_lines(db, body.get("lines")), optional(body, "remark", str))
+    return HTTPStatus.OK, {"products": count}
+
+
+def changes_handler(stream):
+    """变更订阅：GET 参数 after（游标）、limit、format（ndjson / parquet），下次游标在响应头 X-Next-Cursor"""
+    def api_changes(db, body, store_id):
+        after = optional(body, "after") or 0
+        output = body.get("format", "ndjson")
+        if output not in CHANGE_FORMATS:
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"格式只能是 {list(CHANGE_FORMATS)}")
+        frame = read_changes(db, stream, after, optional(body, "limit") or CHANGE_BATCH_SIZE, store_id)
+        cursor = int(frame["id"].max()) if len(frame) else after
+        return HTTPStatus.OK, RawResponse(CHANGE_CONTENT_TYPES[output], CHANGE_FORMATS[output](frame), {
+            "X-Next-Cursor": str(cursor), "X-Row-Count": str(len(frame))
+        })
+    # 只读接口使用只读连接，数据分析拉取不占用写锁
+    api_changes.read_only = True
+    return api_changes
+
+
+# (方法, 路径, 处理函数)，路径中的数字参数按顺序传给处理函数
+ROUTES = [
+    ("GET", r"/api/health", api_health),
+    ("GET", r"/api/stores/(\d+)/tables", api_store_tables),
+    ("POST", r"/api/stores/(\d+)/seat", api_seat_party),
+    ("POST", r"/api/stores/(\d+)/stock-in", api_stock_in),
+    ("POST", r"/api/stock-transfers", api_stock_transfer),
+    ("POST", r"/api/stores/(\d+)/tables/(\d+)/open", api_open_table),
+    ("GET", r"/api/stores/(\d+)/sessions/(\d+)", api_get_session),
+    ("POST", r"/api/stores/(\d+)/sessions/(\d+)/items", api_order_items),
+    ("POST", r"/api/stores/(\d+)/sessions/(\d+)/checkout", api_checkout),
+] + [("GET", rf"/api/stores/(\d+)/changes/{stream}", changes_handler(stream)) for stream in CHANGE_STREAMS]
+ROUTES = [(method, re.compile(pattern + "$"), handler) for method, pattern, handler in ROUTES]
+
+
+def dispatch(method, path, body):
+    """执行一次请求：一个数据库会话、一个事务，成功提交，出错回滚"""
+    for route_method, pattern, handler in ROUTES:
+        match = pattern.match(path)
+        if match and route_method == method:
+            break
+    else:
+        return HTTPStatus.NOT_FOUND, {"error": "接口不存在"}
+    args = [int(arg) for arg in match.groups()]
+    # 门店下的接口第一个参数为门店ID，使用门店库
+    read_only = getattr(handler, "read_only", False)
+    try:
+        db = get_store_db(args[0], read_only) if path.startswith("/api/stores/") else get_db()
+    except ValueError as e:
+        return HTTPStatus.NOT_FOUND, {"error": str(e)}
+    try:
+        status, payload = handler(db, body, *args)
+        db.commit()
+        return status, payload
+    except ApiError as e:
+        db.rollback()
+        return e.status, {"error": str(e)}
+    except CONFLICT_ERRORS as e:
+        db.rollback()
+        return HTTPStatus.CONFLICT, {"error": str(e), "type": type(e).__name__}
+    except ValueError as e:
+        db.rollback()
+        return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+    except Exception as e:
+        db.rollback()
+        print(f"❌ {method} {path} 处理失败：{e!r}", file=sys.stderr)
+        return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "服务器内部错误"}
+    finally:
+        db.close()
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 长连接，终端连续请求无需重复握手
+    protocol_version = "HTTP/1.1"
+    # 响应头与响应体分两次写出，关闭 Nagle 算法避免长连接上每个请求多等一次延迟确认
+    disable_nagle_algorithm = True
+    verbose = False
+
+    def _handle(self, method):
+        body, error = {}, None
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            # 请求体长度未知，长连接上无法定位下一个请求，回复后关闭连接
+            length, error = 0, "Content-Length 无效"
+            self.close_connection = True
+        if length:
+            try:
+                body = json.loads(self.rfile.read(length))
+            except ValueError:
+                body = None
+        path, _, query = self.path.partition("?")
+        if method == "GET":
+            # GET 请求参数来自查询字符串
+            body = dict(parse_qsl(query))
+        if error:
+            status, payload = HTTPStatus.BAD_REQUEST, {"error": error}
+        elif not isinstance(body, dict):
+            status, payload = HTTPStatus.BAD_REQUEST, {"error": "请求体必须是JSON对象"}
+        else:
+            status, payload = dispatch(method, path, body)
+        if not isinstance(payload, RawResponse):
+            payload = RawResponse("application/json; charset=utf-8", json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        data = payload.data
+        self.send_response(status)
+        self.send_header("Content-Type", payload.content_type)
+        for name, value in payload.headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(host="127.0.0.1", port=8600, verbose=False):
+    """创建接口服务（未启动），压测脚本可在进程内直接使用"""
+    handler = type("Handler", (ApiHandler,), {"verbose": verbose})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="连锁茶楼管理系统 POS 接口服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=8600, help="监听端口")
+    parser.add_argument("--verbose", action="store_true", help="打印每个请求的访问日志")
+    args = parser.parse_args()
+
+    init_database()
+    server = make_server(args.host, args.port, args.verbose)
+    # 结账产生的出库流水由本进程的后台线程补写
+    start_outbox_worker()
+    print(f"✅ 接口服务已启动：http://{args.host}:{args.port}/api/health")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,405 +1,41 @@
 import streamlit as st
 import pandas as pd
+import os
 from datetime import datetime, date, timedelta
-from sqlalchemy import create_engine, inspect
-from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Text, Enum as SQLEnum
+from sqlalchemy import select, func
 from sqlalchemy.exc import IntegrityError
-import enum
-import os
-
-# 数据库配置
-# 获取app.py所在目录，确保数据库路径正确
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATABASE_URL = f"sqlite:///{os.path.join(BASE_DIR, 'tea_house.db')}"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False}, echo=False)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
-
-# 枚举定义
-class StoreStatus(str, enum.Enum):
-    ACTIVE = "active"
-    INACTIVE = "inactive"
-
-class EmployeePosition(str, enum.Enum):
-    MANAGER = "manager"
-    STAFF = "staff"
-    CASHIER = "cashier"
-
-class MemberLevel(str, enum.Enum):
-    NORMAL = "normal"
-    SILVER = "silver"
-    GOLD = "gold"
-    DIAMOND = "diamond"
-
-class OrderStatus(str, enum.Enum):
-    PENDING = "pending"
-    PAID = "paid"
-    COMPLETED = "completed"
-    CANCELLED = "cancelled"
-
-class PaymentMethod(str, enum.Enum):
-    WECHAT = "wechat"
-    ALIPAY = "alipay"
-    CASH = "cash"
-    CARD = "card"
-
-class TableStatus(str, enum.Enum):
-    FREE = "free"
-    OCCUPIED = "occupied"
-    RESERVED = "reserved"
-    CLEANING = "cleaning"
-
-class SessionStatus(str, enum.Enum):
-    IN_PROGRESS = "in_progress"
-    PAID = "paid"
-    COMPLETED = "completed"
-    CANCELLED = "cancelled"
-
-# 数据模型
-class Store(Base):
-    __tablename__ = "stores"
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String(100), nullable=False)
-    code = Column(String(20), unique=True, nullable=False, index=True)
-    address = Column(String(200))
-    phone = Column(String(20))
-    status = Column(SQLEnum(StoreStatus), default=StoreStatus.ACTIVE)
-    created_at = Column(DateTime, default=datetime.utcnow)
-
-class Employee(Base):
-    __tablename__ = "employees"
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String(50), nullable=False)
-    phone = Column(String(20), unique=True, nullable=False)
-    position = Column(SQLEnum(EmployeePosition), nullable=False)
-    store_id = Column(Integer, ForeignKey("stores.id"))
-
-class Member(Base):
-    __tablename__ = "members"
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String(50), nullable=False)
-    phone = Column(String(20), unique=True, nullable=False, index=True)
-    level = Column(SQLEnum(MemberLevel), default=MemberLevel.NORMAL)
-    balance = Column(Float, default=0.0)
-
-class Product(Base):
-    __tablename__ = "products"
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String(100), nullable=False)
-    code = Column(String(20), unique=True, nullable=False, index=True)
-    category = Column(String(50), nullable=False)
-    unit_price = Column(Float, nullable=False)
-    unit = Column(String(20), nullable=False)
-
-class Inventory(Base):
-    __tablename__ = "inventory"
-    id = Column(Integer, primary_key=True, index=True)
-    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
-    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
-    quantity = Column(Integer, default=0, nullable=False)
-
-class Table(Base):
-    __tablename__ = "tables"
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String(50), nullable=False)
-    code = Column(String(20), unique=True, nullable=False, index=True)
-    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
-    capacity = Column(Integer, default=4)
-    status = Column(SQLEnum(TableStatus), default=TableStatus.FREE)
-
-class Session(Base):
-    __tablename__ = "sessions"
-    id = Column(Integer, primary_key=True, index=True)
-    table_id = Column(Integer, ForeignKey("tables.id"), nullable=False)
-    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
-    member_id = Column(Integer, ForeignKey("members.id"))
-    start_time = Column(DateTime, default=datetime.utcnow, nullable=False)
-    end_time = Column(DateTime)
-    status = Column(SQLEnum(SessionStatus), default=SessionStatus.IN_PROGRESS)
-    total_amount = Column(Float, default=0.0)
-    duration_minutes = Column(Integer, default=0)
-
-class SessionItem(Base):
-    __tablename__ = "session_items"
-    id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
-    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
-    quantity = Column(Integer, nullable=False)
-    unit_price = Column(Float, nullable=False)
-    subtotal = Column(Float, nullable=False)
-    order_time = Column(DateTime, default=datetime.utcnow)
-
-class Order(Base):
-    __tablename__ = "orders"
-    id = Column(Integer, primary_key=True, index=True)
-    order_no = Column(String(50), unique=True, nullable=False, index=True)
-    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
-    member_id = Column(Integer, ForeignKey("members.id"))
-    total_amount = Column(Float, default=0.0, nullable=False)
-    payment_method = Column(SQLEnum(PaymentMethod), nullable=False)
-    status = Column(SQLEnum(OrderStatus), default=OrderStatus.PAID)
-    created_at = Column(DateTime, default=datetime.utcnow)
-
-class OrderItem(Base):
-    __tablename__ = "order_items"
-    id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
-    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
-    quantity = Column(Integer, nullable=False)
-    unit_price = Column(Float, nullable=False)
-    subtotal = Column(Float, nullable=False)
-
-class InventoryLogType(str, enum.Enum):
-    IN = "in"  # 入库
-    OUT = "out"  # 出库
-    ADJUST = "adjust"  # 调整
-
-class InventoryLog(Base):
-    __tablename__ = "inventory_logs"
-    id = Column(Integer, primary_key=True, index=True)
-    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
-    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
-    log_type = Column(SQLEnum(InventoryLogType), nullable=False)
-    quantity = Column(Integer, nullable=False)  # 变动数量（正数表示增加，负数表示减少）
-    before_quantity = Column(Integer, nullable=False)  # 变动前的库存量
-    after_quantity = Column(Integer, nullable=False)  # 变动后的库存量
-    remark = Column(String(500))  # 备注
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
-
-# 创建数据库表
-Base.metadata.create_all(bind=engine)
-
-def get_db():
-    return SessionLocal()
-
-# 数据库初始化和升级
-def init_sample_data_auto():
-    """自动初始化示例数据"""
-    db = SessionLocal()
-    try:
-        # 检查是否已有数据（以门店为标准）
-        store_count = db.query(Store).count()
-        
-        if store_count == 0:
-            print("检测到空数据库，开始初始化示例数据...")
-            
-            # 1. 创建门店
-            store_data = [
-                {"name": "茶楼总店", "code": "ST001", "address": "市中心商业街1号", "phone": "010-88888888"},
-                {"name": "茶楼东城店", "code": "ST002", "address": "东城区朝阳路88号", "phone": "010-66666666"},
-                {"name": "茶楼西城店", "code": "ST003", "address": "西城区复兴路123号", "phone": "010-77777777"},
-                {"name": "茶楼南山店", "code": "ST004", "address": "南山区科技大道66号", "phone": "0755-99999999"},
-                {"name": "茶楼北湖店", "code": "ST005", "address": "北湖区环湖路88号", "phone": "027-55555555"},
-                {"name": "茶楼新城店", "code": "ST006", "address": "新城开发区金桥路66号", "phone": "020-44444444"},
-            ]
-            
-            stores = []
-            for data in store_data:
-                store = Store(name=data["name"], code=data["code"], 
-                            address=data["address"], phone=data["phone"], 
-                            status=StoreStatus.ACTIVE)
-                db.add(store)
-                db.flush()
-                stores.append(store)
-            
-            # 2. 创建员工
-            employee_data = [
-                {"name": "张经理", "phone": "13800138001", "position": EmployeePosition.MANAGER, "store_id": stores[0].id},
-                {"name": "李店长", "phone": "13800138002", "position": EmployeePosition.MANAGER, "store_id": stores[1].id},
-                {"name": "王员工", "phone": "13800138003", "position": EmployeePosition.STAFF, "store_id": stores[0].id},
-                {"name": "赵员工", "phone": "13800138004", "position": EmployeePosition.STAFF, "store_id": stores[1].id},
-                {"name": "孙员工", "phone": "13800138005", "position": EmployeePosition.STAFF, "store_id": stores[2].id},
-                {"name": "周员工", "phone": "13800138006", "position": EmployeePosition.CASHIER, "store_id": stores[0].id},
-            ]
-            
-            for data in employee_data:
-                employee = Employee(**data)
-                db.add(employee)
-            
-            # 3. 创建商品
-            product_data = [
-                {"name": "龙井绿茶", "code": "P001", "category": "茶叶", "unit_price": 68.00, "unit": "壶"},
-                {"name": "普洱熟茶", "code": "P002", "category": "茶叶", "unit_price": 88.00, "unit": "壶"},
-                {"name": "铁观音", "code": "P003", "category": "茶叶", "unit_price": 78.00, "unit": "壶"},
-                {"name": "大红袍", "code": "P004", "category": "茶叶", "unit_price": 128.00, "unit": "壶"},
-                {"name": "茉莉花茶", "code": "P005", "category": "茶叶", "unit_price": 58.00, "unit": "壶"},
-                {"name": "菊花茶", "code": "P006", "category": "花茶", "unit_price": 48.00, "unit": "杯"},
-                {"name": "玫瑰花茶", "code": "P007", "category": "花茶", "unit_price": 58.00, "unit": "杯"},
-                {"name": "柠檬茶", "code": "P008", "category": "花茶", "unit_price": 38.00, "unit": "杯"},
-                {"name": "瓜子", "code": "S001", "category": "零食", "unit_price": 18.00, "unit": "份"},
-                {"name": "花生", "code": "S002", "category": "零食", "unit_price": 18.00, "unit": "份"},
-                {"name": "开心果", "code": "S003", "category": "零食", "unit_price": 38.00, "unit": "份"},
-                {"name": "腰果", "code": "S004", "category": "零食", "unit_price": 32.00, "unit": "份"},
-                {"name": "话梅", "code": "S005", "category": "零食", "unit_price": 15.00, "unit": "份"},
-                {"name": "薯片", "code": "S006", "category": "零食", "unit_price": 12.00, "unit": "份"},
-                {"name": "水煮鱼", "code": "D001", "category": "菜品", "unit_price": 88.00, "unit": "份"},
-                {"name": "宫保鸡丁", "code": "D002", "category": "菜品", "unit_price": 58.00, "unit": "份"},
-                {"name": "麻婆豆腐", "code": "D003", "category": "菜品", "unit_price": 38.00, "unit": "份"},
-                {"name": "鱼香肉丝", "code": "D004", "category": "菜品", "unit_price": 48.00, "unit": "份"},
-            ]
-            
-            products = []
-            for data in product_data:
-                product = Product(**data)
-                db.add(product)
-                db.flush()
-                products.append(product)
-            
-            # 4. 创建桌台
-            for i, store in enumerate(stores):
-                for j in range(8):
-                    table = Table(
-                        name=f"{store.name}桌台{j+1}号",
-                        code=f"T{i+1:02d}{j+1:02d}",
-                        store_id=store.id,
-                        capacity=[2, 4, 6, 8][j % 4],
-                        status=TableStatus.FREE
-                    )
-                    db.add(table)
-            
-            # 5. 创建库存和库存流水
-            for store in stores:
-                for product in products:
-                    quantity = 20 + (product.id * 5) % 80
-                    inv = Inventory(store_id=store.id, product_id=product.id, quantity=quantity)
-                    db.add(inv)
-                    db.flush()
-                    
-                    # 创建初始入库流水
-                    log = InventoryLog(
-                        store_id=store.id,
-                        product_id=product.id,
-                        log_type=InventoryLogType.IN,
-                        quantity=quantity,
-                        before_quantity=0,
-                        after_quantity=quantity,
-                        remark=f"初始入库 {quantity} 件"
-                    )
-                    db.add(log)
-            
-            # 6. 创建会员
-            member_data = [
-                {"name": "王先生", "phone": "13900139001", "level": MemberLevel.GOLD, "balance": 500.00},
-                {"name": "李女士", "phone": "13900139002", "level": MemberLevel.DIAMOND, "balance": 1000.00},
-                {"name": "张先生", "phone": "13900139003", "level": MemberLevel.SILVER, "balance": 300.00},
-                {"name": "赵女士", "phone": "13900139004", "level": MemberLevel.NORMAL, "balance": 100.00},
-                {"name": "陈先生", "phone": "13900139005", "level": MemberLevel.GOLD, "balance": 800.00},
-                {"name": "刘女士", "phone": "13900139006", "level": MemberLevel.SILVER, "balance": 250.00},
-                {"name": "黄先生", "phone": "13900139007", "level": MemberLevel.NORMAL, "balance": 0.00},
-                {"name": "周女士", "phone": "13900139008", "level": MemberLevel.DIAMOND, "balance": 2000.00},
-            ]
-            
-            members = []
-            for data in member_data:
-                member = Member(**data)
-                db.add(member)
-                db.flush()
-                members.append(member)
-            
-            # 7. 创建订单和会话
-            for i in range(20):
-                store = stores[i % len(stores)]
-                member = members[i % len(members)]
-                
-                order_no = f"ORD{datetime.now() - timedelta(days=i):%Y%m%d%H%M%S}{i:02d}"
-                order = Order(
-                    order_no=order_no,
-                    store_id=store.id,
-                    member_id=member.id,
-                    total_amount=150.0 + (i * 10),
-                    payment_method=[PaymentMethod.WECHAT, PaymentMethod.ALIPAY, PaymentMethod.CASH][i % 3],
-                    status=OrderStatus.COMPLETED,
-                    created_at=datetime.now() - timedelta(days=i)
-                )
-                db.add(order)
-                db.flush()
-                
-                for j in range(3):
-                    product = products[(i + j) % len(products)]
-                    quantity = 1 + j % 2
-                    subtotal = product.unit_price * quantity
-                    
-                    order_item = OrderItem(
-                        order_id=order.id,
-                        product_id=product.id,
-                        quantity=quantity,
-                        unit_price=product.unit_price,
-                        subtotal=subtotal
-                    )
-                    db.add(order_item)
-            
-            # 8. 创建会话
-            tables = db.query(Table).limit(10).all()
-            for i, table in enumerate(tables):
-                store = db.query(Store).get(table.store_id)
-                member = members[i % len(members)]
-                
-                duration = 60 + i * 15
-                start_time = datetime.now() - timedelta(days=i, hours=duration // 60)
-                end_time = start_time + timedelta(minutes=duration)
-                
-                session = Session(
-                    table_id=table.id,
-                    store_id=store.id,
-                    member_id=member.id,
-                    start_time=start_time,
-                    end_time=end_time,
-                    status=SessionStatus.COMPLETED,
-                    duration_minutes=duration,
-                    total_amount=100.0 + i * 20
-                )
-                db.add(session)
-                db.flush()
-                
-                for j in range(2):
-                    product = products[(i + j) % len(products)]
-                    quantity = 1
-                    subtotal = product.unit_price * quantity
-                    
-                    session_item = SessionItem(
-                        session_id=session.id,
-                        product_id=product.id,
-                        quantity=quantity,
-                        unit_price=product.unit_price,
-                        subtotal=subtotal,
-                        order_time=start_time + timedelta(minutes=j * 10)
-                    )
-                    db.add(session_item)
-            
-            db.commit()
-            print("✅ 示例数据初始化完成！")
-        else:
-            print(f"✅ 数据库已有数据（{store_count}家门店），跳过初始化")
-    except Exception as e:
-        print(f"❌ 初始化失败: {str(e)}")
-        db.rollback()
-        raise
-    finally:
-        db.close()
-
-def init_database():
-    """初始化和升级数据库"""
-    # 创建所有表（如果不存在）
-    Base.metadata.create_all(bind=engine)
-    
-    # 检查是否需要添加新字段或新表
-    inspector = inspect(engine)
-    existing_tables = inspector.get_table_names()
-    
-    # 如果inventory_logs表不存在，创建它
-    if 'inventory_logs' not in existing_tables:
-        InventoryLog.__table__.create(bind=engine)
-    
-    # 自动初始化示例数据（如果数据库为空）
-    init_sample_data_auto()
+from sqlalchemy.orm.exc import StaleDataError
+# 本文件只有页面；数据模型与业务服务在 tea_house.py，运维脚本和接口服务直接导入该模块，不运行页面脚本
+from tea_house import (
+    BACKUP_DIR, BACKUP_KEEP, FORECAST_HISTORY_DAYS, FORECAST_HORIZON_DAYS,
+    BalanceLogType, Employee, EmployeePosition, Inventory, InventoryLog, InventoryLogType, Member, MemberBalanceLog,
+    MemberLevel, MemberStats, PaymentMethod, PricingRule, Product, ReplenishmentSuggestion, ReservationStatus,
+    Session, SessionItem, SessionStatus, Store, StoreStatus, Table, TableStatus,
+    InsufficientBalanceError, OperationConflictError, ReservationConflictError,
+    active_sessions_report, backup_databases, cached_revenue_report, cancel_reservation, cancel_session_item,
+    checkout_session, create_reservation, drain_all_outboxes, generate_replenishment_suggestions, get_db,
+    get_free_table_index, get_pricing_engine, get_read_db, get_report_jobs, get_store_db, history_source,
+    init_database, inventory_overview, inventory_valuation_by_store, list_backups, load_reservation_index, map_stores,
+    new_idempotency_key, open_alerts_report, open_table, query_stores, receive_stock, recent_orders_report,
+    reconcile_all_stores, refresh_member_stats, refund_member_balance, seat_party, seat_reservation,
+    start_outbox_worker, start_reservation_sweeper, store_activity_summary, store_revenue_since, submit_report_job,
+    submit_session_order, sweep_reservations, switch_store_db, topup_member_balance, transfer_between_stores, update_reorder_threshold,
+    verify_member_balances
+)
 
-# 初始化数据库
-init_database()
+@st.cache_resource
+def init_app():
+    """初始化数据库，通过 streamlit run 启动时运行后台预约扫描和异步写入；每个进程只执行一次，页面重跑不重复"""
+    init_database()
+    if st.runtime.exists():
+        start_reservation_sweeper()
+        start_outbox_worker()
 
 # Streamlit配置
 st.set_page_config(page_title="连锁茶楼管理系统", page_icon="🏪", layout="wide", initial_sidebar_state="expanded")
 
+init_app()
+
 # 自定义CSS：亮色主题 + 导航栏样式
 st.markdown("""
 <style>
@@ -667,6 +303,7 @@ page = st.sidebar.radio(
     [
         "📊 控制台",
         "🎯 经营",
+        "📅 预约管理",
         "⚙️ 设置",
         "💎 会员管理",
         "📝 订单管理",
@@ -742,6 +379,20 @@ def style_dataframe(df):
     
     return styled
 
+def report_with_progress(kind, label, **params):
+    """提交后台报表任务并显示进度，直到结果返回；数据未变化时直接读取缓存"""
+    jobs = get_report_jobs()
+    key = submit_report_job(kind, **params)
+    placeholder = st.empty()
+    
+    def show(done, total):
+        placeholder.progress(done / total if total else 0.0, text=f"{label}计算中（{done}/{total}）…")
+    
+    try:
+        return jobs.wait(key, on_progress=show)
+    finally:
+        placeholder.empty()
+
 # 包装st.dataframe，自动应用样式
 def st_df(data, **kwargs):
     """Wrap st.dataframe - apply pandas styler"""
@@ -764,6 +415,18 @@ def format_duration(minutes):
         return f"{hours}小时{mins}分钟"
     return f"{mins}分钟"
 
+def card_version(key, current):
+    """操作面板的乐观锁版本：返回本终端上次渲染时看到的版本号，并记下本次渲染的版本号"""
+    seen = st.session_state.get(key, current)
+    st.session_state[key] = current
+    return seen
+
+def refresh_card(db, message):
+    """数据已被其他终端修改：回滚本次操作并刷新操作面板"""
+    db.rollback()
+    st.session_state['card_notice'] = f"⚠️ {message}，已刷新为最新状态"
+    st.rerun()
+
 def calculate_duration(start_time, end_time=None):
     """计算时长"""
     end = end_time or datetime.utcnow()
@@ -797,39 +460,45 @@ if page == "📊 控制台":
     try:
         today = date.today()
         
-        # 今日订单
-        orders_today = db.query(Order).filter(Order.created_at >= today).all()
-        today_revenue = sum(o.total_amount for o in orders_today)
-        
-        # 今日开台
-        sessions_today = db.query(Session).filter(Session.start_time >= today).all()
-        today_sessions_count = len(sessions_today)
+        # 各门店今日开台数、进行中台位、库存预警，分库模式在各门店库并发查询；营业额在订单列存缓存中汇总
+        summary = query_stores(lambda store_db, store_ids: store_activity_summary(store_db, store_ids, today,
+                                                                                  orders=False))
+        revenue = store_revenue_since(today)
+        open_alert_count = int(summary["open_alerts"].sum())
         
-        # 进行中台位
-        active_sessions = db.query(Session).filter(Session.status == SessionStatus.IN_PROGRESS).all()
-        
-        col1, col2, col3, col4 = st.columns(4)
+        col1, col2, col3, col4, col5 = st.columns(5)
         with col1:
-            st.metric("今日营业额", f"¥{today_revenue:,.2f}")
+            st.metric("今日营业额", f"¥{revenue['revenue'].sum():,.2f}")
         with col2:
-            st.metric("今日开台数", today_sessions_count)
+            st.metric("今日开台数", int(summary["session_count"].sum()))
         with col3:
-            st.metric("进行中台位", len(active_sessions))
+            st.metric("进行中台位", int(summary["active_sessions"].sum()))
         with col4:
             st.metric("活跃门店", db.query(Store).filter(Store.status == StoreStatus.ACTIVE).count())
+        with col5:
+            st.metric("⚠️ 库存预警", open_alert_count)
+        
+        if open_alert_count:
+            with st.expander(f"⚠️ {open_alert_count} 个商品库存低于补货阈值"):
+                alerts = query_stores(open_alerts_report).sort_values("created_at", ascending=False).head(50)
+                st_df([{
+                    "门店": alert.store_name,
+                    "商品": alert.product_name,
+                    "触发时库存": alert.quantity,
+                    "补货阈值": alert.threshold,
+                    "时间": alert.created_at.strftime("%Y-%m-%d %H:%M")
+                } for alert in alerts.itertuples()], use_container_width=True)
         
         # 进行中台位列表
         st.subheader("🎯 进行中的台位")
-        if active_sessions:
+        active_sessions = query_stores(active_sessions_report)
+        if not active_sessions.empty:
             session_data = []
-            for session in active_sessions:
-                table = db.query(Table).get(session.table_id)
+            for session in active_sessions.itertuples():
                 duration = calculate_duration(session.start_time)
-                member = db.query(Member).get(session.member_id) if session.member_id else None
-                
                 session_data.append({
-                    "台位": table.name if table else "未知",
-                    "会员": member.name if member else "散客",
+                    "台位": session.table_name,
+                    "会员": session.member_name if isinstance(session.member_name, str) else "散客",
                     "开始时间": session.start_time.strftime("%H:%M"),
                     "时长": format_duration(duration),
                     "消费金额": f"¥{session.total_amount:.2f}"
@@ -842,13 +511,14 @@ if page == "📊 控制台":
         
         # 最近订单
         st.subheader("📝 最近订单")
-        recent = db.query(Order).order_by(Order.created_at.desc()).limit(5).all()
-        if recent:
+        recent = query_stores(lambda store_db, store_ids: recent_orders_report(store_db, store_ids, limit=5))
+        if not recent.empty:
+            recent = recent.sort_values("created_at", ascending=False).head(5)
             st_df([{
                 "订单号": o.order_no,
                 "金额": f"¥{o.total_amount:.2f}",
                 "时间": o.created_at.strftime("%H:%M")
-            } for o in recent], use_container_width=True)
+            } for o in recent.itertuples()], use_container_width=True)
     finally: 
         db.close()
 
@@ -866,6 +536,7 @@ elif page == "🎯 经营":
             # 选择门店
             store_options = [(s.id, s.name) for s in stores]
             store_id = st.selectbox("选择门店", store_options, format_func=lambda x: x[1])
+            db = switch_store_db(db, store_id[0])
             
             # 获取该门店所有桌台
             tables = db.query(Table).filter(Table.store_id == store_id[0]).all()
@@ -889,6 +560,32 @@ elif page == "🎯 经营":
                 with col4:
                     st.metric("清洁中", status_counts[TableStatus.CLEANING])
                 
+                # 按人数分配桌台
+                with st.expander("👥 按人数安排入座"):
+                    seat_key = st.session_state.setdefault("seat_party_key", new_idempotency_key())
+                    with st.form("seat_party"):
+                        col1, col2 = st.columns(2)
+                        with col1:
+                            party_size = st.number_input("人数", min_value=1, value=2)
+                        with col2:
+                            members = db.query(Member).all()
+                            party_member = st.selectbox("会员（可选）", [None] + members,
+                                                        format_func=lambda m: f"{m.name} ({m.phone})" if m else "散客")
+                        if st.form_submit_button("🎯 分配并开台", type="primary"):
+                            seated = seat_party(db, store_id[0], party_size, party_member.id if party_member else None,
+                                                seat_key)
+                            if seated is None:
+                                db.rollback()
+                                st.warning(f"暂无可容纳 {party_size} 人的空闲桌台")
+                            else:
+                                seated_table, _ = seated
+                                db.commit()
+                                st.session_state.pop("seat_party_key", None)
+                                st.success(f"✅ 已安排 {seated_table.name}（{seated_table.capacity}人）")
+                                st.session_state['selected_table_id'] = seated_table.id
+                                st.session_state['selected_table_name'] = seated_table.name
+                                st.rerun()
+                
                 # 显示桌台列表
                 st.subheader("🪑 桌台列表")
                 
@@ -926,8 +623,8 @@ elif page == "🎯 经营":
                         # 状态之间添加分隔线
                         st.divider()
                 
-                # 显示选中桌台的详情和操作面板
-                if 'selected_table_id' in st.session_state:
+                # 显示选中桌台的详情和操作面板（切换门店后不显示其他门店的桌台，分库模式桌台ID只在门店库内唯一）
+                if st.session_state.get('selected_table_id') in {t.id for t in tables}:
                     st.divider()
                     st.subheader(f"🪑 {st.session_state['selected_table_name']} - 操作面板")
                     
@@ -939,29 +636,33 @@ elif page == "🎯 经营":
                         Session.status == SessionStatus.IN_PROGRESS
                     ).first()
                     
+                    # 面板上的操作以本终端看到的版本为准，版本已变化的写入会被拒绝并刷新面板
+                    notice = st.session_state.pop('card_notice', None)
+                    if notice:
+                        st.warning(notice)
+                    table_version = card_version(f"table_version_{table.id}", table.version)
+                    session_version = card_version(f"session_version_{session.id}", session.version) if session else None
+                    
                     if not session:
                         # 桌台空闲 - 显示开台界面
                         st.info("当前桌台空闲，可以进行开台")
                         
+                        # 开台表单的幂等键，开台成功后才清除
+                        open_key = st.session_state.setdefault(f"open_key_{table.id}", new_idempotency_key())
                         with st.form("open_table"):
                             members = db.query(Member).all()
                             member_options = [(0, "散客")] + [(m.id, f"{m.name} ({m.phone})") for m in members]
                             member_id = st.selectbox("选择会员（可选）", member_options, format_func=lambda x: x[1])
                             
                             if st.form_submit_button("🎯 开台", type="primary"):
-                                # 创建会话
-                                new_session = Session(
-                                    table_id=table.id,
-                                    store_id=table.store_id,
-                                    member_id=member_id[0] if member_id[0] != 0 else None
-                                )
-                                db.add(new_session)
-                                
-                                # 更新桌台状态
-                                table.status = TableStatus.OCCUPIED
-                                
-                                db.commit()
+                                try:
+                                    open_table(db, table.id, member_id[0] if member_id[0] != 0 else None, open_key,
+                                               version=table_version)
+                                    db.commit()
+                                except (StaleDataError, OperationConflictError) as e:
+                                    refresh_card(db, e)
                                 st.success(f"✅ {table.name} 开台成功！")
+                                st.session_state.pop(f"open_key_{table.id}", None)
                                 st.session_state.pop('selected_table_id', None)
                                 st.session_state.pop('selected_table_name', None)
                                 st.rerun()
@@ -988,64 +689,76 @@ elif page == "🎯 经营":
                             if not products:
                                 st.warning("暂无商品，请先创建商品")
                             else:
-                                with st.form("add_order"):
-                                    product_options = [(p.id, f"{p.name} - ¥{p.unit_price:.2f}/{p.unit}") for p in products]
-                                    product_id = st.selectbox("选择商品", product_options, format_func=lambda x: x[1])
-                                    quantity = st.number_input("数量", min_value=1, value=1)
+                                # 购物车按会话保存在 session_state，加菜不写库，提交时一次事务下单
+                                cart_key = f"cart_{session.id}"
+                                cart = st.session_state.setdefault(cart_key, {})
+                                products_by_id = {p.id: p for p in products}
+                                
+                                with st.form("add_to_cart", clear_on_submit=True):
+                                    col1, col2 = st.columns([3, 1])
+                                    with col1:
+                                        product_id = st.selectbox(
+                                            "选择商品",
+                                            list(products_by_id),
+                                            format_func=lambda x: f"{products_by_id[x].name} - ¥{products_by_id[x].unit_price:.2f}/{products_by_id[x].unit}"
+                                        )
+                                    with col2:
+                                        quantity = st.number_input("数量", min_value=1, value=1)
+                                    if st.form_submit_button("➕ 加入购物车"):
+                                        cart[product_id] = cart.get(product_id, 0) + quantity
+                                
+                                cart = {pid: qty for pid, qty in cart.items() if pid in products_by_id}
+                                st.session_state[cart_key] = cart
+                                if cart:
+                                    st.subheader("🛒 购物车")
+                                    pricing = get_pricing_engine()
+                                    member_level = member.level if member else None
+                                    cart_prices = {
+                                        pid: pricing.price(products_by_id[pid].unit_price, pid, products_by_id[pid].category,
+                                                           session.store_id, member_level)
+                                        for pid in cart
+                                    }
+                                    for pid, qty in list(cart.items()):
+                                        product = products_by_id[pid]
+                                        col1, col2, col3, col4 = st.columns([3, 2, 2, 1])
+                                        with col1:
+                                            st.text(f"🛍️ {product.name}")
+                                        with col2:
+                                            if cart_prices[pid] < product.unit_price:
+                                                st.text(f"数量: {qty}  单价: ¥{cart_prices[pid]:.2f}（原价 ¥{product.unit_price:.2f}）")
+                                            else:
+                                                st.text(f"数量: {qty}  单价: ¥{product.unit_price:.2f}")
+                                        with col3:
+                                            st.text(f"小计: ¥{cart_prices[pid] * qty:.2f}")
+                                        with col4:
+                                            if st.button("移除", key=f"cart_remove_{pid}"):
+                                                cart.pop(pid)
+                                                st.rerun()
                                     
-                                    if st.form_submit_button("📝 点单", type="primary"):
-                                        product = db.query(Product).get(product_id[0])
-                                        if not product:
-                                            st.error("商品不存在，请刷新页面重试")
-                                            db.rollback()
+                                    cart_total = sum(cart_prices[pid] * qty for pid, qty in cart.items())
+                                    col1, col2 = st.columns(2)
+                                    with col1:
+                                        if st.button("🗑️ 清空购物车", key="cart_clear"):
+                                            st.session_state.pop(cart_key, None)
                                             st.rerun()
-                                        
-                                        # 先保存商品信息，避免session问题
-                                        product_name = product.name
-                                        product_id_val = product.id
-                                        unit_price = product.unit_price
-                                        subtotal = unit_price * quantity
-                                        
-                                        # 创建会话点单
-                                        session_item = SessionItem(
-                                            session_id=session.id,
-                                            product_id=product_id_val,
-                                            quantity=quantity,
-                                            unit_price=unit_price,
-                                            subtotal=subtotal
-                                        )
-                                        db.add(session_item)
-                                        
-                                        # 更新会话总金额
-                                        session.total_amount += subtotal
-                                        
-                                        # 扣减库存
-                                        inv = db.query(Inventory).filter(
-                                            Inventory.store_id == session.store_id,
-                                            Inventory.product_id == product_id_val
-                                        ).first()
-                                        
-                                        current_stock = inv.quantity if inv else 0
-                                        
-                                        if inv:
-                                            if inv.quantity >= quantity:
-                                                inv.quantity -= quantity
-                                                message = f"✅ 点单成功！{product_name} x{quantity}，库存已扣减"
-                                                message_type = "success"
+                                    with col2:
+                                        if st.button(f"📝 提交点单（{len(cart)} 项，¥{cart_total:.2f}）", type="primary", key="cart_submit"):
+                                            try:
+                                                short_ids = submit_session_order(db, session.id, session.store_id, cart,
+                                                                                 member_level, version=session_version)
+                                                db.commit()
+                                            except (StaleDataError, OperationConflictError) as e:
+                                                refresh_card(db, e)
+                                            st.session_state.pop(cart_key, None)
+                                            
+                                            if short_ids:
+                                                st.warning("⚠️ 点单成功！但以下商品库存不足或无库存记录，未扣减库存：" +
+                                                           "、".join(products_by_id[pid].name for pid in short_ids))
                                             else:
-                                                message = f"⚠️ 点单成功！但库存不足（当前库存: {inv.quantity}）"
-                                                message_type = "warning"
-                                        else:
-                                            message = f"⚠️ 点单成功！但该商品暂无库存记录"
-                                            message_type = "warning"
-                                        
-                                        db.commit()
-                                        
-                                        if message_type == "success":
-                                            st.success(message)
-                                        else:
-                                            st.warning(message)
-                                        st.rerun()
+                                                st.success(f"✅ 点单成功！共 {len(cart)} 项，库存已扣减")
+                                            st.rerun()
+                                else:
+                                    st.caption("购物车为空，选择商品加入后统一提交")
                         
                         # 消费明细
                         with tab2:
@@ -1070,26 +783,12 @@ elif page == "🎯 经营":
                                             st.text(f"小计: ¥{item.subtotal:.2f}")
                                         with col5:
                                             if st.button("取消", key=f"cancel_{item.id}", type="secondary"):
-                                                # 删除点单
-                                                # 先保存需要的信息
-                                                item_subtotal = item.subtotal
-                                                item_quantity = item.quantity
-                                                item_product_id = item.product_id
-                                                
-                                                # 恢复库存
-                                                inv = db.query(Inventory).filter(
-                                                    Inventory.store_id == session.store_id,
-                                                    Inventory.product_id == item_product_id
-                                                ).first()
-                                                if inv:
-                                                    inv.quantity += item_quantity
-
-                                                # 扣减会话总金额
-                                                session.total_amount -= item_subtotal
-
-                                                # 删除点单记录
-                                                db.delete(item)
-                                                db.commit()
+                                                # 删除点单、扣回会话金额并恢复库存
+                                                try:
+                                                    cancel_session_item(db, item.id, version=session_version)
+                                                    db.commit()
+                                                except (StaleDataError, OperationConflictError) as e:
+                                                    refresh_card(db, e)
                                                 st.success(f"✅ 已取消 {product_name}")
                                                 st.rerun()
 
@@ -1126,18 +825,26 @@ elif page == "🎯 经营":
                             if 'checkout_table_id' not in st.session_state or st.session_state['checkout_table_id'] != table.id:
                                 if st.button("💰 开始结账", type="primary", key="start_checkout"):
                                     st.session_state['checkout_table_id'] = table.id
+                                    # 进入确认步骤时生成幂等键，重复点击确认只会结账一次
+                                    st.session_state['checkout_key'] = new_idempotency_key()
                                     st.rerun()
                             else:
                                 # 结账确认流程
                                 st.subheader("💳 结账确认")
 
                                 # 选择支付方式
+                                payment_options = [PaymentMethod.WECHAT, PaymentMethod.ALIPAY, PaymentMethod.CASH]
+                                if session.member_id:
+                                    payment_options.append(PaymentMethod.BALANCE)
                                 payment_method = st.selectbox(
                                     "支付方式",
-                                    [PaymentMethod.WECHAT, PaymentMethod.ALIPAY, PaymentMethod.CASH],
-                                    format_func=lambda x: {"wechat": "微信", "alipay": "支付宝", "cash": "现金"}[x.value],
+                                    payment_options,
+                                    format_func=lambda x: {"wechat": "微信", "alipay": "支付宝", "cash": "现金", "balance": "会员余额"}[x.value],
                                     key="payment_method"
                                 )
+                                if payment_method == PaymentMethod.BALANCE:
+                                    member_balance = db.query(Member.balance).filter(Member.id == session.member_id).scalar() or 0.0
+                                    st.info(f"会员余额: ¥{member_balance:.2f}")
 
                                 # 输入实收金额
                                 received_amount = st.number_input(
@@ -1165,66 +872,22 @@ elif page == "🎯 经营":
                                         st.rerun()
                                 with col2:
                                     if st.button("✅ 确认结账", key="confirm_checkout", disabled=not confirm_enabled, type="primary"):
-                                        # 停止计时
-                                        session.end_time = datetime.utcnow()
-                                        session.duration_minutes = duration
-                                        session.status = SessionStatus.COMPLETED
-
-                                        # 更新桌台状态为空闲
-                                        table.status = TableStatus.FREE
-
-                                        # 创建订单
-                                        order = Order(
-                                            order_no=f"ORD{datetime.now().strftime('%Y%m%d%H%M%S')}",
-                                            store_id=session.store_id,
-                                            member_id=session.member_id,
-                                            total_amount=session.total_amount,
-                                            payment_method=payment_method,
-                                            status=OrderStatus.COMPLETED
-                                        )
-                                        db.add(order)
-                                        db.flush()
-
-                                        # 创建订单明细并扣减库存
-                                        for item in session_items:
-                                            # 创建订单明细
-                                            order_item = OrderItem(
-                                                order_id=order.id,
-                                                product_id=item.product_id,
-                                                quantity=item.quantity,
-                                                unit_price=item.unit_price,
-                                                subtotal=item.subtotal
-                                            )
-                                            db.add(order_item)
-                                            
-                                            # 扣减库存
-                                            inv = db.query(Inventory).filter(
-                                                Inventory.store_id == session.store_id,
-                                                Inventory.product_id == item.product_id
-                                            ).first()
-                                            
-                                            if inv:
-                                                before_quantity = inv.quantity
-                                                inv.quantity -= item.quantity
-                                                after_quantity = inv.quantity
-                                                
-                                                # 记录库存流水
-                                                log = InventoryLog(
-                                                    store_id=session.store_id,
-                                                    product_id=item.product_id,
-                                                    log_type=InventoryLogType.OUT,
-                                                    quantity=-item.quantity,
-                                                    before_quantity=before_quantity,
-                                                    after_quantity=after_quantity,
-                                                    remark=f"订单 {order.order_no} 消耗 {item.quantity} 件"
-                                                )
-                                                db.add(log)
-
-                                        db.commit()
+                                        try:
+                                            order, _ = checkout_session(db, session.id, payment_method,
+                                                                        st.session_state.get('checkout_key'),
+                                                                        version=session_version)
+                                            db.commit()
+                                        except InsufficientBalanceError as e:
+                                            db.rollback()
+                                            st.error(f"❌ {e}")
+                                            st.stop()
+                                        except (StaleDataError, OperationConflictError) as e:
+                                            refresh_card(db, e)
                                         st.success(f"✅ 结账成功！订单号: {order.order_no}")
                                         st.session_state.pop('selected_table_id', None)
                                         st.session_state.pop('selected_table_name', None)
                                         st.session_state.pop('checkout_table_id', None)
+                                        st.session_state.pop('checkout_key', None)
                                         st.rerun()
 
                     # 关闭选中状态
@@ -1236,15 +899,133 @@ elif page == "🎯 经营":
         db.close()
 
 # 设置页面
+# 预约管理
+elif page == "📅 预约管理":
+    st.header("📅 预约管理")
+    db = get_db()
+    try:
+        stores = db.query(Store).filter(Store.status == StoreStatus.ACTIVE).all()
+        if not stores:
+            st.warning("请先创建门店")
+        else:
+            col1, col2 = st.columns(2)
+            with col1:
+                store_id = st.selectbox("选择门店", [(s.id, s.name) for s in stores], format_func=lambda x: x[1],
+                                        key="reservation_store")[0]
+            with col2:
+                day = st.date_input("预约日期", value=date.today(), key="reservation_day")
+            db = switch_store_db(db, store_id)
+            
+            tables = db.query(Table).filter(Table.store_id == store_id).order_by(Table.id).all()
+            if not tables:
+                st.warning("该门店暂无桌台，请先添加桌台")
+            else:
+                # 当天预约一次查询载入内存区间索引，下面的时段表和空闲桌台都从索引计算
+                index = load_reservation_index(db, store_id, day)
+                day_start = datetime.combine(day, datetime.min.time())
+                
+                st.subheader("🗓️ 当日时段")
+                slots = [day_start + timedelta(hours=9, minutes=30 * i) for i in range(28)]
+                grid = []
+                for table in tables:
+                    row = {"桌台": f"{table.name}（{table.capacity}人）"}
+                    for slot in slots:
+                        r = index.find(table.id, slot, slot + timedelta(minutes=30))
+                        row[slot.strftime("%H:%M")] = ("🟡" if r.status == ReservationStatus.SEATED else "🔵") if r else ""
+                    grid.append(row)
+                st_df(pd.DataFrame(grid), use_container_width=True, hide_index=True)
+                st.caption("🔵 已预约  🟡 已到店")
+                
+                st.subheader("➕ 新增预约")
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    start_time = st.time_input("开始时间", value=datetime.strptime("14:00", "%H:%M").time(),
+                                               step=timedelta(minutes=30), key="reservation_start")
+                with col2:
+                    hours = st.selectbox("预约时长", [1, 1.5, 2, 3, 4], index=2, format_func=lambda x: f"{x}小时",
+                                         key="reservation_hours")
+                with col3:
+                    party_size = st.number_input("人数", min_value=1, value=2, key="reservation_party")
+                start_at = datetime.combine(day, start_time)
+                end_at = start_at + timedelta(hours=hours)
+                
+                tables_by_id = {t.id: t for t in tables}
+                free_ids = index.free_tables([t.id for t in tables if t.capacity >= party_size], start_at, end_at)
+                if not free_ids:
+                    st.warning("所选时段没有可容纳该人数的空闲桌台")
+                else:
+                    with st.form("create_reservation"):
+                        table_id = st.selectbox("桌台", free_ids,
+                                                format_func=lambda x: f"{tables_by_id[x].name}（{tables_by_id[x].capacity}人）")
+                        members = db.query(Member).all()
+                        member = st.selectbox("会员（可选）", [None] + members,
+                                              format_func=lambda m: f"{m.name} ({m.phone})" if m else "散客")
+                        customer_name = st.text_input("顾客姓名")
+                        phone = st.text_input("联系电话")
+                        remark = st.text_input("备注")
+                        if st.form_submit_button("📅 预约", type="primary"):
+                            name = customer_name or (member.name if member else "")
+                            if not name:
+                                st.error("请填写顾客姓名或选择会员")
+                            elif end_at <= datetime.now():
+                                st.error("预约时段已过")
+                            else:
+                                try:
+                                    create_reservation(db, table_id, start_at, end_at, name,
+                                                       phone=phone or (member.phone if member else None),
+                                                       party_size=party_size, member_id=member.id if member else None,
+                                                       remark=remark or None)
+                                    db.commit()
+                                    st.success(f"✅ 已预约 {tables_by_id[table_id].name} {start_at:%H:%M}-{end_at:%H:%M}")
+                                    st.rerun()
+                                except ReservationConflictError as e:
+                                    db.rollback()
+                                    st.error(f"❌ {e}")
+                
+                st.subheader("📋 当日预约")
+                day_reservations = sorted(
+                    (r for t in tables for r in index.reservations(t.id)), key=lambda r: r.start_at
+                )
+                if not day_reservations:
+                    st.info("当日暂无预约")
+                for r in day_reservations:
+                    col1, col2, col3, col4 = st.columns([3, 3, 1, 1])
+                    with col1:
+                        st.text(f"{r.start_at:%H:%M}-{r.end_at:%H:%M}  {tables_by_id[r.table_id].name}")
+                    with col2:
+                        st.text(f"{r.customer_name} {r.phone or ''}  {r.party_size}人  "
+                                f"{'已到店' if r.status == ReservationStatus.SEATED else '待到店'}")
+                    if r.status == ReservationStatus.BOOKED:
+                        with col3:
+                            if st.button("到店", key=f"seat_reservation_{r.id}"):
+                                try:
+                                    seat_reservation(db, r.id)
+                                    db.commit()
+                                    st.rerun()
+                                except ReservationConflictError as e:
+                                    db.rollback()
+                                    st.error(f"❌ {e}")
+                        with col4:
+                            if st.button("取消", key=f"cancel_reservation_{r.id}"):
+                                cancel_reservation(db, r.id)
+                                db.commit()
+                                sweep_reservations(db)
+                                st.rerun()
+    finally:
+        db.close()
+
 elif page == "⚙️ 设置":
     st.header("⚙️ 系统设置")
     
-    tab1, tab2, tab3, tab4, tab5 = st.tabs([
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8 = st.tabs([
         "🏪 门店管理",
         "🪑 桌台管理",
         "👥 员工管理",
         "🛍️ 商品管理",
-        "📦 库存管理"
+        "📦 库存管理",
+        "🔍 库存对账",
+        "🏷️ 价格规则",
+        "💾 数据备份"
     ])
     
     db = get_db()
@@ -1298,7 +1079,11 @@ elif page == "⚙️ 设置":
                         format_func=lambda x: x[1]
                     )
                     
-                    tables = db.query(Table).filter(Table.store_id == selected_store_id[0]).all()
+                    store_db = get_store_db(selected_store_id[0])
+                    try:
+                        tables = store_db.query(Table).filter(Table.store_id == selected_store_id[0]).all()
+                    finally:
+                        store_db.close()
                     if tables:
                         st_df(pd.DataFrame([{
                             "名称": t.name,
@@ -1324,19 +1109,23 @@ elif page == "⚙️ 设置":
                             format_func=lambda x: x[1]
                         )
                         if st.form_submit_button("创建", type="primary"):
+                            store_db = get_store_db(store_id[0])
                             try:
-                                db.add(Table(
+                                store_db.add(Table(
                                     name=name,
                                     code=code,
                                     capacity=capacity,
                                     store_id=store_id[0]
                                 ))
-                                db.commit()
+                                store_db.commit()
+                                get_free_table_index().invalidate(store_id[0])
                                 st.success("✅ 创建成功")
                                 st.rerun()
                             except IntegrityError:
-                                db.rollback()
+                                store_db.rollback()
                                 st.error("编码已存在")
+                            finally:
+                                store_db.close()
                 else:
                     st.warning("请先创建门店")
         
@@ -1396,8 +1185,25 @@ elif page == "⚙️ 设置":
                         "编码": p.code,
                         "分类": p.category,
                         "单价": f"¥{p.unit_price:.2f}",
-                        "单位": p.unit
+                        "单位": p.unit,
+                        "补货阈值": p.reorder_threshold
                     } for p in products]), use_container_width=True)
+                    
+                    st.write("### 修改补货阈值")
+                    # 商品选择放在表单外，切换商品时阈值输入框立即带出该商品的当前阈值
+                    threshold_product = st.selectbox(
+                        "商品",
+                        [(p.id, p.name, p.reorder_threshold) for p in products],
+                        format_func=lambda x: f"{x[1]}（当前阈值 {x[2]}）",
+                        key="reorder_threshold_product"
+                    )
+                    with st.form("update_reorder_threshold"):
+                        new_threshold = st.number_input("补货阈值", min_value=0, value=threshold_product[2],
+                                                        key=f"reorder_threshold_{threshold_product[0]}")
+                        if st.form_submit_button("保存", type="primary"):
+                            opened, resolved = update_reorder_threshold(threshold_product[0], new_threshold)
+                            st.success(f"✅ 已更新补货阈值，新增预警 {opened} 条，关闭预警 {resolved} 条")
+                            st.rerun()
                 else: 
                     st.info("暂无商品")
             
@@ -1409,9 +1215,11 @@ elif page == "⚙️ 设置":
                     category = st.selectbox("分类", ["茶叶", "茶具", "点心", "饮品"])
                     price = st.number_input("单价*", min_value=0.0, step=1.0)
                     unit = st.text_input("单位*")
+                    reorder_threshold = st.number_input("补货阈值", min_value=0, value=10)
                     if st.form_submit_button("创建", type="primary"):
                         try:
-                            db.add(Product(name=name, code=code, category=category, unit_price=price, unit=unit))
+                            db.add(Product(name=name, code=code, category=category, unit_price=price, unit=unit,
+                                           reorder_threshold=reorder_threshold))
                             db.commit()
                             st.success("✅ 创建成功")
                             st.rerun()
@@ -1428,56 +1236,225 @@ elif page == "⚙️ 设置":
                 stores = db.query(Store).filter(Store.status == StoreStatus.ACTIVE).all()
                 if stores:
                     store_id = st.selectbox("选择门店", [(s.id, s.name) for s in stores], format_func=lambda x: x[1])
-                    invs = db.query(Inventory).filter(Inventory.store_id == store_id[0]).all()
+                    store_db = get_store_db(store_id[0])
+                    try:
+                        invs = store_db.query(Inventory.quantity, Product.name).join(
+                            Product, Product.id == Inventory.product_id
+                        ).filter(Inventory.store_id == store_id[0]).order_by(Inventory.id).all()
+                    finally:
+                        store_db.close()
                     if invs:
-                        data = []
-                        for inv in invs:
-                            p = db.query(Product).get(inv.product_id)
-                            data.append({"商品": p.name, "数量": inv.quantity})
-                        st_df(pd.DataFrame(data), use_container_width=True)
+                        st_df(pd.DataFrame([{"商品": name, "数量": quantity} for quantity, name in invs]),
+                              use_container_width=True)
                     else: 
                         st.info("暂无库存")
                 else:
                     st.warning("请先创建门店")
             
             with col2:
-                st.write("### 库存入库")
+                st.write("### 批量入库 / 调拨")
                 stores = db.query(Store).filter(Store.status == StoreStatus.ACTIVE).all()
-                products = db.query(Product).all()
-                if stores and products:
-                    with st.form("add_stock"):
-                        sid = st.selectbox("门店", [(s.id, s.name) for s in stores], format_func=lambda x: x[1])
-                        pid = st.selectbox("商品", [(p.id, p.name) for p in products], format_func=lambda x: x[1])
-                        qty = st.number_input("数量*", min_value=1)
+                if stores and db.query(Product.id).first():
+                    stock_mode = st.radio("操作", ["入库", "调拨"], horizontal=True, key="stock_mode")
+                    store_options = [(s.id, s.name) for s in stores]
+                    if stock_mode == "入库":
+                        sid = st.selectbox("门店", store_options, format_func=lambda x: x[1], key="stock_store")
+                    else:
+                        from_sid = st.selectbox("调出门店", store_options, format_func=lambda x: x[1], key="transfer_from")
+                        sid = st.selectbox("调入门店", store_options, index=min(1, len(store_options) - 1),
+                                           format_func=lambda x: x[1], key="transfer_to")
+                    with st.form("batch_stock"):
+                        lines_text = st.text_area("商品明细*", height=200, placeholder="每行一个商品：商品编码,数量\nP001,20\nP002,15",
+                                                  help="可直接粘贴送货单，编码与数量之间可用逗号、空格或制表符分隔")
                         remark = st.text_input("备注（可选）")
-                        if st.form_submit_button("入库", type="primary"):
-                            inv = db.query(Inventory).filter(Inventory.store_id == sid[0], Inventory.product_id == pid[0]).first()
-                            if inv:
-                                before_quantity = inv.quantity
-                                inv.quantity += qty
-                                after_quantity = inv.quantity
+                        if st.form_submit_button(stock_mode, type="primary"):
+                            product_ids = dict(db.execute(select(Product.code, Product.id)).all())
+                            lines, errors = {}, []
+                            for number, raw in enumerate(lines_text.splitlines(), 1):
+                                parts = raw.replace(",", " ").replace("，", " ").split()
+                                if not parts:
+                                    continue
+                                if len(parts) != 2 or parts[0] not in product_ids or not parts[1].isdigit() or int(parts[1]) <= 0:
+                                    errors.append(f"第 {number} 行：{raw.strip()}")
+                                    continue
+                                product_id = product_ids[parts[0]]
+                                lines[product_id] = lines.get(product_id, 0) + int(parts[1])
+                            if errors:
+                                st.error("以下明细无法识别（编码不存在或数量不是正整数）：\n\n" + "\n\n".join(errors))
+                            elif not lines:
+                                st.error("请填写商品明细")
                             else:
-                                before_quantity = 0
-                                inv = Inventory(store_id=sid[0], product_id=pid[0], quantity=qty)
-                                db.add(inv)
-                                after_quantity = qty
-                            
-                            # 记录库存流水
-                            log = InventoryLog(
-                                store_id=sid[0],
-                                product_id=pid[0],
-                                log_type=InventoryLogType.IN,
-                                quantity=qty,
-                                before_quantity=before_quantity,
-                                after_quantity=after_quantity,
-                                remark=remark or f"手动入库 {qty} 件"
-                            )
-                            db.add(log)
+                                try:
+                                    if stock_mode == "入库":
+                                        store_db = get_store_db(sid[0])
+                                        try:
+                                            count = receive_stock(store_db, sid[0], lines, remark or None)
+                                            store_db.commit()
+                                        finally:
+                                            store_db.close()
+                                    else:
+                                        count = transfer_between_stores(from_sid[0], sid[0], lines, remark or None)
+                                    st.success(f"✅ {stock_mode}成功，共 {count} 个商品 {sum(lines.values())} 件")
+                                    st.rerun()
+                                except ValueError as e:
+                                    st.error(str(e))
+                else:
+                    st.warning("请先创建门店和商品")
+        
+        # 库存对账
+        with tab6:
+            st.subheader("库存对账")
+            st.caption("核对当前库存、最后一条流水的变动后库存、流水变动量累计，并检查流水前后衔接")
+            stores = db.query(Store).all()
+            if stores:
+                store_names = {s.id: s.name for s in stores}
+                reconcile_store = st.selectbox(
+                    "对账门店",
+                    [(0, "全部门店")] + [(s.id, s.name) for s in stores],
+                    format_func=lambda x: x[1],
+                    key="reconcile_store"
+                )
+                if st.button("🔍 开始对账", type="primary"):
+                    # 先补写队列中尚未写入的出库流水
+                    drain_all_outboxes()
+                    store_ids = [reconcile_store[0]] if reconcile_store[0] != 0 else None
+                    result = reconcile_all_stores(db, store_ids)
+                    issues = result[result["has_issue"]]
+                    
+                    col1, col2, col3 = st.columns(3)
+                    with col1:
+                        st.metric("核对商品数", len(result))
+                    with col2:
+                        st.metric("存在差异", len(issues))
+                    with col3:
+                        st.metric("流水断链", int(result["broken_links"].sum()))
+                    
+                    if issues.empty:
+                        st.success("✅ 库存与流水一致")
+                    else:
+                        products_dict = {p.id: p.name for p in db.query(Product).all()}
+                        st.warning(f"发现 {len(issues)} 个商品库存与流水不一致")
+                        st_df(pd.DataFrame({
+                            "门店": issues["store_id"].map(store_names),
+                            "商品": issues["product_id"].map(products_dict).fillna("未知"),
+                            "当前库存": issues["stock_quantity"],
+                            "最后流水库存": issues["last_after"],
+                            "流水累计": issues["delta_sum"],
+                            "流水条数": issues["log_count"],
+                            "断链次数": issues["broken_links"],
+                            "异常流水": issues["bad_rows"]
+                        }), use_container_width=True, hide_index=True)
+            else:
+                st.warning("请先创建门店")
+        
+        # 价格规则
+        with tab7:
+            st.subheader("价格规则")
+            st.caption("按会员等级、门店、分类或商品设置折扣，可限定生效时间；多条规则同时匹配时优先级高者优先，其次取更具体的规则")
+            level_names = {"normal": "普通卡", "silver": "银卡", "gold": "金卡", "diamond": "钻石卡"}
+            stores = db.query(Store).all()
+            products = db.query(Product).all()
+            store_names = {s.id: s.name for s in stores}
+            product_names = {p.id: p.name for p in products}
+            col1, col2 = st.columns([2, 1])
+            
+            with col1:
+                rules = db.query(PricingRule).order_by(PricingRule.priority.desc(), PricingRule.id).all()
+                if rules:
+                    st_df(pd.DataFrame([{
+                        "ID": r.id,
+                        "名称": r.name,
+                        "会员等级": level_names[r.member_level.value] if r.member_level else "全部",
+                        "门店": store_names.get(r.store_id, "全部") if r.store_id else "全部",
+                        "适用范围": product_names.get(r.product_id, "未知") if r.product_id else (r.category or "全部商品"),
+                        "折扣": f"{r.discount_rate * 10:.1f}折",
+                        "优先级": r.priority,
+                        "生效时间": r.start_at.strftime("%Y-%m-%d %H:%M") if r.start_at else "-",
+                        "失效时间": r.end_at.strftime("%Y-%m-%d %H:%M") if r.end_at else "-"
+                    } for r in rules]), use_container_width=True, hide_index=True)
+                    
+                    with st.form("delete_pricing_rule"):
+                        rule_to_delete = st.selectbox("删除规则", [(r.id, r.name) for r in rules],
+                                                      format_func=lambda x: f"{x[0]} - {x[1]}")
+                        if st.form_submit_button("🗑️ 删除"):
+                            db.query(PricingRule).filter(PricingRule.id == rule_to_delete[0]).delete()
                             db.commit()
-                            st.success("✅ 入库成功")
+                            get_pricing_engine().invalidate()
+                            st.success("✅ 已删除")
                             st.rerun()
                 else:
-                    st.warning("请先创建门店和商品")
+                    st.info("暂无价格规则，商品按原价销售")
+            
+            with col2:
+                st.write("### 新增规则")
+                with st.form("create_pricing_rule"):
+                    name = st.text_input("规则名称*")
+                    member_level = st.selectbox("会员等级", [None] + list(MemberLevel),
+                                                format_func=lambda x: level_names[x.value] if x else "全部（含散客）")
+                    rule_store = st.selectbox("门店", [(0, "全部门店")] + [(s.id, s.name) for s in stores],
+                                              format_func=lambda x: x[1])
+                    category = st.selectbox("分类", ["全部分类"] + sorted({p.category for p in products}))
+                    rule_product = st.selectbox("商品", [(0, "全部商品")] + [(p.id, p.name) for p in products],
+                                                format_func=lambda x: x[1])
+                    discount_rate = st.number_input("折扣率（0.9 即九折）", min_value=0.01, max_value=1.0, value=0.9, step=0.05)
+                    priority = st.number_input("优先级", value=0, step=1)
+                    limit_time = st.checkbox("限定生效时间")
+                    start_date = st.date_input("开始日期", value=date.today())
+                    start_time = st.time_input("开始时间", value=datetime.min.time())
+                    end_date = st.date_input("结束日期", value=date.today() + timedelta(days=7))
+                    end_time = st.time_input("结束时间", value=datetime.min.time())
+                    if st.form_submit_button("创建", type="primary"):
+                        start_at = datetime.combine(start_date, start_time) if limit_time else None
+                        end_at = datetime.combine(end_date, end_time) if limit_time else None
+                        if not name:
+                            st.error("请填写规则名称")
+                        elif start_at and end_at <= start_at:
+                            st.error("结束时间必须晚于开始时间")
+                        else:
+                            db.add(PricingRule(
+                                name=name,
+                                member_level=member_level,
+                                store_id=rule_store[0] or None,
+                                category=category if category != "全部分类" and not rule_product[0] else None,
+                                product_id=rule_product[0] or None,
+                                discount_rate=discount_rate,
+                                priority=int(priority),
+                                start_at=start_at,
+                                end_at=end_at
+                            ))
+                            db.commit()
+                            get_pricing_engine().invalidate()
+                            st.success("✅ 创建成功")
+                            st.rerun()
+        
+        # 数据备份
+        with tab8:
+            st.subheader("数据备份")
+            st.caption(f"营业中在线备份全部库文件到 {BACKUP_DIR}，分批复制不影响收银；"
+                       f"与上一快照相比未变化的文件直接沿用，保留最近 {BACKUP_KEEP} 个快照")
+            if st.button("💾 立即备份", type="primary"):
+                with st.spinner("备份中..."):
+                    try:
+                        manifest = backup_databases()
+                        st.success(f"✅ 备份完成：复制 {manifest['copied_bytes'] / 1024 / 1024:.1f} MB，"
+                                   f"沿用 {manifest['linked_files']} 个未变化文件，耗时 {manifest['seconds']:.2f} 秒，"
+                                   f"吞吐 {manifest['mb_per_second'] or 0:.1f} MB/s")
+                    except RuntimeError as e:
+                        st.error(str(e))
+            
+            backups = list_backups()
+            if backups:
+                st_df(pd.DataFrame([{
+                    "快照": os.path.basename(path),
+                    "时间(UTC)": manifest["created_at"][:19].replace("T", " "),
+                    "文件数": len(manifest["files"]),
+                    "沿用文件数": manifest["linked_files"],
+                    "复制(MB)": round(manifest["copied_bytes"] / 1024 / 1024, 1),
+                    "耗时(秒)": manifest["seconds"],
+                    "吞吐(MB/s)": manifest["mb_per_second"]
+                } for path, manifest in reversed(backups)]), use_container_width=True, hide_index=True)
+            else:
+                st.info("暂无备份")
     
     finally:
         db.close()
@@ -1485,18 +1462,37 @@ elif page == "⚙️ 设置":
 # 会员管理
 elif page == "💎 会员管理":
     st.header("💎 会员管理")
-    tab1, tab2 = st.tabs(["会员列表", "新增会员"])
+    tab1, tab2, tab3 = st.tabs(["会员列表", "新增会员", "余额管理"])
     db = get_db()
     try:
         with tab1:
-            members = db.query(Member).all()
+            members = db.query(Member, MemberStats).outerjoin(MemberStats, MemberStats.member_id == Member.id).all()
             if members:
+                stats_updated_at = db.query(func.max(MemberStats.updated_at)).scalar()
+                col1, col2 = st.columns([3, 1])
+                with col1:
+                    st.caption(f"消费分析更新时间: {stats_updated_at:%Y-%m-%d %H:%M}" if stats_updated_at else "尚未计算消费分析")
+                with col2:
+                    if st.button("🔄 更新消费分析"):
+                        try:
+                            count = refresh_member_stats(db, full=stats_updated_at is None)
+                            st.success(f"✅ 已更新 {count} 名会员")
+                            st.rerun()
+                        except ValueError as e:
+                            st.error(str(e))
+                
                 st_df(pd.DataFrame([{
                     "姓名": m.name,
                     "电话": m.phone,
                     "等级": m.level.value,
-                    "余额": f"¥{m.balance:.2f}"
-                } for m in members]), use_container_width=True)
+                    "余额": f"¥{m.balance:.2f}",
+                    "消费次数": stats.order_count if stats else 0,
+                    "累计消费": f"¥{stats.total_spent:.2f}" if stats else "-",
+                    "客单价": f"¥{stats.avg_ticket:.2f}" if stats else "-",
+                    "最近消费": stats.last_order_at.strftime("%Y-%m-%d") if stats and stats.last_order_at else "-",
+                    "RFM": f"{stats.r_score}{stats.f_score}{stats.m_score}" if stats else "-",
+                    "分群": stats.segment if stats else "-"
+                } for m, stats in members]), use_container_width=True)
             else: 
                 st.info("暂无会员")
         with tab2:
@@ -1512,22 +1508,78 @@ elif page == "💎 会员管理":
                     except IntegrityError:
                         db.rollback()
                         st.error("电话已存在")
+        with tab3:
+            all_members = db.query(Member).order_by(Member.id).all()
+            if all_members:
+                member = st.selectbox(
+                    "选择会员",
+                    all_members,
+                    format_func=lambda m: f"{m.name} ({m.phone}) 余额 ¥{m.balance:.2f}",
+                    key="balance_member"
+                )
+                with st.form("member_balance"):
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        log_type = st.selectbox("操作", [BalanceLogType.TOPUP, BalanceLogType.REFUND],
+                                                format_func=lambda x: {"topup": "充值", "refund": "退款"}[x.value])
+                        amount = st.number_input("金额", min_value=0.01, step=10.0, value=100.0, format="%.2f")
+                    with col2:
+                        order_no = st.text_input("关联订单号（退款时填写）")
+                        remark = st.text_input("备注")
+                    if st.form_submit_button("提交", type="primary"):
+                        if log_type == BalanceLogType.TOPUP:
+                            balance_after = topup_member_balance(db, member.id, amount, remark=remark or None)
+                        else:
+                            balance_after = refund_member_balance(db, member.id, amount, order_no=order_no or None,
+                                                                  remark=remark or f"退款 ¥{amount:.2f}")
+                        db.commit()
+                        st.success(f"✅ 操作成功，当前余额 ¥{balance_after:.2f}")
+                        st.rerun()
+                
+                st.subheader("余额流水")
+                logs = db.query(MemberBalanceLog).filter(
+                    MemberBalanceLog.member_id == member.id
+                ).order_by(MemberBalanceLog.id.desc()).limit(100).all()
+                if logs:
+                    st_df(pd.DataFrame([{
+                        "时间": log.created_at.strftime("%Y-%m-%d %H:%M"),
+                        "类型": {"opening": "期初", "topup": "充值", "spend": "消费", "refund": "退款"}[log.log_type.value],
+                        "金额": f"{log.amount:+.2f}",
+                        "变动后余额": f"¥{log.balance_after:.2f}",
+                        "订单号": log.order_no or "-",
+                        "备注": log.remark or "-"
+                    } for log in logs]), use_container_width=True)
+                else:
+                    st.info("暂无余额流水")
+                
+                if st.button("🔍 核对余额"):
+                    mismatched = verify_member_balances(db)
+                    if mismatched.empty:
+                        st.success("✅ 所有会员余额与流水一致")
+                    else:
+                        st.error(f"❌ {len(mismatched)} 名会员余额与流水不一致")
+                        st_df(mismatched.rename(columns={
+                            "member_id": "会员ID", "name": "姓名", "balance": "余额", "ledger_balance": "流水累计"
+                        }), use_container_width=True)
+            else:
+                st.info("暂无会员")
     finally: 
         db.close()
 
 # 订单管理
 elif page == "📝 订单管理":
     st.header("📝 订单管理")
-    db = get_db()
+    db = get_read_db()
     try:
-        orders = db.query(Order).order_by(Order.created_at.desc()).limit(50).all()
-        if orders:
+        orders = query_stores(recent_orders_report)
+        if not orders.empty:
+            orders = orders.sort_values("created_at", ascending=False).head(50)
             st_df(pd.DataFrame([{
                 "订单号": o.order_no,
                 "金额": f"¥{o.total_amount:.2f}",
-                "状态": o.status.value,
+                "状态": o.status,
                 "时间": o.created_at.strftime("%Y-%m-%d %H:%M")
-            } for o in orders]), use_container_width=True)
+            } for o in orders.itertuples()]), use_container_width=True)
         else: 
             st.info("暂无订单")
     finally: 
@@ -1536,9 +1588,10 @@ elif page == "📝 订单管理":
 # 库存台账
 elif page == "📦 库存台账":
     st.header("📦 库存台账")
-    db = get_db()
+    # 报表页面走只读连接，长查询不与经营页面的写入争用
+    db = get_read_db()
     try:
-        tab1, tab2 = st.tabs(["库存流水", "库存详情"])
+        tab1, tab2, tab3, tab4 = st.tabs(["库存流水", "库存详情", "门店估值", "补货建议"])
         
         with tab1:
             st.subheader("📋 库存流水记录")
@@ -1551,7 +1604,8 @@ elif page == "📦 库存台账":
                 selected_store_id = st.selectbox("门店", store_options, format_func=lambda x: x[1])
             
             with col2:
-                log_type_options = [(0, "全部类型"), ("in", "入库"), ("out", "出库"), ("adjust", "调整")]
+                log_type_options = [(0, "全部类型"), ("in", "入库"), ("out", "出库"), ("adjust", "调整"),
+                                    ("transfer_in", "调入"), ("transfer_out", "调出")]
                 selected_log_type = st.selectbox("类型", log_type_options, format_func=lambda x: x[1])
             
             with col3:
@@ -1560,19 +1614,25 @@ elif page == "📦 库存台账":
             with col4:
                 end_date = st.date_input("结束日期", value=date.today())
             
-            # 查询库存流水
-            query = db.query(InventoryLog).filter(
-                InventoryLog.created_at >= datetime.combine(start_date, datetime.min.time()),
-                InventoryLog.created_at <= datetime.combine(end_date, datetime.max.time())
-            )
+            # 查询库存流水（查询区间早于归档水位时自动合并归档库），分库模式各门店库并发查询后合并
+            start_dt = datetime.combine(start_date, datetime.min.time())
             
-            if selected_store_id[0] != 0:
-                query = query.filter(InventoryLog.store_id == selected_store_id[0])
-            
-            if selected_log_type[0] != 0:
-                query = query.filter(InventoryLog.log_type == selected_log_type[0])
+            def query_logs(store_db, store_ids):
+                logs_src = history_source(store_db, InventoryLog.__table__, start_dt)
+                query = select(logs_src).where(
+                    logs_src.c.created_at >= start_dt,
+                    logs_src.c.created_at <= datetime.combine(end_date, datetime.max.time())
+                )
+                if store_ids:
+                    query = query.where(logs_src.c.store_id.in_(store_ids))
+                if selected_log_type[0] != 0:
+                    query = query.where(logs_src.c.log_type == InventoryLogType(selected_log_type[0]))
+                return store_db.execute(query.order_by(logs_src.c.created_at.desc())).all()
             
-            logs = query.order_by(InventoryLog.created_at.desc()).all()
+            logs = [log for rows in map_stores(query_logs, [selected_store_id[0]] if selected_store_id[0] != 0 else None,
+                                               read_only=True)
+                    for log in rows]
+            logs.sort(key=lambda log: log.created_at, reverse=True)
             
             if logs:
                 # 获取门店和商品信息
@@ -1584,7 +1644,9 @@ elif page == "📦 库存台账":
                 type_map = {
                     "in": "入库",
                     "out": "出库",
-                    "adjust": "调整"
+                    "adjust": "调整",
+                    "transfer_in": "调入",
+                    "transfer_out": "调出"
                 }
                 
                 # 创建DataFrame
@@ -1606,8 +1668,8 @@ elif page == "📦 库存台账":
                 # 显示选中行的详情
                 if event.selection['rows']:
                     selected_row = event.selection['rows'][0]
-                    log_id = df.iloc[selected_row]['ID']
-                    log = db.query(InventoryLog).get(log_id)
+                    # 分库模式流水ID只在门店库内唯一，按行号取流水
+                    log = logs[selected_row]
                     
                     if log:
                         st.divider()
@@ -1682,23 +1744,31 @@ elif page == "📦 库存台账":
                     format_func=lambda x: x[1]
                 )
                 
-                # 查询该门店的库存
-                inventories = db.query(Inventory).filter(Inventory.store_id == selected_store_id[0]).all()
+                as_of_date = st.date_input("库存日期", value=date.today(), max_value=date.today(), key="inventory_as_of_date")
                 
-                if inventories:
-                    # 获取商品信息
-                    products_dict = {p.id: p for p in db.query(Product).all()}
-                    
+                store_db = get_store_db(selected_store_id[0], read_only=True)
+                try:
+                    if as_of_date < date.today():
+                        # 历史库存：由库存快照 + 流水回放得出
+                        overview = inventory_overview(store_db, selected_store_id[0], as_of=datetime.combine(as_of_date, datetime.max.time()))
+                        st.caption(f"显示 {as_of_date:%Y-%m-%d} 日终的台账库存")
+                    else:
+                        overview = inventory_overview(store_db, selected_store_id[0])
+                finally:
+                    store_db.close()
+                
+                if not overview.empty:
                     # 创建DataFrame
-                    df = pd.DataFrame([{
-                        "商品ID": inv.product_id,
-                        "商品名称": products_dict.get(inv.product_id, {}).name if inv.product_id in products_dict else "未知",
-                        "商品编码": products_dict.get(inv.product_id, {}).code if inv.product_id in products_dict else "未知",
-                        "分类": products_dict.get(inv.product_id, {}).category if inv.product_id in products_dict else "未知",
-                        "当前库存": inv.quantity,
-                        "单价": f"¥{products_dict.get(inv.product_id, {}).unit_price:.2f}" if inv.product_id in products_dict else "-",
-                        "库存价值": f"¥{inv.quantity * products_dict.get(inv.product_id, {}).unit_price:.2f}" if inv.product_id in products_dict else "-"
-                    } for inv in inventories])
+                    df = pd.DataFrame({
+                        "商品ID": overview["product_id"],
+                        "商品名称": overview["name"],
+                        "商品编码": overview["code"],
+                        "分类": overview["category"],
+                        "当前库存": overview["quantity"],
+                        "补货阈值": overview["reorder_threshold"],
+                        "单价": overview["unit_price"].map("¥{:.2f}".format),
+                        "库存价值": overview["stock_value"].map("¥{:.2f}".format)
+                    })
                     
                     # 显示表格（支持行选择）
                     event = st_df(df, use_container_width=True, hide_index=True, on_select="rerun", selection_mode="single-row")
@@ -1706,8 +1776,8 @@ elif page == "📦 库存台账":
                     # 显示选中行的详情
                     if event.selection['rows']:
                         selected_row = event.selection['rows'][0]
-                        product_id = df.iloc[selected_row]['商品ID']
-                        product = products_dict.get(product_id)
+                        product_id = int(df.iloc[selected_row]['商品ID'])
+                        product = db.get(Product, product_id)
                         
                         if product:
                             st.divider()
@@ -1725,14 +1795,19 @@ elif page == "📦 库存台账":
                             st.divider()
                             st.subheader(f"📋 {product.name} 的库存流水记录")
                             
-                            inventory_logs = db.query(InventoryLog).filter(
-                                InventoryLog.store_id == selected_store_id[0],
-                                InventoryLog.product_id == product_id
-                            ).order_by(InventoryLog.created_at.desc()).limit(10).all()
+                            store_db = get_store_db(selected_store_id[0], read_only=True)
+                            try:
+                                inventory_logs = store_db.query(InventoryLog).filter(
+                                    InventoryLog.store_id == selected_store_id[0],
+                                    InventoryLog.product_id == product_id
+                                ).order_by(InventoryLog.created_at.desc()).limit(10).all()
+                            finally:
+                                store_db.close()
                             
                             if inventory_logs:
                                 logs_df = pd.DataFrame([{
-                                    "类型": "入库" if log.log_type == InventoryLogType.IN else "出库" if log.log_type == InventoryLogType.OUT else "调整",
+                                    "类型": {InventoryLogType.IN: "入库", InventoryLogType.OUT: "出库", InventoryLogType.TRANSFER_IN: "调入",
+                                             InventoryLogType.TRANSFER_OUT: "调出"}.get(log.log_type, "调整"),
                                     "变动数量": f"+{log.quantity}" if log.quantity > 0 else str(log.quantity),
                                     "变动前": log.before_quantity,
                                     "变动后": log.after_quantity,
@@ -1746,23 +1821,22 @@ elif page == "📦 库存台账":
                     # 库存统计
                     st.divider()
                     st.subheader("📊 库存统计")
-                    total_quantity = sum(inv.quantity for inv in inventories)
-                    total_value = sum(inv.quantity * products_dict.get(inv.product_id, {}).unit_price for inv in inventories if inv.product_id in products_dict)
                     
                     col1, col2 = st.columns(2)
                     with col1:
-                        st.metric("总库存数量", total_quantity)
+                        st.metric("总库存数量", int(overview["quantity"].sum()))
                     with col2:
-                        st.metric("总库存价值", f"¥{total_value:,.2f}")
+                        st.metric("总库存价值", f"¥{overview['stock_value'].sum():,.2f}")
                     
-                    # 库存预警
+                    # 库存预警（按商品补货阈值）
                     st.subheader("⚠️ 库存预警")
-                    low_stock = [inv for inv in inventories if inv.quantity < 10]
-                    if low_stock:
-                        low_stock_df = pd.DataFrame([{
-                            "商品": products_dict.get(inv.product_id, {}).name if inv.product_id in products_dict else "未知",
-                            "当前库存": inv.quantity
-                        } for inv in low_stock])
+                    low_stock = overview[overview["is_low"].astype(bool)]
+                    if not low_stock.empty:
+                        low_stock_df = pd.DataFrame({
+                            "商品": low_stock["name"],
+                            "当前库存": low_stock["quantity"],
+                            "补货阈值": low_stock["reorder_threshold"]
+                        })
                         st.warning(f"发现 {len(low_stock)} 种商品库存不足")
                         st_df(low_stock_df, use_container_width=True)
                     else:
@@ -1771,13 +1845,87 @@ elif page == "📦 库存台账":
                     st.info("该门店暂无库存记录")
             else:
                 st.warning("请先创建门店")
+        
+        with tab3:
+            st.subheader("🏬 门店库存估值")
+            valuation = query_stores(inventory_valuation_by_store)
+            if not valuation.empty:
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("全部门店库存数量", int(valuation["total_quantity"].sum()))
+                with col2:
+                    st.metric("全部门店库存价值", f"¥{valuation['total_value'].sum():,.2f}")
+                with col3:
+                    st.metric("低库存商品数", int(valuation["low_stock_count"].sum()))
+                st_df(pd.DataFrame({
+                    "门店": valuation["name"],
+                    "商品种类": valuation["product_count"],
+                    "库存数量": valuation["total_quantity"],
+                    "库存价值": valuation["total_value"].map("¥{:,.2f}".format),
+                    "低库存商品": valuation["low_stock_count"]
+                }), use_container_width=True, hide_index=True)
+            else:
+                st.info("暂无门店")
+        
+        with tab4:
+            st.subheader("🚚 补货建议")
+            st.caption(f"根据近{FORECAST_HISTORY_DAYS}天订单销量按周季节性预测未来{FORECAST_HORIZON_DAYS}天需求，建议补货量 = 预测销量 + 安全库存 - 当前库存")
+            
+            col1, col2 = st.columns([3, 1])
+            with col2:
+                if st.button("🔄 重新计算", type="primary"):
+                    write_db = get_db()
+                    try:
+                        count = generate_replenishment_suggestions(write_db, use_order_cache=True)
+                    finally:
+                        write_db.close()
+                    # 结束只读会话当前的快照，下面读到刚生成的建议
+                    db.rollback()
+                    st.success(f"✅ 已生成 {count} 条补货建议")
+            
+            generated_at = db.query(func.max(ReplenishmentSuggestion.generated_at)).scalar()
+            if generated_at:
+                stores = db.query(Store).filter(Store.status == StoreStatus.ACTIVE).all()
+                with col1:
+                    suggestion_store = st.selectbox(
+                        "门店",
+                        [(0, "全部门店")] + [(s.id, s.name) for s in stores],
+                        format_func=lambda x: x[1],
+                        key="suggestion_store"
+                    )
+                only_needed = st.checkbox("只看需要补货的商品", value=True)
+                
+                query = db.query(ReplenishmentSuggestion, Store.name, Product.name).join(
+                    Store, Store.id == ReplenishmentSuggestion.store_id
+                ).join(Product, Product.id == ReplenishmentSuggestion.product_id)
+                if suggestion_store[0] != 0:
+                    query = query.filter(ReplenishmentSuggestion.store_id == suggestion_store[0])
+                if only_needed:
+                    query = query.filter(ReplenishmentSuggestion.suggested_quantity > 0)
+                suggestions = query.order_by(ReplenishmentSuggestion.suggested_quantity.desc()).all()
+                
+                st.caption(f"计算时间: {generated_at:%Y-%m-%d %H:%M}")
+                if suggestions:
+                    st_df([{
+                        "门店": store_name,
+                        "商品": product_name,
+                        "日均销量": f"{r.avg_daily_sales:.2f}",
+                        "预测销量": f"{r.forecast_quantity:.1f}",
+                        "安全库存": f"{r.safety_stock:.1f}",
+                        "当前库存": r.on_hand,
+                        "建议补货": r.suggested_quantity
+                    } for r, store_name, product_name in suggestions], use_container_width=True, hide_index=True)
+                else:
+                    st.success("暂无需要补货的商品")
+            else:
+                st.info("尚未计算补货建议，请点击“重新计算”")
     finally:
         db.close()
 
 # 财务报表
 elif page == "💰 财务报表":
     st.header("💰 财务报表")
-    db = get_db()
+    db = get_read_db()
     try:
         tab1, tab2 = st.tabs(["营业额统计", "台位统计"])
         
@@ -1786,38 +1934,30 @@ elif page == "💰 财务报表":
             start_date = st.date_input("开始日期", value=date.today() - timedelta(days=7))
             end_date = st.date_input("结束日期", value=date.today())
             
-            orders = db.query(Order).filter(
-                Order.created_at >= datetime.combine(start_date, datetime.min.time()),
-                Order.created_at <= datetime.combine(end_date, datetime.max.time())
-            ).all()
-            
-            total_revenue = sum(o.total_amount for o in orders)
-            total_orders = len(orders)
+            # 区间在订单列存缓存内时直接在内存中汇总，否则由后台进程按门店和日期区间切分并行汇总
+            start = datetime.combine(start_date, datetime.min.time())
+            end = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+            daily = cached_revenue_report(start, end)
+            if daily is None:
+                daily = report_with_progress("revenue", "营业额统计", start=start, end=end)
             
             col1, col2 = st.columns(2)
             with col1:
-                st.metric("总营业额", f"¥{total_revenue:,.2f}")
+                st.metric("总营业额", f"¥{daily['revenue'].sum():,.2f}")
             with col2:
-                st.metric("总订单数", total_orders)
+                st.metric("总订单数", int(daily["order_count"].sum()))
             
-            if orders:
-                # 按日期统计
-                df = pd.DataFrame([{
-                    "日期": o.created_at.strftime("%Y-%m-%d"),
-                    "金额": o.total_amount
-                } for o in orders])
-                
-                df_grouped = df.groupby("日期").sum().reset_index()
-                st_df(df_grouped, use_container_width=True)
+            if not daily.empty:
+                st_df(pd.DataFrame({"日期": daily["date"], "金额": daily["revenue"]}), use_container_width=True)
         
         with tab2:
             st.subheader("🪑 台位统计")
-            sessions = db.query(Session).all()
+            usage = report_with_progress("table_usage", "台位统计")
+            total_sessions = int(usage["session_count"].sum())
             
-            if sessions:
-                total_sessions = len(sessions)
-                completed_sessions = len([s for s in sessions if s.status == SessionStatus.COMPLETED])
-                avg_duration = sum(s.duration_minutes for s in sessions if s.duration_minutes) / completed_sessions if completed_sessions > 0 else 0
+            if total_sessions:
+                completed_sessions = int(usage["completed_count"].sum())
+                avg_duration = usage["duration_minutes"].sum() / completed_sessions if completed_sessions > 0 else 0
                 
                 col1, col2, col3 = st.columns(3)
                 with col1:
@@ -1829,15 +1969,8 @@ elif page == "💰 财务报表":
                 
                 # 台位使用率统计
                 st.subheader("台位使用情况")
-                tables = db.query(Table).all()
-                table_stats = []
-                for t in tables:
-                    session_count = db.query(Session).filter(Session.table_id == t.id).count()
-                    table_stats.append({
-                        "台位": t.name,
-                        "开台次数": session_count
-                    })
-                df = pd.DataFrame(table_stats)
-                st_df(df, use_container_width=True)
+                existing = usage[usage["table_name"].notna()]
+                st_df(pd.DataFrame({"台位": existing["table_name"], "开台次数": existing["session_count"]}),
+                      use_container_width=True)
     finally: 
         db.close()
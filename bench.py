@@ -0,0 +1,1203 @@
+"""并发与性能压测脚本
+
+在临时目录中创建独立的数据库运行，不影响正式数据，结束后删除临时目录；
+设置 TEA_HOUSE_BENCH_DIR 时改用该目录并保留，便于查看压测生成的数据。
+"""
+import sys
+import os
+import io
+import argparse
+import atexit
+import shutil
+import tempfile
+import time
+import random
+import json
+import sqlite3
+import threading
+import http.client
+from itertools import zip_longest
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# 添加项目路径
+sys.path.insert(0, os.path.dirname(__file__))
+
+# 必须在导入 tea_house 之前指定临时数据库；报表进程池的子进程会重新导入本脚本，沿用父进程的临时目录
+BENCH_DIR = os.environ.get("TEA_HOUSE_BENCH_DIR")
+if not BENCH_DIR:
+    BENCH_DIR = os.environ["TEA_HOUSE_BENCH_DIR"] = tempfile.mkdtemp(prefix="tea_house_bench_")
+    # 只由创建临时目录的进程在退出时删除，子进程通过环境变量拿到目录，不注册删除
+    atexit.register(shutil.rmtree, BENCH_DIR, ignore_errors=True)
+os.environ["TEA_HOUSE_DB"] = os.path.join(BENCH_DIR, "bench.db")
+os.environ["TEA_HOUSE_ARCHIVE_DB"] = os.path.join(BENCH_DIR, "bench_archive.db")
+os.environ["TEA_HOUSE_REPORT_CACHE_DIR"] = os.path.join(BENCH_DIR, "report_cache")
+# --sharded：门店经营数据按门店分库（目前只有 api、reports、report-jobs、order-cache 场景支持）
+if "--sharded" in sys.argv:
+    os.environ["TEA_HOUSE_SHARD_DIR"] = os.path.join(BENCH_DIR, "shards")
+else:
+    os.environ.pop("TEA_HOUSE_SHARD_DIR", None)
+
+from sqlalchemy import func, insert, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+from tea_house import (
+    get_db, get_read_db, get_store_db, Member, MemberLevel, Product, Store, Table, TableStatus, Session, SessionStatus, SessionItem,
+    Inventory, InventoryLog, InventoryLogType, Order, OrderStatus, PaymentMethod,
+    PricingRule, InsufficientBalanceError, OperationConflictError, PricingEngine,
+    topup_member_balance, spend_member_balance, verify_member_balances, new_idempotency_key, open_table,
+    submit_session_order, checkout_session, receive_stock, transfer_stock, reconcile_all_stores,
+    drain_outbox, drain_all_outboxes, count_pending_outbox, map_stores, get_store_engine, all_store_ids,
+    REPORT_PARTITION_DAYS, report_partitions, revenue_report, table_usage_report, backup_databases, list_backups,
+    close_day, DailyStoreSummary, ARCHIVE_RETENTION_DAYS, archive_all_stores, ARCHIVE_TABLES,
+    init_database, get_report_jobs, submit_report_job, OrderItem, OrderColumnCache, get_order_cache, cached_revenue_report,
+    cached_daily_sales, store_revenue_since, _store_revenue_query, _frame, _load_forecast_rows, query_stores
+)
+
+
+def bench_balance(args):
+    """多线程同时对同一会员余额扣款，校验不超扣、流水与余额一致"""
+    db = get_db()
+    try:
+        member = Member(name="压测会员", phone=f"bench{int(time.time() * 1000)}")
+        db.add(member)
+        db.flush()
+        topup_member_balance(db, member.id, args.topup)
+        db.commit()
+        member_id = member.id
+    finally:
+        db.close()
+
+    def spend(i):
+        db = get_db()
+        try:
+            spend_member_balance(db, member_id, args.amount, order_no=f"BENCH{i:06d}")
+            db.commit()
+            return True
+        except InsufficientBalanceError:
+            db.rollback()
+            return False
+        finally:
+            db.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(spend, range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    succeeded = sum(results)
+    expected = min(args.requests, int(round(args.topup / args.amount, 6)))
+    db = get_db()
+    try:
+        balance = db.query(Member.balance).filter(Member.id == member_id).scalar()
+        mismatched = verify_member_balances(db)
+    finally:
+        db.close()
+
+    print(f"并发扣款 {args.requests} 次（{args.workers} 线程），耗时 {elapsed:.2f} 秒，"
+          f"{args.requests / elapsed:.0f} 次/秒")
+    print(f"  成功 {succeeded} 次（预期 {expected}），余额不足 {args.requests - succeeded} 次，最终余额 ¥{balance:.2f}")
+    ok = succeeded == expected and balance >= 0 and mismatched.empty
+    print("✅ 通过" if ok else "❌ 失败：余额被超扣或与流水不一致")
+    return ok
+
+
+def reference_discount(rules, product, store_id, member_level, now):
+    """逐条扫描规则的参考实现，用于校验定价引擎结果"""
+    best = None
+    for r in rules:
+        if r.start_at is not None and r.start_at > now or r.end_at is not None and r.end_at <= now:
+            continue
+        if r.member_level is not None and r.member_level != member_level:
+            continue
+        if r.store_id is not None and r.store_id != store_id:
+            continue
+        if r.product_id is not None and r.product_id != product.id:
+            continue
+        if r.product_id is None and r.category and r.category != product.category:
+            continue
+        target = 2 if r.product_id is not None else (1 if r.category else 0)
+        rank = (r.priority, (target, r.store_id is not None, r.member_level is not None), -r.discount_rate)
+        if best is None or rank > best[0]:
+            best = (rank, r.discount_rate)
+    return best[1] if best else 1.0
+
+
+def bench_pricing(args):
+    """批量定价：规则预编译后逐行查表，并与逐条扫描的参考实现比对"""
+    rng = random.Random(args.seed)
+    now = datetime.now()
+    db = get_db()
+    try:
+        products = db.query(Product.id, Product.category, Product.unit_price).all()
+        store_ids = [s.id for s in db.query(Store).all()]
+        categories = sorted({p.category for p in products})
+        levels = list(MemberLevel)
+        db.query(PricingRule).delete()
+        for i in range(args.rules):
+            scope = rng.random()
+            start_at = end_at = None
+            if rng.random() < 0.3:
+                start_at = now + timedelta(hours=rng.randint(-48, 24))
+                end_at = start_at + timedelta(hours=rng.randint(1, 72))
+            db.add(PricingRule(
+                name=f"压测规则{i}",
+                member_level=rng.choice(levels) if rng.random() < 0.6 else None,
+                store_id=rng.choice(store_ids) if rng.random() < 0.4 else None,
+                category=rng.choice(categories) if 0.3 <= scope < 0.7 else None,
+                product_id=rng.choice(products).id if scope < 0.3 else None,
+                discount_rate=round(rng.uniform(0.5, 0.99), 2),
+                priority=rng.randint(0, 3),
+                start_at=start_at,
+                end_at=end_at
+            ))
+        db.commit()
+        rules = db.query(PricingRule.member_level, PricingRule.store_id, PricingRule.category, PricingRule.product_id,
+                         PricingRule.discount_rate, PricingRule.priority, PricingRule.start_at, PricingRule.end_at).all()
+    finally:
+        db.close()
+
+    items = [(rng.choice(products), rng.choice(store_ids), rng.choice(levels + [None]))
+             for _ in range(args.items)]
+    pricing = PricingEngine()
+
+    started = time.perf_counter()
+    pricing.lookup(items[0][0].id, items[0][0].category, now=now)
+    compiled = time.perf_counter() - started
+
+    started = time.perf_counter()
+    prices = [pricing.price(p.unit_price, p.id, p.category, store_id, level, now)
+              for p, store_id, level in items]
+    elapsed = time.perf_counter() - started
+
+    # 参考实现逐条扫描规则，较慢，只抽样比对
+    sample = list(zip(items, prices))[:args.verify]
+    mismatched = sum(
+        1 for (p, store_id, level), price in sample
+        if price != round(p.unit_price * reference_discount(rules, p, store_id, level, now), 2)
+    )
+    print(f"{len(rules)} 条规则编译耗时 {compiled * 1000:.1f} 毫秒")
+    print(f"定价 {args.items} 行耗时 {elapsed * 1000:.1f} 毫秒，每行 {elapsed / args.items * 1e6:.2f} 微秒")
+    print(f"  抽样 {len(sample)} 行与逐条扫描结果比对，不一致 {mismatched} 行")
+    ok = mismatched == 0 and elapsed / args.items * 10000 < 1.0
+    print("✅ 通过" if ok else "❌ 失败")
+    return ok
+
+
+def fire_concurrently(func, workers):
+    """多线程同时执行同一操作，返回每个线程的结果或异常"""
+    def call(_):
+        db = get_db()
+        try:
+            result = func(db)
+            db.commit()
+            return result
+        except Exception as e:
+            db.rollback()
+            return e
+        finally:
+            db.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(call, range(workers)))
+
+
+def bench_checkout(args):
+    """同一开台、结账请求被多个线程同时重复提交，校验只执行一次"""
+    db = get_db()
+    try:
+        table = db.query(Table).filter(Table.status == TableStatus.FREE).first()
+        table_id, store_id = table.id, table.store_id
+        cart = {p.id: 2 for p in db.query(Product).limit(3)}
+        stock_before = dict(db.query(Inventory.product_id, Inventory.quantity).filter(
+            Inventory.store_id == store_id, Inventory.product_id.in_(cart)).all())
+    finally:
+        db.close()
+
+    open_key = new_idempotency_key()
+    results = fire_concurrently(lambda db: open_table(db, table_id, idempotency_key=open_key)[0].id, args.workers)
+    session_ids = {r for r in results if not isinstance(r, Exception)}
+    errors = [r for r in results if isinstance(r, Exception)]
+    print(f"并发开台 {args.workers} 次：得到会话 {sorted(session_ids)}，异常 {len(errors)} 次")
+    ok = len(session_ids) == 1 and not errors
+    session_id = session_ids.pop()
+
+    db = get_db()
+    try:
+        submit_session_order(db, session_id, store_id, cart)
+        db.commit()
+        stock_ordered = dict(db.query(Inventory.product_id, Inventory.quantity).filter(
+            Inventory.store_id == store_id, Inventory.product_id.in_(cart)).all())
+    finally:
+        db.close()
+
+    checkout_key = new_idempotency_key()
+    started = time.perf_counter()
+    results = fire_concurrently(
+        lambda db: checkout_session(db, session_id, PaymentMethod.CASH, checkout_key)[0].id, args.workers
+    )
+    elapsed = time.perf_counter() - started
+    order_ids = {r for r in results if not isinstance(r, Exception)}
+    errors = [r for r in results if isinstance(r, Exception)]
+
+    drain_outbox()
+    db = get_db()
+    try:
+        orders = db.query(Order).filter(Order.id.in_(order_ids)).all()
+        order_nos = [o.order_no for o in orders]
+        order_logs = db.query(InventoryLog).filter(InventoryLog.remark.like(f"订单 {order_nos[0]}%")).count() if orders else 0
+        stock_after = dict(db.query(Inventory.product_id, Inventory.quantity).filter(
+            Inventory.store_id == store_id, Inventory.product_id.in_(cart)).all())
+        table_status = db.get(Table, table_id).status
+    finally:
+        db.close()
+    deducted_once = all(stock_ordered[p] - stock_after[p] == cart[p] for p in stock_after)
+    print(f"并发结账 {args.workers} 次，耗时 {elapsed:.2f} 秒：得到订单 {order_nos}，异常 {len(errors)} 次")
+    print(f"  库存流水 {order_logs} 条，结账扣减库存 "
+          f"{ {p: stock_ordered[p] - stock_after[p] for p in stock_after} }（点单前 {stock_before}），桌台 {table_status.value}")
+    ok = ok and len(order_ids) == 1 and not errors and order_logs == len(stock_after) and deducted_once \
+        and table_status == TableStatus.FREE
+
+    # 没有幂等键的重复结账由会话状态条件拦截
+    results = fire_concurrently(lambda db: checkout_session(db, session_id, PaymentMethod.CASH)[0].id, 4)
+    conflicts = sum(isinstance(r, OperationConflictError) for r in results)
+    print(f"  不带幂等键再次结账 4 次：被拒绝 {conflicts} 次")
+    ok = ok and conflicts == 4
+    print("✅ 通过" if ok else "❌ 失败：重复提交被执行了多次")
+    return ok
+
+
+def bench_contention(args):
+    """多个终端同时对同一桌台开台、点单、结账，校验乐观锁下状态始终一致"""
+    db = get_db()
+    try:
+        table = db.query(Table).filter(Table.status == TableStatus.FREE).first()
+        table_id, store_id = table.id, table.store_id
+        product_ids = [p.id for p in db.query(Product).limit(5)]
+        last_session_id = db.query(func.max(Session.id)).scalar() or 0
+    finally:
+        db.close()
+
+    def terminal(seed):
+        rng = random.Random(seed)
+        outcomes = {"open": 0, "order": 0, "checkout": 0, "stale": 0, "conflict": 0}
+        for _ in range(args.rounds):
+            db = get_db()
+            try:
+                # 读取面板：桌台与进行中会话的版本号
+                table = db.get(Table, table_id)
+                session = db.query(Session).filter(
+                    Session.table_id == table_id, Session.status == SessionStatus.IN_PROGRESS
+                ).first()
+                table_version = table.version
+                session_id, session_version = (session.id, session.version) if session else (None, None)
+                db.rollback()
+                time.sleep(rng.uniform(0, 0.005))
+                try:
+                    if session_id is None:
+                        open_table(db, table_id, version=table_version)
+                        action = "open"
+                    elif rng.random() < 0.7:
+                        submit_session_order(db, session_id, store_id, {rng.choice(product_ids): rng.randint(1, 3)},
+                                             version=session_version)
+                        action = "order"
+                    else:
+                        checkout_session(db, session_id, PaymentMethod.CASH, version=session_version)
+                        action = "checkout"
+                    db.commit()
+                    outcomes[action] += 1
+                except StaleDataError:
+                    db.rollback()
+                    outcomes["stale"] += 1
+                except OperationConflictError:
+                    db.rollback()
+                    outcomes["conflict"] += 1
+            finally:
+                db.close()
+        return outcomes
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(terminal, range(args.workers)))
+    elapsed = time.perf_counter() - started
+    totals = {key: sum(r[key] for r in results) for key in results[0]}
+
+    db = get_db()
+    try:
+        sessions = db.query(Session).filter(Session.table_id == table_id, Session.id > last_session_id).all()
+        in_progress = [s for s in sessions if s.status == SessionStatus.IN_PROGRESS]
+        item_totals = dict(db.query(SessionItem.session_id, func.sum(SessionItem.subtotal)).filter(
+            SessionItem.session_id.in_([s.id for s in sessions])).group_by(SessionItem.session_id).all())
+        completed = [s for s in sessions if s.status == SessionStatus.COMPLETED]
+        orders = db.query(Order.order_no, Order.total_amount).filter(
+            func.substr(Order.order_no, -6).in_([f"{s.id:06d}" for s in completed])).all()
+        table_status = db.get(Table, table_id).status
+    finally:
+        db.close()
+
+    amount_mismatch = sum(1 for s in sessions if abs(s.total_amount - (item_totals.get(s.id) or 0.0)) > 0.005)
+    order_by_session = {int(no[-6:]): amount for no, amount in orders}
+    order_mismatch = sum(1 for s in completed if abs(order_by_session.get(s.id, -1) - s.total_amount) > 0.005)
+    expected_status = TableStatus.OCCUPIED if in_progress else TableStatus.FREE
+    print(f"{args.workers} 个终端各操作 {args.rounds} 次，耗时 {elapsed:.2f} 秒")
+    print(f"  开台 {totals['open']}，点单 {totals['order']}，结账 {totals['checkout']}，"
+          f"版本冲突刷新 {totals['stale']}，状态冲突 {totals['conflict']}")
+    print(f"  会话 {len(sessions)} 个（进行中 {len(in_progress)}），会话金额与明细不符 {amount_mismatch}，"
+          f"订单金额与会话不符 {order_mismatch}，桌台状态 {table_status.value}")
+    ok = (len(in_progress) <= 1 and amount_mismatch == 0 and order_mismatch == 0
+          and len(orders) == len(completed) == totals["checkout"] and totals["open"] == len(sessions)
+          and table_status == expected_status)
+    print("✅ 通过" if ok else "❌ 失败：并发操作破坏了桌台或会话状态")
+    return ok
+
+
+def bench_stock(args):
+    """批量入库与门店调拨：多行明细一次提交，校验库存、流水与对账结果"""
+    rng = random.Random(args.seed)
+    tag = int(time.time() * 1000)
+    db = get_db()
+    try:
+        from_store_id, to_store_id = [s.id for s in db.query(Store).order_by(Store.id).limit(2)]
+        products = [Product(name=f"压测商品{i}", code=f"B{tag}{i:04d}", category="茶叶", unit_price=10.0, unit="件")
+                    for i in range(args.lines)]
+        db.add_all(products)
+        db.commit()
+        lines = {p.id: rng.randint(1, 100) for p in products}
+        transfer_lines = {product_id: rng.randint(1, quantity) for product_id, quantity in lines.items()}
+        logs_before = db.query(func.count(InventoryLog.id)).scalar()
+
+        started = time.perf_counter()
+        receive_stock(db, from_store_id, lines)
+        db.commit()
+        receive_elapsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        transfer_stock(db, from_store_id, to_store_id, transfer_lines)
+        db.commit()
+        transfer_elapsed = time.perf_counter() - started
+
+        stock = {(store_id, product_id): quantity for store_id, product_id, quantity in db.query(
+            Inventory.store_id, Inventory.product_id, Inventory.quantity).filter(Inventory.product_id.in_(lines))}
+        logs_added = db.query(func.count(InventoryLog.id)).scalar() - logs_before
+        stock_mismatch = sum(
+            1 for product_id, quantity in lines.items()
+            if stock.get((from_store_id, product_id)) != quantity - transfer_lines[product_id]
+            or stock.get((to_store_id, product_id)) != transfer_lines[product_id]
+        )
+        reconcile = reconcile_all_stores(db, [from_store_id, to_store_id])
+        reconcile_issues = int(reconcile[reconcile["product_id"].isin(list(lines))]["has_issue"].sum())
+    finally:
+        db.close()
+
+    print(f"{args.lines} 行入库提交耗时 {receive_elapsed * 1000:.1f} 毫秒，"
+          f"{args.lines} 行调拨提交耗时 {transfer_elapsed * 1000:.1f} 毫秒")
+    print(f"  新增流水 {logs_added} 条（应为 {args.lines * 3}），库存不符 {stock_mismatch}，对账差异 {reconcile_issues}")
+    ok = (receive_elapsed < 1.0 and transfer_elapsed < 1.0 and logs_added == args.lines * 3
+          and stock_mismatch == 0 and reconcile_issues == 0)
+    print("✅ 通过" if ok else "❌ 失败")
+    return ok
+
+
+def bench_api(args):
+    """POS 接口压测：每个终端占用一张桌台，循环开台、点单、结账，统计吞吐量与延迟分位数
+    
+    终端轮流分配到各门店的桌台，分库模式下不同门店的写入落在不同的库文件。
+    """
+    from api_server import make_server
+
+    def count_orders():
+        return sum(map_stores(lambda db, store_ids: db.query(func.count(Order.id)).scalar()))
+
+    tables, product_ids = free_tables_and_products(args, product_limit=10)
+    if tables is None:
+        return False
+    orders_before = count_orders()
+
+    server = make_server(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    def terminal(worker):
+        rng = random.Random(args.seed + worker)
+        table_id, store_id = tables[worker]
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        latencies, failures, checkouts = [], [], 0
+
+        def call(method, path, body=None):
+            started = time.perf_counter()
+            conn.request(method, path, body=json.dumps(body) if body is not None else None,
+                         headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            payload = json.loads(response.read())
+            latencies.append(time.perf_counter() - started)
+            if response.status >= 300:
+                failures.append(f"{method} {path} {response.status} {payload.get('error')}")
+                return None
+            return payload
+
+        try:
+            for _ in range(args.rounds):
+                call("GET", f"/api/stores/{store_id}/tables")
+                opened = call("POST", f"/api/stores/{store_id}/tables/{table_id}/open", {"idempotency_key": new_idempotency_key()})
+                if opened is None:
+                    continue
+                session_id = opened["session"]["id"]
+                for _ in range(args.items):
+                    call("POST", f"/api/stores/{store_id}/sessions/{session_id}/items",
+                         {"items": [{"product_id": rng.choice(product_ids), "quantity": rng.randint(1, 2)}]})
+                if call("POST", f"/api/stores/{store_id}/sessions/{session_id}/checkout",
+                        {"payment_method": "cash", "idempotency_key": new_idempotency_key()}):
+                    checkouts += 1
+        finally:
+            conn.close()
+        return latencies, failures, checkouts
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(terminal, range(args.workers)))
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    server.server_close()
+
+    latencies = sorted(l for r in results for l in r[0])
+    failures = [f for r in results for f in r[1]]
+    checkouts = sum(r[2] for r in results)
+    orders = count_orders() - orders_before
+
+    print(f"{args.workers} 个终端各完成 {args.rounds} 轮（开台、{args.items} 次点单、结账），"
+          f"共 {len(latencies)} 个请求，耗时 {elapsed:.2f} 秒")
+    print(f"  吞吐量 {len(latencies) / elapsed:.0f} 请求/秒，延迟 p50 {percentile(latencies, 0.5):.1f} 毫秒，"
+          f"p99 {percentile(latencies, 0.99):.1f} 毫秒，最大 {latencies[-1] * 1000:.1f} 毫秒")
+    print(f"  失败请求 {len(failures)}，结账 {checkouts}，新增订单 {orders}")
+    for failure in failures[:5]:
+        print(f"    {failure}")
+    ok = not failures and orders == checkouts == args.workers * args.rounds
+    print("✅ 通过" if ok else "❌ 失败")
+    return ok
+
+
+def reference_reports(start, end):
+    """原财务报表的做法：一个会话取出全部订单、会话行，在 Python 中逐行汇总，用于对比耗时和校验结果"""
+    def load(db, store_ids):
+        orders = db.query(Order.created_at, Order.total_amount).filter(
+            Order.created_at >= start, Order.created_at < end).all()
+        sessions = db.query(Session.store_id, Session.table_id, Session.status, Session.duration_minutes).all()
+        return orders, sessions
+
+    revenue, session_counts = {}, {}
+    for orders, sessions in map_stores(load):
+        for o in orders:
+            day = o.created_at.strftime("%Y-%m-%d")
+            revenue[day] = revenue.get(day, 0) + o.total_amount
+        for s in sessions:
+            session_counts[(s.store_id, s.table_id)] = session_counts.get((s.store_id, s.table_id), 0) + 1
+    return revenue, session_counts
+
+
+def generate_report_data(args):
+    """生成 args.stores 家门店、args.days 天的订单与已结账会话，返回统计区间 (开始, 结束)"""
+    rng = random.Random(args.seed)
+    tag = int(time.time() * 1000)
+    end = datetime.combine(datetime.utcnow().date() + timedelta(days=1), datetime.min.time())
+    start = end - timedelta(days=args.days)
+
+    db = get_db()
+    try:
+        stores = [Store(name=f"压测门店{i}", code=f"R{tag}{i:03d}") for i in range(args.stores)]
+        db.add_all(stores)
+        db.commit()
+        store_ids = [s.id for s in stores]
+    finally:
+        db.close()
+
+    generated = time.perf_counter()
+    for store_id in store_ids:
+        with get_store_engine(store_id).begin() as conn:
+            table_ids = conn.execute(insert(Table.__table__).returning(Table.__table__.c.id), [
+                {"name": f"桌台{i}", "code": f"R{tag}-{store_id}-{i}", "store_id": store_id, "capacity": 4,
+                 "status": TableStatus.FREE, "version": 1} for i in range(args.tables)
+            ]).scalars().all()
+            orders, sessions = [], []
+            for day in range(args.days):
+                for i in range(args.orders_per_day):
+                    created_at = start + timedelta(days=day, seconds=rng.randrange(86400))
+                    amount = round(rng.uniform(20, 500), 2)
+                    orders.append({"order_no": f"R{tag}-{store_id}-{day}-{i}", "store_id": store_id, "total_amount": amount,
+                                   "payment_method": PaymentMethod.CASH, "status": OrderStatus.PAID, "created_at": created_at})
+                    sessions.append({"table_id": rng.choice(table_ids), "store_id": store_id, "start_time": created_at,
+                                     "end_time": created_at, "status": SessionStatus.COMPLETED, "total_amount": amount,
+                                     "duration_minutes": rng.randint(30, 240), "version": 1})
+            conn.execute(insert(Order.__table__), orders)
+            conn.execute(insert(Session.__table__), sessions)
+    generated = time.perf_counter() - generated
+    rows = args.stores * args.days * args.orders_per_day
+    print(f"生成 {args.stores} 家门店 {args.days} 天数据：订单、会话各 {rows} 行，耗时 {generated:.1f} 秒")
+    return start, end
+
+
+def bench_reports(args):
+    """连锁报表：生成多门店、多日订单与会话，对比原逐行汇总、分区串行、分区并行三种做法的耗时并校验结果一致"""
+    start, end = generate_report_data(args)
+
+    timings = {}
+    started = time.perf_counter()
+    reference_revenue, reference_counts = reference_reports(start, end)
+    timings["逐行汇总（原做法）"] = time.perf_counter() - started
+    results = {}
+    for label, workers in (("分区串行", 1), (f"分区并行（{args.workers} 线程）", args.workers)):
+        started = time.perf_counter()
+        results[label] = (revenue_report(start, end, workers=workers), table_usage_report(workers=workers))
+        timings[label] = time.perf_counter() - started
+
+    baseline = timings["逐行汇总（原做法）"]
+    partitions = len(report_partitions(all_store_ids(), start, end))
+    print(f"  CPU 核数 {os.cpu_count()}，营业额分区 {partitions} 个（门店 × {REPORT_PARTITION_DAYS} 天）")
+    for label, elapsed in timings.items():
+        print(f"  {label}：{elapsed:.2f} 秒（{baseline / elapsed:.1f}x）")
+
+    mismatched = 0
+    for revenue, usage in results.values():
+        daily = dict(zip(revenue["date"], revenue["revenue"]))
+        mismatched += sum(1 for day, amount in reference_revenue.items() if abs(daily.get(day, 0) - amount) > 0.01)
+        mismatched += len(set(daily) - set(reference_revenue))
+        counts = {(s, t): c for s, t, c in zip(usage["store_id"], usage["table_id"], usage["session_count"]) if c}
+        mismatched += counts != reference_counts
+    print(f"  结果与逐行汇总不一致 {mismatched} 处")
+    ok = mismatched == 0
+    print("✅ 通过" if ok else "❌ 失败")
+    return ok
+
+
+def bench_report_jobs(args):
+    """后台报表任务：首次请求在进程池中计算并写入缓存，数据未变化时再次请求直接读缓存，新增订单后重新计算；
+    校验各次结果与同步计算一致"""
+    start, end = generate_report_data(args)
+    jobs = get_report_jobs()
+
+    def frames_equal(left, right):
+        return left[["date", "order_count"]].astype(str).equals(right[["date", "order_count"]].astype(str)) and \
+            (left["revenue"] - right["revenue"]).abs().max() < 0.01
+
+    def timed_job(kind, **params):
+        updates = []
+        started = time.perf_counter()
+        key = submit_report_job(kind, **params)
+        frame = jobs.wait(key, poll=0.02, on_progress=lambda done, total: updates.append((done, total)))
+        return key, frame, time.perf_counter() - started, updates
+
+    started = time.perf_counter()
+    expected = revenue_report(start, end)
+    sync = time.perf_counter() - started
+
+    key, cold, cold_seconds, updates = timed_job("revenue", start=start, end=end)
+    same_key, cached, hit_seconds, _ = timed_job("revenue", start=start, end=end)
+
+    # 区间内新增一笔订单后水位改变，重新计算
+    store_id = all_store_ids()[-1]
+    with get_store_engine(store_id).begin() as conn:
+        conn.execute(insert(Order.__table__).values(
+            order_no=f"J{int(time.time() * 1000)}", store_id=store_id, total_amount=100.0,
+            payment_method=PaymentMethod.CASH, status=OrderStatus.PAID, created_at=end - timedelta(hours=1)
+        ))
+    new_key, fresh, fresh_seconds, _ = timed_job("revenue", start=start, end=end)
+    _, usage, usage_seconds, _ = timed_job("table_usage")
+    _, usage_cached, usage_hit_seconds, _ = timed_job("table_usage")
+
+    print(f"  同步计算营业额 {sync:.2f} 秒；后台任务首次 {cold_seconds:.2f} 秒（含进程启动），"
+          f"收到进度 {len(updates)} 次（最后 {updates[-1] if updates else '-'}）")
+    print(f"  数据未变化再次请求：{hit_seconds * 1000:.1f} 毫秒（命中缓存 {'是' if same_key == key else '否'}）")
+    print(f"  新增订单后重新计算：{fresh_seconds:.2f} 秒，营业额增加 {fresh['revenue'].sum() - expected['revenue'].sum():.2f}")
+    print(f"  台位统计：首次 {usage_seconds:.2f} 秒，再次 {usage_hit_seconds * 1000:.1f} 毫秒")
+    ok = (frames_equal(cold, expected) and frames_equal(cached, expected) and same_key == key and new_key != key
+          and abs(fresh["revenue"].sum() - expected["revenue"].sum() - 100.0) < 0.01
+          and usage_cached["session_count"].sum() == usage["session_count"].sum() and hit_seconds < sync)
+    print("✅ 通过" if ok else "❌ 失败：后台任务结果与同步计算不一致、缓存未命中或新增订单后未重新计算")
+    jobs.shutdown()
+    return ok
+
+
+def bench_order_cache(args):
+    """订单列存缓存：对比首次加载、按水位增量刷新、缓存汇总与 SQL 汇总的耗时并校验结果一致；
+    另用较小的内存上限验证按月淘汰后，早于覆盖范围的区间改走 SQL"""
+    start, end = generate_report_data(args)
+    rng = random.Random(args.seed)
+    db = get_db()
+    try:
+        product_ids = [p.id for p in db.query(Product.id).limit(20)]
+    finally:
+        db.close()
+    # 为最近的订单补上明细，供补货预测的日销量使用
+    items_since = end - timedelta(days=args.item_days)
+    for store_id in all_store_ids():
+        with get_store_engine(store_id).begin() as conn:
+            order_ids = conn.execute(select(Order.id).where(Order.store_id == store_id, Order.created_at >= items_since)
+                                     ).scalars().all()
+            items = []
+            for order_id in order_ids:
+                for product_id in rng.sample(product_ids, rng.randint(1, 3)):
+                    quantity = rng.randint(1, 4)
+                    items.append({"order_id": order_id, "product_id": product_id, "quantity": quantity,
+                                  "unit_price": 10.0, "subtotal": 10.0 * quantity})
+            if items:
+                conn.execute(insert(OrderItem.__table__), items)
+
+    def timed(func, rounds=args.rounds):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            result = func()
+        return result, (time.perf_counter() - started) / rounds
+
+    cache = get_order_cache()
+    started = time.perf_counter()
+    loaded = cache.refresh(max_age=0)
+    load_seconds = time.perf_counter() - started
+    stats = cache.stats()
+    print(f"  首次加载 {loaded} 行：{load_seconds:.2f} 秒，{stats['partitions']} 个月份分区，"
+          f"内存 {stats['bytes'] / 1024 / 1024:.1f} MB")
+
+    today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    forecast_start = (end - timedelta(days=args.item_days)).date()
+    sql_revenue, sql_revenue_seconds = timed(lambda: revenue_report(start, end))
+    cache_revenue, cache_revenue_seconds = timed(lambda: cached_revenue_report(start, end))
+    sql_today, sql_today_seconds = timed(lambda: query_stores(lambda db, ids: _frame(db, _store_revenue_query(ids, today))))
+    cache_today, cache_today_seconds = timed(lambda: store_revenue_since(today))
+
+    def sql_sales():
+        return np.vstack([sales for sales, _ in map_stores(
+            lambda db, ids: _load_forecast_rows(db, forecast_start, end.date()), read_only=True)])
+    sql_sales_rows, sql_sales_seconds = timed(sql_sales)
+    cache_sales_rows, cache_sales_seconds = timed(lambda: cached_daily_sales(forecast_start, end.date()))
+    for label, sql_seconds, cache_seconds in (("营业额按日汇总", sql_revenue_seconds, cache_revenue_seconds),
+                                              ("控制台今日营业额", sql_today_seconds, cache_today_seconds),
+                                              ("补货预测日销量", sql_sales_seconds, cache_sales_seconds)):
+        print(f"  {label}：SQL {sql_seconds * 1000:.1f} 毫秒，缓存 {cache_seconds * 1000:.1f} 毫秒"
+              f"（{sql_seconds / cache_seconds:.1f}x）")
+
+    def same_sales(left, right):
+        return np.array_equal(left[np.lexsort(left.T[::-1])], right[np.lexsort(right.T[::-1])])
+
+    def same_revenue(left, right):
+        return left["date"].tolist() == right["date"].tolist() and \
+            left["order_count"].tolist() == right["order_count"].tolist() and \
+            np.allclose(left["revenue"], right["revenue"])
+
+    # 新增订单后增量刷新只读取新行
+    store_ids = all_store_ids()
+    new_orders = [{"order_no": f"C{int(time.time() * 1000)}-{i}", "store_id": rng.choice(store_ids),
+                   "total_amount": 50.0, "payment_method": PaymentMethod.CASH, "status": OrderStatus.PAID,
+                   "created_at": datetime.utcnow()} for i in range(args.new_orders)]
+    for order in new_orders:
+        with get_store_engine(order["store_id"]).begin() as conn:
+            conn.execute(insert(Order.__table__).values(**order))
+    started = time.perf_counter()
+    added = cache.refresh(max_age=0)
+    refresh_seconds = time.perf_counter() - started
+    idle, idle_seconds = timed(lambda: cache.refresh(max_age=0))
+    print(f"  新增 {args.new_orders} 笔订单后增量刷新：读取 {added} 行，{refresh_seconds * 1000:.1f} 毫秒；"
+          f"无新数据时刷新 {idle_seconds * 1000:.1f} 毫秒")
+    fresh_ok = same_revenue(cached_revenue_report(start, end + timedelta(days=1)),
+                            revenue_report(start, end + timedelta(days=1)))
+
+    # 内存上限只够保留约一个月时，淘汰早期月份，早于覆盖范围的区间返回 None
+    small = OrderColumnCache(stats["bytes"] // max(stats["partitions"], 1) * 2)
+    small.refresh(max_age=0)
+    small_stats = small.stats()
+    print(f"  内存上限 {small.max_bytes / 1024 / 1024:.1f} MB：保留 {small_stats['partitions']} 个分区，"
+          f"内存 {small_stats['bytes'] / 1024 / 1024:.1f} MB，覆盖起点 {small_stats['floor']:%Y-%m-%d}")
+    evict_ok = small_stats["bytes"] <= small.max_bytes and not small.covers(start) and \
+        small.covers(small_stats["floor"]) and len(small.frame("orders", small_stats["floor"])) == \
+        len(cache.frame("orders", small_stats["floor"]))
+
+    ok = (same_revenue(cache_revenue, sql_revenue) and fresh_ok and added == args.new_orders and idle == 0 and evict_ok
+          and same_sales(cache_sales_rows, sql_sales_rows)
+          and sorted(cache_today["order_count"].tolist()) == sorted(sql_today["order_count"].tolist()))
+    print("✅ 通过" if ok else "❌ 失败：缓存汇总与 SQL 不一致、增量刷新行数不对或淘汰后覆盖范围错误")
+    return ok
+
+
+def bench_outbox(args):
+    """多个收银台并发结账，出库流水走异步写入队列：统计结账耗时，模拟重启后补写积压事件并校验流水"""
+    tables, product_ids = free_tables_and_products(args)
+    if tables is None:
+        return False
+
+    def cashier(worker):
+        table_id, store_id = tables[worker]
+        latencies, orders = [], []
+        for _ in range(args.rounds):
+            db = get_store_db(store_id)
+            try:
+                session, _ = open_table(db, table_id)
+                db.commit()
+                session_id = session.id
+                submit_session_order(db, session_id, store_id, {product_id: 1 for product_id in product_ids})
+                db.commit()
+                started = time.perf_counter()
+                order, _ = checkout_session(db, session_id, PaymentMethod.CASH)
+                db.commit()
+                latencies.append(time.perf_counter() - started)
+                orders.append(order.order_no)
+            finally:
+                db.close()
+        return latencies, orders
+
+    # 不启动后台线程，结账产生的事件全部积压在队列中，相当于进程在补写前崩溃
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(cashier, range(args.workers)))
+    latencies = sorted(l for r in results for l in r[0])
+    order_nos = [o for r in results for o in r[1]]
+    pending = sum(map_stores(lambda db, store_ids: count_pending_outbox(db)))
+
+    # 重启时 init_database 调用的就是 drain_all_outboxes
+    started = time.perf_counter()
+    drained = drain_all_outboxes()
+    drain_elapsed = time.perf_counter() - started
+
+    def check_logs(db, store_ids):
+        remaining = count_pending_outbox(db)
+        logged_orders = {remark.split()[1] for (remark,) in db.query(InventoryLog.remark).filter(
+            InventoryLog.log_type == InventoryLogType.OUT, InventoryLog.remark.like("订单 %"))}
+        logs = db.query(func.count(InventoryLog.id)).filter(
+            InventoryLog.remark.in_([f"订单 {no} 消耗 1 件" for no in order_nos])).scalar()
+        return remaining, logged_orders, logs
+
+    checked = map_stores(check_logs, read_only=True)
+    remaining = sum(r[0] for r in checked)
+    logged_orders = set().union(*(r[1] for r in checked))
+    logs = sum(r[2] for r in checked)
+
+    missing = sum(1 for no in order_nos if no not in logged_orders)
+    print(f"{args.workers} 个收银台各结账 {args.rounds} 单（每单 {len(product_ids)} 个商品），"
+          f"结账事务 p50 {percentile(latencies, 0.5):.1f} 毫秒，p99 {percentile(latencies, 0.99):.1f} 毫秒")
+    print(f"  积压事件 {pending} 条，补写 {drained} 条耗时 {drain_elapsed * 1000:.1f} 毫秒，剩余 {remaining} 条")
+    print(f"  出库流水 {logs} 条（应为 {len(order_nos) * len(product_ids)}），缺少流水的订单 {missing}")
+    ok = (pending == drained == len(order_nos) and remaining == 0 and missing == 0
+          and logs == len(order_nos) * len(product_ids))
+    print("✅ 通过" if ok else "❌ 失败")
+    return ok
+
+
+def free_tables_and_products(args, product_limit=None):
+    """每个收银台一张空闲桌台（轮流取各门店的桌台），以及每单点的商品（默认 args.items 个）"""
+    def free_tables(db, store_ids):
+        return db.query(Table.id, Table.store_id).filter(Table.status == TableStatus.FREE).order_by(Table.id).all()
+
+    by_store = {}
+    for rows in map_stores(free_tables):
+        for table_id, store_id in rows:
+            by_store.setdefault(store_id, []).append((table_id, store_id))
+    tables = [table for group in zip_longest(*by_store.values()) for table in group if table]
+    db = get_db()
+    try:
+        product_ids = [p.id for p in db.query(Product.id).limit(product_limit or args.items)]
+    finally:
+        db.close()
+    if len(tables) < args.workers:
+        print(f"❌ 空闲桌台只有 {len(tables)} 张，少于收银台数 {args.workers}")
+        return None, None
+    return tables, product_ids
+
+
+def run_cashiers(args, tables, product_ids):
+    """args.workers 个收银台各循环 args.rounds 轮开台、点单、结账，返回排序后的每轮耗时（秒）"""
+    def cashier(worker):
+        table_id, store_id = tables[worker]
+        latencies = []
+        for _ in range(args.rounds):
+            started = time.perf_counter()
+            db = get_store_db(store_id)
+            try:
+                session, _ = open_table(db, table_id)
+                db.commit()
+                submit_session_order(db, session.id, store_id, {product_id: 1 for product_id in product_ids})
+                db.commit()
+                checkout_session(db, session.id, PaymentMethod.CASH)
+                db.commit()
+            finally:
+                db.close()
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        return sorted(l for r in pool.map(cashier, range(args.workers)) for l in r)
+
+
+def percentile(latencies, p):
+    """排序后耗时的百分位（毫秒）"""
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+
+def bench_analytics(args):
+    """报表与收银并行：多个收银台循环开台、点单、结账，对比空闲时和只读连接上持续跑大报表时的结账延迟"""
+    generate_report_data(args)
+    tables, product_ids = free_tables_and_products(args)
+    if tables is None:
+        return False
+
+    idle = run_cashiers(args, tables, product_ids)
+
+    # 报表线程在只读连接上反复执行一条扫描全部订单、会话的长查询，直到收银结束
+    stop = threading.Event()
+    report_times = []
+
+    def reporter():
+        while not stop.is_set():
+            started = time.perf_counter()
+            db = get_read_db()
+            try:
+                db.execute(text(
+                    "SELECT date(o.created_at), o.store_id, COUNT(*), SUM(o.total_amount), SUM(s.duration_minutes) "
+                    "FROM orders o JOIN sessions s ON s.store_id = o.store_id AND s.start_time = o.created_at "
+                    "GROUP BY 1, 2"
+                )).all()
+            finally:
+                db.close()
+            report_times.append(time.perf_counter() - started)
+
+    thread = threading.Thread(target=reporter)
+    thread.start()
+    busy = run_cashiers(args, tables, product_ids)
+    stop.set()
+    thread.join()
+
+    # 只读连接拒绝写入
+    db = get_read_db()
+    try:
+        db.execute(text("DELETE FROM orders"))
+        read_only = False
+    except OperationalError:
+        read_only = True
+    finally:
+        db.close()
+
+    print(f"{args.workers} 个收银台各完成 {args.rounds} 轮（开台、点单 {len(product_ids)} 个商品、结账）")
+    print(f"  空闲时：p50 {percentile(idle, 0.5):.1f} 毫秒，p99 {percentile(idle, 0.99):.1f} 毫秒")
+    print(f"  报表运行时：p50 {percentile(busy, 0.5):.1f} 毫秒，p99 {percentile(busy, 0.99):.1f} 毫秒，"
+          f"期间完成报表 {len(report_times)} 次，平均 {sum(report_times) / max(len(report_times), 1):.2f} 秒/次")
+    print(f"  只读连接拒绝写入：{'是' if read_only else '否'}")
+    ok = read_only and report_times and percentile(busy, 0.99) < args.max_p99_ms
+    print("✅ 通过" if ok else f"❌ 失败：报表运行时结账 p99 超过 {args.max_p99_ms} 毫秒或只读连接可写入")
+    return bool(ok)
+
+
+def bench_backup(args):
+    """在线备份：收银台持续结账时反复做热备份，检查结账延迟、快照完整性、增量沿用和快照轮换"""
+    generate_report_data(args)
+    tables, product_ids = free_tables_and_products(args)
+    if tables is None:
+        return False
+    backup_dir = os.path.join(BENCH_DIR, "backups")
+
+    idle = run_cashiers(args, tables, product_ids)
+
+    stop = threading.Event()
+    manifests = []
+
+    def backer():
+        while not stop.is_set():
+            manifests.append(backup_databases(backup_dir, args.keep, args.pages, args.sleep))
+
+    thread = threading.Thread(target=backer)
+    thread.start()
+    busy = run_cashiers(args, tables, product_ids)
+    stop.set()
+    thread.join()
+
+    # 收银停止后再备份一次：主库已有变化需要复制，归档库未变化应直接沿用
+    final = backup_databases(backup_dir, args.keep, args.pages, args.sleep)
+    snapshots = list_backups(backup_dir)
+    snapshot_dir, _ = snapshots[-1]
+    db = get_db()
+    try:
+        expected = db.query(func.count(Order.id)).scalar()
+    finally:
+        db.close()
+    with sqlite3.connect(os.path.join(snapshot_dir, os.path.basename(os.environ["TEA_HOUSE_DB"]))) as conn:
+        restored = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+    copies = [s for m in manifests + [final] for s in m["files"].values() if not s["linked"]]
+    copied = sum(s["bytes"] for s in copies)
+    seconds = sum(s["seconds"] for s in copies)
+    print(f"{args.workers} 个收银台各完成 {args.rounds} 轮（开台、点单 {len(product_ids)} 个商品、结账）")
+    print(f"  空闲时：p50 {percentile(idle, 0.5):.1f} 毫秒，p99 {percentile(idle, 0.99):.1f} 毫秒")
+    print(f"  备份运行时：p50 {percentile(busy, 0.5):.1f} 毫秒，p99 {percentile(busy, 0.99):.1f} 毫秒，"
+          f"期间完成备份 {len(manifests)} 次")
+    print(f"  复制 {len(copies)} 个文件共 {copied / 1024 / 1024:.1f} MB，耗时 {seconds:.2f} 秒"
+          f"（{copied / 1024 / 1024 / max(seconds, 1e-9):.1f} MB/s）")
+    print(f"  最后一次备份沿用未变化文件 {final['linked_files']} 个，快照内订单 {restored} 条（主库 {expected} 条），"
+          f"保留快照 {len(snapshots)} 个（上限 {args.keep}）")
+    ok = (manifests and restored == expected and final["linked_files"] >= 1 and len(snapshots) <= args.keep
+          and percentile(busy, 0.99) < args.max_p99_ms)
+    print("✅ 通过" if ok else "❌ 失败：快照数据不一致、未沿用未变化文件、未轮换或结账 p99 超限")
+    return bool(ok)
+
+
+def bench_close_day(args):
+    """日结：生成超过保留期的历史数据和遗留会话，执行日结，输出各阶段耗时并校验汇总、遗留会话、归档回收空间"""
+    start, end = generate_report_data(args)
+    db = get_db()
+    try:
+        # 每家门店一张桌台开台后一直未结账
+        tables = db.query(Table).filter(Table.status == TableStatus.FREE).group_by(Table.store_id).all()
+        stale_ids = []
+        for table in tables:
+            session, _ = open_table(db, table.id)
+            session.start_time = datetime.utcnow() - timedelta(hours=args.stale_hours + 1)
+            stale_ids.append(session.id)
+        db.commit()
+    finally:
+        db.close()
+
+    business_date = (end - timedelta(days=1)).date()
+    expected = revenue_report(datetime.combine(business_date, datetime.min.time()), end)
+    runs = close_day(business_date, args.stale_hours, progress=lambda stage, seconds, detail: print(
+        f"  {stage:<24} {seconds:8.2f} 秒  {json.dumps(detail, ensure_ascii=False)[:120]}"))
+
+    db = get_db()
+    try:
+        revenue = db.query(func.sum(DailyStoreSummary.revenue)).filter(
+            DailyStoreSummary.business_date == business_date).scalar() or 0
+        stale_left = db.query(func.count(Session.id)).filter(
+            Session.id.in_(stale_ids), Session.status == SessionStatus.IN_PROGRESS).scalar()
+        occupied = db.query(func.count(Table.id)).filter(Table.status == TableStatus.OCCUPIED).scalar()
+    finally:
+        db.close()
+    details = {stage: detail for stage, _, detail in runs}
+    freed = sum(pages or 0 for pages in details["incremental_vacuum"].values())
+    print(f"日结 {business_date}：汇总营业额 {revenue:.2f}，财务报表 {expected['revenue'].sum():.2f}；"
+          f"遗留会话 {len(stale_ids)} 个，未关闭 {stale_left} 个，占用桌台 {occupied} 张；"
+          f"归档订单 {details['archive']['orders']} 行，回收空闲页 {freed} 页")
+    ok = (abs(revenue - expected["revenue"].sum()) < 0.01 and stale_left == 0 and occupied == 0
+          and details["archive"]["orders"] > 0 and freed > 0)
+    print("✅ 通过" if ok else "❌ 失败：汇总与财务报表不一致、遗留会话未关闭或归档后未回收空间")
+    return ok
+
+
+def bench_changes(args):
+    """变更订阅：收银台持续结账时，消费方经接口按游标循环拉取一家门店的订单，校验不重不漏，并与全表扫描对比耗时"""
+    from api_server import CHANGE_CONTENT_TYPES, make_server
+
+    generate_report_data(args)
+    moved = archive_all_stores()
+    tables, product_ids = free_tables_and_products(args)
+    if tables is None:
+        return False
+    # 收银台都在最后生成的门店，消费方订阅该门店
+    store_id = tables[-1][1]
+    tables = [table for table in tables if table[1] == store_id]
+    if len(tables) < args.workers:
+        print(f"❌ 门店 {store_id} 空闲桌台只有 {len(tables)} 张，少于收银台数 {args.workers}")
+        return False
+
+    server = make_server(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    stop = threading.Event()
+    received, polls = [], []
+
+    def consumer():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        cursor = 0
+        try:
+            while True:
+                # 收银结束后再拉一次，拿到最后提交的订单
+                done = stop.is_set()
+                started = time.perf_counter()
+                conn.request("GET", f"/api/stores/{store_id}/changes/orders?after={cursor}&limit={args.limit}")
+                response = conn.getresponse()
+                lines = response.read().decode("utf-8").splitlines()
+                polls.append((time.perf_counter() - started, len(lines)))
+                received.extend(json.loads(line)["id"] for line in lines)
+                cursor = int(response.getheader("X-Next-Cursor"))
+                if done and not lines:
+                    return
+                if not lines:
+                    time.sleep(0.05)
+        finally:
+            conn.close()
+
+    thread = threading.Thread(target=consumer)
+    thread.start()
+    run_cashiers(args, tables, product_ids)
+    stop.set()
+    thread.join()
+
+    # 对照：每次全量扫描该门店热表与归档表的全部订单
+    db = get_read_db()
+    try:
+        started = time.perf_counter()
+        expected = [row[0] for table in (Order.__table__, ARCHIVE_TABLES["orders"])
+                    for row in db.execute(table.select().where(table.c.store_id == store_id))]
+        full_scan = time.perf_counter() - started
+    finally:
+        db.close()
+    # 同一游标分别以 NDJSON 和 Parquet 拉取，Parquet 解码后的行应与 NDJSON 一致
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    conn.request("GET", f"/api/stores/{store_id}/changes/orders?after=0&limit={args.limit}")
+    response = conn.getresponse()
+    ndjson_ids = [json.loads(line)["id"] for line in response.read().decode("utf-8").splitlines()]
+    conn.request("GET", f"/api/stores/{store_id}/changes/orders?after=0&limit={args.limit}&format=parquet")
+    response = conn.getresponse()
+    body = response.read()
+    parquet = response.status, response.getheader("Content-Type"), len(body)
+    parquet_ids = pd.read_parquet(io.BytesIO(body))["id"].tolist() if parquet[0] == 200 else None
+    conn.close()
+    server.shutdown()
+    server.server_close()
+
+    incremental = sorted(seconds for seconds, rows in polls if rows < args.limit)
+    print(f"已归档订单 {moved['orders']} 行；门店 {store_id} 共 {len(expected)} 条订单，"
+          f"全量扫描 {full_scan * 1000:.1f} 毫秒")
+    print(f"  拉取 {len(polls)} 次，收到 {len(received)} 行（去重 {len(set(received))}），"
+          f"追平后每次拉取 p50 {percentile(incremental, 0.5):.1f} 毫秒，p99 {percentile(incremental, 0.99):.1f} 毫秒")
+    print(f"  Parquet：状态 {parquet[0]}，{parquet[1]}，{parquet[2]} 字节，"
+          f"{len(parquet_ids) if parquet_ids is not None else '-'} 行（NDJSON {len(ndjson_ids)} 行）")
+    ok = (sorted(received) == received and sorted(received) == sorted(expected) and moved["orders"] > 0)
+    parquet_ok = (parquet[0] == 200 and parquet[1] == CHANGE_CONTENT_TYPES["parquet"]
+                  and bool(ndjson_ids) and parquet_ids == ndjson_ids)
+    if not ok:
+        print("❌ 失败：收到的订单与库中不一致（重复、遗漏或乱序）")
+    elif not parquet_ok:
+        print("❌ 失败：Parquet 导出的状态、类型或行与 NDJSON 不一致")
+    else:
+        print("✅ 通过")
+    ok = ok and parquet_ok
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="连锁茶楼管理系统压测")
+    subparsers = parser.add_subparsers(dest="scenario", required=True)
+
+    p = subparsers.add_parser("balance", help="会员余额并发扣款")
+    p.add_argument("--topup", type=float, default=1000.0, help="初始充值金额")
+    p.add_argument("--amount", type=float, default=10.0, help="每次扣款金额")
+    p.add_argument("--requests", type=int, default=200, help="扣款次数")
+    p.add_argument("--workers", type=int, default=32, help="并发线程数")
+    p.set_defaults(func=bench_balance)
+
+    p = subparsers.add_parser("pricing", help="价格规则批量定价")
+    p.add_argument("--rules", type=int, default=500, help="价格规则数")
+    p.add_argument("--items", type=int, default=10000, help="定价行数")
+    p.add_argument("--verify", type=int, default=2000, help="与参考实现比对的抽样行数")
+    p.add_argument("--seed", type=int, default=42, help="随机种子")
+    p.set_defaults(func=bench_pricing)
+
+    p = subparsers.add_parser("checkout", help="开台、结账并发重复提交")
+    p.add_argument("--workers", type=int, default=16, help="并发线程数")
+    p.set_defaults(func=bench_checkout)
+
+    p = subparsers.add_parser("contention", help="同一桌台并发开台、点单、结账")
+    p.add_argument("--workers", type=int, default=8, help="并发终端数")
+    p.add_argument("--rounds", type=int, default=50, help="每个终端的操作次数")
+    p.set_defaults(func=bench_contention)
+
+    p = subparsers.add_parser("stock", help="多行批量入库与门店调拨")
+    p.add_argument("--lines", type=int, default=200, help="明细行数")
+    p.add_argument("--seed", type=int, default=42, help="随机种子")
+    p.set_defaults(func=bench_stock)
+
+    p = subparsers.add_parser("api", help="POS 接口吞吐量与延迟")
+    p.add_argument("--workers", type=int, default=8, help="并发终端数")
+    p.add_argument("--rounds", type=int, default=50, help="每个终端的开台-结账轮数")
+    p.add_argument("--items", type=int, default=3, help="每轮点单次数")
+    p.add_argument("--seed", type=int, default=42, help="随机种子")
+    p.add_argument("--sharded", action="store_true", help="门店经营数据按门店分库")
+    p.set_defaults(func=bench_api)
+
+    p = subparsers.add_parser("reports", help="连锁营业额、台位统计分区并行汇总")
+    p.add_argument("--stores", type=int, default=40, help="生成的门店数")
+    p.add_argument("--days", type=int, default=90, help="生成的天数")
+    p.add_argument("--orders-per-day", type=int, default=50, help="每家门店每天的订单数")
+    p.add_argument("--tables", type=int, default=10, help="每家门店的桌台数")
+    p.add_argument("--workers", type=int, default=8, help="并行线程数")
+    p.add_argument("--seed", type=int, default=42, help="随机种子")
+    p.add_argument("--sharded", action="store_true", help="门店经营数据按门店分库")
+    p.set_defaults(func=bench_reports)
+
+    p = subparsers.add_parser("analytics", help="只读连接跑大报表时的结账延迟")
+    p.add_argument("--stores", type=int, default=40, help="生成的门店数")
+    p.add_argument("--days", type=int, default=90, help="生成的天数")
+    p.add_argument("--orders-per-day", type=int, default=50, help="每家门店每天的订单数")
+    p.add_argument("--tables", type=int, default=10, help="每家门店的桌台数")
+    p.add_argument("--workers", type=int, default=4, help="并发收银台数")
+    p.add_argument("--rounds", type=int, default=30, help="每个收银台的结账轮数")
+    p.add_argument("--items", type=int, default=5, help="每单商品数")
+    p.add_argument("--max-p99-ms", type=float, default=2000, help="报表运行时结账 p99 延迟上限（毫秒）")
+    p.add_argument("--seed", type=int, default=42, help="随机种子")
+    p.set_defaults(func=bench_analytics)
+
+    p = subparsers.add_parser("backup", help="收银期间在线热备份的结账延迟与快照校验")
+    p.add_argument("--stores", type=int, default=20, help="生成的门店数")
+    p.add_argument("--days", type=int, default=90, help="生成的天数")
+    p.add_argument("--orders-per-day", type=int, default=50, help="每家门店每天的订单数")
+    p.add_argument("--tables", type=int, default=10, help="每家门店的桌台数")
+    p.add_argument("--workers", type=int, default=4, help="并发收银台数")
+    p.add_argument("--rounds", type=int, default=30, help="每个收银台的结账轮数")
+    p.add_argument("--items", type=int, default=5, help="每单商品数")
+    p.add_argument("--keep", type=int, default=3, help="保留的快照个数")
+    p.add_argument("--pages", type=int, default=256, help="每批复制的页数")
+    p.add_argument("--sleep", type=float, default=0.005, help="每批之间暂停的秒数")
+    p.add_argument("--max-p99-ms", type=float, default=2000, help="备份运行时结账 p99 延迟上限（毫秒）")
+    p.add_argument("--seed", type=int, default=42, help="随机种子")
+    p.set_defaults(func=bench_backup)
+
+    p = subparsers.add_parser("close-day", help="日结各阶段耗时")
+    p.add_argument("--stores", type=int, default=40, help="生成的门店数")
+    p.add_argument("--days", type=int, default=ARCHIVE_RETENTION_DAYS + 30, help="生成的天数（超过保留期的部分会被归档）")
+    p.add_argument("--orders-per-day", type=int, default=20, help="每家门店每天的订单数")
+    p.add_argument("--tables", type=int, default=10, help="每家门店的桌台数")
+    p.add_argument("--stale-hours", type=int, default=12, help="遗留会话判定小时数")
+    p.add_argument("--seed", type=int, default=42, help="随机种子")
+    p.set_defaults(func=bench_close_day)
+
+    p = subparsers.add_parser("changes", help="变更订阅按游标增量拉取")
+    p.add_argument("--stores", type=int, default=20, help="生成的门店数")
+    p.add_argument("--days", type=int, default=ARCHIVE_RETENTION_DAYS + 30, help="生成的天数（超过保留期的部分会被归档）")
+    p.add_argument("--orders-per-day", type=int, default=50, help="每家门店每天的订单数")
+    p.add_argument("--tables", type=int, default=10, help="每家门店的桌台数")
+    p.add_argument("--workers", type=int, default=4, help="并发收银台数")
+    p.add_argument("--rounds", type=int, default=30, help="每个收银台的结账轮数")
+    p.add_argument("--items", type=int, default=5, help="每单商品数")
+    p.add_argument("--limit", type=int, default=1000, help="每次拉取的行数")
+    p.add_argument("--seed", type=int, default=42, help="随机种子")
+    p.set_defaults(func=bench_changes)
+
+    p = subparsers.add_parser("report-jobs", help="后台报表任务与磁盘缓存")
+    p.add_argument("--stores", type=int, default=40, help="生成的门店数")
+    p.add_argument("--days", type=int, default=90, help="生成的天数")
+    p.add_argument("--orders-per-day", type=int, default=50, help="每家门店每天的订单数")
+    p.add_argument("--tables", type=int, default=10, help="每家门店的桌台数")
+    p.add_argument("--seed", type=int, default=42, help="随机种子")
+    p.add_argument("--sharded", action="store_true", help="门店经营数据按门店分库")
+    p.set_defaults(func=bench_report_jobs)
+
+    p = subparsers.add_parser("order-cache", help="订单列存缓存增量刷新与内存汇总")
+    p.add_argument("--stores", type=int, default=40, help="生成的门店数")
+    p.add_argument("--days", type=int, default=90, help="生成的天数")
+    p.add_argument("--orders-per-day", type=int, default=50, help="每家门店每天的订单数")
+    p.add_argument("--tables", type=int, default=10, help="每家门店的桌台数")
+    p.add_argument("--item-days", type=int, default=56, help="最近多少天的订单补上明细")
+    p.add_argument("--new-orders", type=int, default=200, help="增量刷新前新增的订单数")
+    p.add_argument("--rounds", type=int, default=5, help="每种汇总重复的次数")
+    p.add_argument("--seed", type=int, default=42, help="随机种子")
+    p.add_argument("--sharded", action="store_true", help="门店经营数据按门店分库")
+    p.set_defaults(func=bench_order_cache)
+
+    p = subparsers.add_parser("outbox", help="结账出库流水异步写入与重启补写")
+    p.add_argument("--workers", type=int, default=8, help="并发收银台数")
+    p.add_argument("--rounds", type=int, default=20, help="每个收银台的结账单数")
+    p.add_argument("--items", type=int, default=10, help="每单商品数")
+    p.set_defaults(func=bench_outbox)
+
+    args = parser.parse_args()
+    init_database()
+    ok = args.func(args)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,7 @@ sys.path.insert(0, os.path.dirname(__file__))
 from datetime import datetime, timedelta
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from app import (
+from tea_house import (
     Base, Store, StoreStatus, Employee, EmployeePosition,
     Member, MemberLevel, Product, Inventory, InventoryLog,
     InventoryLogType, Table, TableStatus, Session, SessionStatus,
@@ -324,4 +324,6 @@ def init_sample_data():
         db.close()
 
 if __name__ == "__main__":
+    # 导入 tea_house 不会建表，单独运行时先建表
+    Base.metadata.create_all(bind=engine)
     init_sample_data()
@@ -0,0 +1,219 @@
+"""运维命令行工具"""
+import sys
+import os
+import argparse
+import json
+
+# 添加项目路径
+sys.path.insert(0, os.path.dirname(__file__))
+
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+from tea_house import (
+    ARCHIVE_RETENTION_DAYS, BACKUP_DIR, BACKUP_KEEP, BACKUP_PAGES_PER_STEP, BACKUP_STEP_SLEEP, STALE_SESSION_HOURS,
+    CHANGE_BATCH_SIZE, CHANGE_FORMATS, CHANGE_STREAMS, archive_all_stores, backup_databases, close_day,
+    create_inventory_checkpoints, get_db, get_read_db, get_store_db, init_database, map_stores, read_changes,
+    reconcile_all_stores, generate_replenishment_suggestions, refresh_member_stats, store_db_factories,
+    sweep_reservations
+)
+
+
+def cmd_checkpoint(args):
+    """生成库存快照"""
+    count = sum(map_stores(lambda db, store_ids: create_inventory_checkpoints(db, store_ids=store_ids)))
+    print(f"✅ 已生成 {count} 条库存快照")
+
+
+def cmd_archive(args):
+    """归档历史数据"""
+    # 先打快照，历史库存查询无需回放已归档的流水
+    cmd_checkpoint(args)
+    cutoff = datetime.utcnow() - timedelta(days=args.days)
+    print(f"开始归档 {cutoff:%Y-%m-%d %H:%M:%S} 之前的历史数据（每批 {args.batch_size} 行）...")
+    moved = archive_all_stores(cutoff, args.batch_size)
+    for table_name, rows in moved.items():
+        print(f"  {table_name}: 迁移 {rows} 行")
+    print("✅ 归档完成")
+
+
+def cmd_reconcile(args):
+    """库存对账"""
+    db = get_db()
+    try:
+        started = datetime.utcnow()
+        result = reconcile_all_stores(db, args.store_id)
+        elapsed = (datetime.utcnow() - started).total_seconds()
+        issues = result[result["has_issue"]]
+        print(f"核对 {len(result)} 个门店商品，耗时 {elapsed:.2f} 秒，发现 {len(issues)} 处差异")
+        if not issues.empty:
+            print(issues.drop(columns=["has_issue"]).to_string(index=False))
+            sys.exit(1)
+    finally:
+        db.close()
+
+
+def cmd_forecast(args):
+    """生成补货建议"""
+    db = get_db()
+    try:
+        started = datetime.utcnow()
+        count = generate_replenishment_suggestions(db, history_days=args.history_days,
+                                                   horizon_days=args.horizon_days, method=args.method)
+        elapsed = (datetime.utcnow() - started).total_seconds()
+        print(f"✅ 已生成 {count} 条补货建议，耗时 {elapsed:.2f} 秒")
+    finally:
+        db.close()
+
+
+def cmd_member_stats(args):
+    """计算会员RFM统计"""
+    db = get_db()
+    try:
+        started = datetime.utcnow()
+        try:
+            count = refresh_member_stats(db, full=args.full)
+        except ValueError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        elapsed = (datetime.utcnow() - started).total_seconds()
+        print(f"✅ {'全量' if args.full else '增量'}更新 {count} 名会员，耗时 {elapsed:.2f} 秒")
+    finally:
+        db.close()
+
+
+def cmd_sweep_reservations(args):
+    """预约扫描"""
+    result = {"reserved": 0, "released": 0, "no_show": 0}
+    # 分库模式逐个门店库扫描
+    for session_factory in store_db_factories():
+        db = session_factory()
+        try:
+            for key, count in sweep_reservations(db).items():
+                result[key] += count
+        finally:
+            db.close()
+    print(f"✅ 锁定桌台 {result['reserved']} 张，释放桌台 {result['released']} 张，"
+          f"标记爽约 {result['no_show']} 条")
+
+
+def cmd_backup(args):
+    """在线备份"""
+    def report(name, stats):
+        if stats["linked"]:
+            print(f"  {name}: 未变化，沿用上一快照")
+        else:
+            rate = stats["bytes"] / 1024 / 1024 / stats["seconds"] if stats["seconds"] else 0
+            print(f"  {name}: {stats['bytes'] / 1024 / 1024:.1f} MB，{stats['seconds']:.2f} 秒（{rate:.1f} MB/s），"
+                  f"完整性检查 {stats['integrity']}")
+
+    print(f"开始备份到 {args.dir}（每批 {args.pages} 页，间隔 {args.sleep} 秒）...")
+    try:
+        manifest = backup_databases(args.dir, args.keep, args.pages, args.sleep, progress=report)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    print(f"✅ 备份完成：复制 {manifest['copied_bytes'] / 1024 / 1024:.1f} MB，沿用 {manifest['linked_files']} 个未变化文件，"
+          f"耗时 {manifest['seconds']:.2f} 秒，吞吐 {manifest['mb_per_second'] or 0:.1f} MB/s")
+
+
+def cmd_close_day(args):
+    """日结"""
+    business_date = datetime.strptime(args.date, "%Y-%m-%d").date() if args.date else None
+
+    def report(stage, seconds, detail):
+        print(f"  {stage:<24} {seconds:8.2f} 秒  {json.dumps(detail, ensure_ascii=False)}")
+
+    print(f"开始日结（营业日 {business_date or '昨天'}）...")
+    started = datetime.utcnow()
+    close_day(business_date, args.stale_hours, archive=not args.no_archive, full_vacuum=args.full_vacuum, progress=report)
+    elapsed = (datetime.utcnow() - started).total_seconds()
+    print(f"✅ 日结完成，总耗时 {elapsed:.2f} 秒")
+
+
+def cmd_changes(args):
+    """变更订阅"""
+    if args.format == "parquet" and not args.output:
+        print("❌ Parquet 格式须指定 --output", file=sys.stderr)
+        sys.exit(1)
+    try:
+        db = get_store_db(args.store_id, read_only=True) if args.store_id else get_read_db()
+        try:
+            frame = read_changes(db, args.stream, args.after, args.limit, args.store_id)
+            data = CHANGE_FORMATS[args.format](frame)
+        finally:
+            db.close()
+    except ValueError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(data)
+    else:
+        sys.stdout.buffer.write(data)
+    # 游标输出到标准错误，不混入数据；没有新行时游标不变
+    cursor = int(frame["id"].max()) if len(frame) else args.after
+    print(f"{len(frame)} 行，下次游标 --after {cursor}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="连锁茶楼管理系统运维工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("archive", help="将早于保留期限的订单、会话、库存流水迁移到归档库")
+    p.add_argument("--days", type=int, default=ARCHIVE_RETENTION_DAYS, help="热数据保留天数")
+    p.add_argument("--batch-size", type=int, default=1000, help="每批迁移的主表行数")
+    p.set_defaults(func=cmd_archive)
+
+    p = subparsers.add_parser("checkpoint", help="生成各门店商品的库存快照，加速历史库存查询")
+    p.set_defaults(func=cmd_checkpoint)
+
+    p = subparsers.add_parser("reconcile", help="核对库存与库存流水是否一致")
+    p.add_argument("--store-id", type=int, action="append", help="只核对指定门店（可重复）")
+    p.set_defaults(func=cmd_reconcile)
+
+    p = subparsers.add_parser("forecast", help="根据历史销量预测需求并生成补货建议")
+    p.add_argument("--history-days", type=int, default=56, help="参与预测的历史天数")
+    p.add_argument("--horizon-days", type=int, default=7, help="预测未来天数")
+    p.add_argument("--method", choices=["ses", "ma"], default="ses", help="ses: 季节性指数平滑；ma: 季节性移动平均")
+    p.set_defaults(func=cmd_forecast)
+
+    p = subparsers.add_parser("member-stats", help="计算会员消费RFM统计")
+    p.add_argument("--full", action="store_true", help="全量重算（默认只处理新订单涉及的会员）")
+    p.set_defaults(func=cmd_member_stats)
+
+    p = subparsers.add_parser("sweep-reservations", help="锁定即将到店预约的桌台，释放过期预约")
+    p.set_defaults(func=cmd_sweep_reservations)
+
+    p = subparsers.add_parser("backup", help="在线热备份全部库文件，未变化的文件沿用上一快照，并轮换旧快照")
+    p.add_argument("--dir", default=BACKUP_DIR, help="快照目录")
+    p.add_argument("--keep", type=int, default=BACKUP_KEEP, help="保留的快照个数")
+    p.add_argument("--pages", type=int, default=BACKUP_PAGES_PER_STEP, help="每批复制的页数")
+    p.add_argument("--sleep", type=float, default=BACKUP_STEP_SLEEP, help="每批之间暂停的秒数")
+    p.set_defaults(func=cmd_backup)
+
+    p = subparsers.add_parser("close-day", help="日结：关闭遗留会话、生成日结汇总、归档，并更新统计信息、回收空间")
+    p.add_argument("--date", help="营业日 YYYY-MM-DD（UTC，默认昨天）")
+    p.add_argument("--stale-hours", type=int, default=STALE_SESSION_HOURS, help="开台超过该小时数仍未结账的会话视为遗留会话")
+    p.add_argument("--no-archive", action="store_true", help="跳过历史数据归档")
+    p.add_argument("--full-vacuum", action="store_true", help="对尚未启用增量回收的库执行一次完整 VACUUM（写入会等待）")
+    p.set_defaults(func=cmd_close_day)
+
+    p = subparsers.add_parser("changes", help="按 id 游标导出订单、订单明细、库存流水的新增行（NDJSON / Parquet）")
+    p.add_argument("stream", choices=CHANGE_STREAMS, help="订阅的表")
+    p.add_argument("--after", type=int, default=0, help="游标：上一批最大 id，只导出 id 更大的行")
+    p.add_argument("--limit", type=int, default=CHANGE_BATCH_SIZE, help="每批行数")
+    p.add_argument("--store-id", type=int, help="只导出指定门店（分库模式必填）")
+    p.add_argument("--format", choices=list(CHANGE_FORMATS), default="ndjson", help="输出格式，parquet 需要安装 pyarrow")
+    p.add_argument("--output", help="输出文件，默认写到标准输出")
+    p.set_defaults(func=cmd_changes)
+
+    args = parser.parse_args()
+    # 初始化提示写到标准错误，标准输出只留命令结果（changes 命令可直接输出数据）
+    with redirect_stdout(sys.stderr):
+        init_database()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""后台报表任务
+
+报表在独立的进程池中计算，结果以 Parquet 缓存到磁盘，缓存键为 (报表类型, 参数, 数据水位)，
+数据未变化时直接读取缓存，多个页面会话请求同一报表只计算一次。
+
+tea_house 导入本模块创建任务管理器，因此这里不在顶层导入 tea_house；工作进程首次执行任务时再导入，
+数据库已由启动报表任务的进程初始化。
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+CACHE_MAX_FILES = 200  # 缓存目录最多保留的结果文件数，超出时删除最旧的
+FINISHED_JOBS_KEEP = 8  # 内存中保留的已完成任务数（结果尚未写入磁盘缓存时），超出时丢弃最久未读取的
+
+
+def parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def cache_key(kind, params, watermark):
+    """报表类型、参数、数据水位的摘要"""
+    raw = json.dumps([kind, params, watermark], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def _write_atomic(path, write):
+    """先写临时文件再替换，读取方不会看到写了一半的文件"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _prune_cache(cache_dir, keep=CACHE_MAX_FILES):
+    files = sorted((entry for entry in os.scandir(cache_dir) if entry.name.endswith(".parquet")),
+                   key=lambda entry: entry.stat().st_mtime)
+    for entry in files[:-keep]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def _warm_up():
+    """工作进程预先导入 tea_house，首个任务不必等待导入"""
+    import tea_house  # noqa: F401
+    return os.getpid()
+
+
+def run_report_job(kind, params, cache_dir, key):
+    """工作进程：计算报表，写入缓存并返回结果；进度写到 {key}.progress"""
+    from tea_house import REPORT_JOBS
+    progress_path = os.path.join(cache_dir, f"{key}.progress")
+
+    def write_progress(path, done, total):
+        with open(path, "w") as f:
+            json.dump([done, total], f)
+
+    def progress(done, total):
+        _write_atomic(progress_path, lambda path: write_progress(path, done, total))
+
+    try:
+        frame = REPORT_JOBS[kind][0](**params, progress=progress)
+        if parquet_available():
+            _write_atomic(os.path.join(cache_dir, f"{key}.parquet"),
+                          lambda path: frame.to_parquet(path, index=False))
+            _prune_cache(cache_dir)
+        return frame
+    finally:
+        try:
+            os.remove(progress_path)
+        except FileNotFoundError:
+            pass
+
+
+class ReportJobManager:
+    """提交、跟踪报表任务并读取缓存
+
+    同一缓存键的任务只提交一次。结果写入磁盘缓存后不再保留任务对象；缺少 pyarrow 时不写磁盘缓存，
+    结果只保存在任务对象中，最多保留 FINISHED_JOBS_KEEP 个已完成的任务。
+    """
+
+    def __init__(self, cache_dir, workers):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        # spawn：Streamlit 进程有多个线程，fork 出的子进程可能继承被占用的锁
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()  # 缓存键 -> Future，按最近读取排序
+        for _ in range(workers):
+            self._pool.submit(_warm_up)
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def _has_cache(self, key):
+        return parquet_available() and os.path.exists(self._cache_path(key))
+
+    def _prune_jobs(self):
+        """丢弃结果已写入磁盘缓存的任务，其余已完成的任务只保留最近读取的几个；调用方持有锁"""
+        finished = [key for key, job in self._jobs.items() if job.done()]
+        for key in finished:
+            if self._has_cache(key):
+                del self._jobs[key]
+        finished = [key for key, job in self._jobs.items() if job.done()]
+        for key in finished[:-FINISHED_JOBS_KEEP]:
+            del self._jobs[key]
+
+    def cached(self, key):
+        """读取缓存结果，没有缓存返回 None"""
+        if not self._has_cache(key):
+            return None
+        try:
+            return pd.read_parquet(self._cache_path(key))
+        except FileNotFoundError:
+            # 刚被清理
+            return None
+
+    def submit(self, kind, params, watermark):
+        """有缓存或同一任务正在计算时不重复提交，返回缓存键"""
+        key = cache_key(kind, params, watermark)
+        if self._has_cache(key):
+            return key
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or (job.done() and job.exception() is not None):
+                self._prune_jobs()
+                self._jobs[key] = self._pool.submit(run_report_job, kind, params, self.cache_dir, key)
+        return key
+
+    def status(self, key):
+        """返回 (状态, 已完成分区数, 分区总数)，状态为 done / running / failed / missing（未提交或已丢弃）"""
+        job = self._jobs.get(key)
+        if job is None:
+            return ("done", 1, 1) if self._has_cache(key) else ("missing", 0, 0)
+        if job.done():
+            return ("failed", 0, 0) if job.exception() is not None else ("done", 1, 1)
+        try:
+            with open(os.path.join(self.cache_dir, f"{key}.progress")) as f:
+                done, total = json.load(f)
+        except (FileNotFoundError, ValueError):
+            done, total = 0, 0
+        return "running", done, total
+
+    def result(self, key, timeout=None):
+        """等待任务完成并返回结果，任务失败时抛出原异常，任务不存在时抛出 KeyError"""
+        # 先取任务对象再读缓存：任务对象只在结果写入缓存后才会被丢弃
+        job = self._jobs.get(key)
+        frame = self.cached(key)
+        if frame is None:
+            if job is None:
+                raise KeyError(f"报表任务 {key} 不存在")
+            frame = job.result(timeout)
+        with self._lock:
+            if key in self._jobs:
+                self._jobs.move_to_end(key)
+            self._prune_jobs()
+        return frame
+
+    def wait(self, key, poll=0.2, on_progress=None):
+        """轮询直到任务结束，on_progress(已完成, 总数) 在每次轮询时调用，返回结果；任务不存在时抛出 KeyError"""
+        while True:
+            state, done, total = self.status(key)
+            if state != "running":
+                return self.result(key)
+            if on_progress:
+                on_progress(done, total)
+            time.sleep(poll)
+
+    def shutdown(self):
+        self._pool.shutdown(cancel_futures=True)
@@ -0,0 +1,3481 @@
+"""连锁茶楼管理系统：数据模型与业务服务
+
+不依赖 Streamlit，页面（app.py）、运维脚本、POS 接口、报表进程都从这里导入；导入时不初始化数据库，
+入口程序启动时调用 init_database()。进程内共享的对象（分库路由、价格引擎、后台线程等）用 functools.cache 保证每个进程只创建一次。
+"""
+import pandas as pd
+import numpy as np
+from datetime import datetime, date, timedelta
+from sqlalchemy import create_engine, inspect, event, select, insert, update, delete, func, case, literal, bindparam, union_all, except_, text, MetaData
+from sqlalchemy.orm import sessionmaker, declarative_base, Session as OrmSession
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, Text, Index, Enum as SQLEnum
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.schema import CreateTable
+import enum
+import functools
+import io
+import os
+import json
+import shutil
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+import uuid
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from report_jobs import ReportJobManager
+
+# 数据库配置
+# 获取本文件所在目录，确保数据库路径正确
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATABASE_PATH = os.environ.get("TEA_HOUSE_DB", os.path.join(BASE_DIR, 'tea_house.db'))
+DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
+# 归档库：超过保留天数的历史数据迁移到独立的SQLite文件，以 archive 库名挂载到每个连接
+ARCHIVE_DATABASE_PATH = os.environ.get("TEA_HOUSE_ARCHIVE_DB", os.path.join(BASE_DIR, 'tea_house_archive.db'))
+ARCHIVE_RETENTION_DAYS = int(os.environ.get("TEA_HOUSE_ARCHIVE_DAYS", "180"))
+# 分库模式：设置目录后每个门店的经营数据（桌台、会话、订单、库存等）存放在该目录下按门店编码命名的独立文件，
+# 主库只保存门店、商品、会员、价格规则等全局数据
+SHARD_DIR = os.environ.get("TEA_HOUSE_SHARD_DIR")
+# timeout：写锁被占用时最多等待30秒，避免并发写入直接报 database is locked
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30}, echo=False)
+
+@event.listens_for(engine, "connect")
+def attach_archive_database(dbapi_connection, connection_record):
+    """新连接使用WAL日志并挂载归档库"""
+    cursor = dbapi_connection.cursor()
+    # 新建的库启用增量回收，日结时归还删除数据留下的空闲页；已有的库需执行一次完整 VACUUM 才生效
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL：读不阻塞写，报表长查询期间结账照常提交
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DATABASE_PATH,))
+    cursor.execute("PRAGMA archive.auto_vacuum=INCREMENTAL")
+    cursor.close()
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def run_after_commit(db, func, *args):
+    """会话 db 的事务提交后执行 func(*args)，回滚或未提交就关闭则丢弃；进程内缓存只反映已提交的数据"""
+    db.info.setdefault("after_commit", []).append((func, args))
+
+@event.listens_for(OrmSession, "after_commit")
+def _run_after_commit_callbacks(session):
+    for func, args in session.info.pop("after_commit", []):
+        func(*args)
+
+@event.listens_for(OrmSession, "after_transaction_end")
+def _discard_after_commit_callbacks(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("after_commit", None)
+
+# 报表只读连接：大缓存、内存映射，适合大范围扫描；连接只读，误写会直接报错
+READ_CACHE_KIB = 65536  # 每个连接的页缓存（KiB）
+READ_MMAP_BYTES = 256 * 1024 * 1024  # 内存映射读取的上限
+
+def create_read_engine(path, attachments):
+    """以只读方式打开SQLite库，attachments 为 [(库名, 文件路径)]，被挂载的库同样只读"""
+    def uri(file_path):
+        return f"file:{quote(os.path.abspath(file_path))}?mode=ro"
+    
+    read_engine = create_engine(f"sqlite:///{uri(path)}&uri=true",
+                                connect_args={"check_same_thread": False, "timeout": 30}, echo=False)
+    
+    @event.listens_for(read_engine, "connect")
+    def configure_read_connection(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for alias, attach_path in attachments:
+            cursor.execute(f"ATTACH DATABASE ? AS {alias}", (uri(attach_path),))
+        cursor.execute("PRAGMA query_only = ON")
+        cursor.execute(f"PRAGMA cache_size = -{READ_CACHE_KIB}")
+        cursor.execute(f"PRAGMA mmap_size = {READ_MMAP_BYTES}")
+        cursor.execute("PRAGMA temp_store = MEMORY")
+        cursor.close()
+    
+    return read_engine
+
+# 主库建表后首次使用时才真正连接，此时主库和归档库文件都已存在
+read_engine = create_read_engine(DATABASE_PATH, [("archive", ARCHIVE_DATABASE_PATH)])
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+Base = declarative_base()
+
+# 枚举定义
+class StoreStatus(str, enum.Enum):
+    ACTIVE = "active"
+    INACTIVE = "inactive"
+
+class EmployeePosition(str, enum.Enum):
+    MANAGER = "manager"
+    STAFF = "staff"
+    CASHIER = "cashier"
+
+class MemberLevel(str, enum.Enum):
+    NORMAL = "normal"
+    SILVER = "silver"
+    GOLD = "gold"
+    DIAMOND = "diamond"
+
+class OrderStatus(str, enum.Enum):
+    PENDING = "pending"
+    PAID = "paid"
+    COMPLETED = "completed"
+    CANCELLED = "cancelled"
+
+class PaymentMethod(str, enum.Enum):
+    WECHAT = "wechat"
+    ALIPAY = "alipay"
+    CASH = "cash"
+    CARD = "card"
+    BALANCE = "balance"  # 会员余额
+
+class TableStatus(str, enum.Enum):
+    FREE = "free"
+    OCCUPIED = "occupied"
+    RESERVED = "reserved"
+    CLEANING = "cleaning"
+
+class SessionStatus(str, enum.Enum):
+    IN_PROGRESS = "in_progress"
+    PAID = "paid"
+    COMPLETED = "completed"
+    CANCELLED = "cancelled"
+
+# 数据模型
+class Store(Base):
+    __tablename__ = "stores"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(100), nullable=False)
+    code = Column(String(20), unique=True, nullable=False, index=True)
+    address = Column(String(200))
+    phone = Column(String(20))
+    status = Column(SQLEnum(StoreStatus), default=StoreStatus.ACTIVE)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class Employee(Base):
+    __tablename__ = "employees"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(50), nullable=False)
+    phone = Column(String(20), unique=True, nullable=False)
+    position = Column(SQLEnum(EmployeePosition), nullable=False)
+    store_id = Column(Integer, ForeignKey("stores.id"))
+
+class Member(Base):
+    __tablename__ = "members"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(50), nullable=False)
+    phone = Column(String(20), unique=True, nullable=False, index=True)
+    level = Column(SQLEnum(MemberLevel), default=MemberLevel.NORMAL)
+    balance = Column(Float, default=0.0)
+
+class Product(Base):
+    __tablename__ = "products"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(100), nullable=False)
+    code = Column(String(20), unique=True, nullable=False, index=True)
+    category = Column(String(50), nullable=False)
+    unit_price = Column(Float, nullable=False)
+    unit = Column(String(20), nullable=False)
+    reorder_threshold = Column(Integer, default=10, server_default="10", nullable=False)  # 补货阈值，库存低于该值预警
+
+class Inventory(Base):
+    __tablename__ = "inventory"
+    id = Column(Integer, primary_key=True, index=True)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    quantity = Column(Integer, default=0, nullable=False)
+
+class Table(Base):
+    __tablename__ = "tables"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(50), nullable=False)
+    code = Column(String(20), unique=True, nullable=False, index=True)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
+    capacity = Column(Integer, default=4)
+    status = Column(SQLEnum(TableStatus), default=TableStatus.FREE)
+    version = Column(Integer, nullable=False, default=1, server_default="1")  # 乐观锁版本号
+    __mapper_args__ = {"version_id_col": version}
+
+class Session(Base):
+    __tablename__ = "sessions"
+    id = Column(Integer, primary_key=True, index=True)
+    table_id = Column(Integer, ForeignKey("tables.id"), nullable=False)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
+    member_id = Column(Integer, ForeignKey("members.id"))
+    start_time = Column(DateTime, default=datetime.utcnow, nullable=False)
+    end_time = Column(DateTime)
+    status = Column(SQLEnum(SessionStatus), default=SessionStatus.IN_PROGRESS)
+    total_amount = Column(Float, default=0.0)
+    duration_minutes = Column(Integer, default=0)
+    version = Column(Integer, nullable=False, default=1, server_default="1")  # 乐观锁版本号
+    __mapper_args__ = {"version_id_col": version}
+    __table_args__ = (
+        Index("ix_sessions_store_start", "store_id", "start_time"),
+        # 会归档的表使用 AUTOINCREMENT：热表清空后新行的 id 也不会复用已归档的 id
+        {"sqlite_autoincrement": True},
+    )
+
+class SessionItem(Base):
+    __tablename__ = "session_items"
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    unit_price = Column(Float, nullable=False)
+    subtotal = Column(Float, nullable=False)
+    order_time = Column(DateTime, default=datetime.utcnow)
+
+class Order(Base):
+    __tablename__ = "orders"
+    id = Column(Integer, primary_key=True, index=True)
+    order_no = Column(String(50), unique=True, nullable=False, index=True)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
+    member_id = Column(Integer, ForeignKey("members.id"))
+    total_amount = Column(Float, default=0.0, nullable=False)
+    payment_method = Column(SQLEnum(PaymentMethod), nullable=False)
+    status = Column(SQLEnum(OrderStatus), default=OrderStatus.PAID)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_orders_store_created", "store_id", "created_at"),
+        {"sqlite_autoincrement": True},
+    )
+
+class OrderItem(Base):
+    __tablename__ = "order_items"
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = Column(Integer, primary_key=True, index=True)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    unit_price = Column(Float, nullable=False)
+    subtotal = Column(Float, nullable=False)
+
+class InventoryLogType(str, enum.Enum):
+    IN = "in"  # 入库
+    OUT = "out"  # 出库
+    ADJUST = "adjust"  # 调整
+    TRANSFER_IN = "transfer_in"  # 调入
+    TRANSFER_OUT = "transfer_out"  # 调出
+
+class InventoryLog(Base):
+    __tablename__ = "inventory_logs"
+    id = Column(Integer, primary_key=True, index=True)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    log_type = Column(SQLEnum(InventoryLogType), nullable=False)
+    quantity = Column(Integer, nullable=False)  # 变动数量（正数表示增加，负数表示减少）
+    before_quantity = Column(Integer, nullable=False)  # 变动前的库存量
+    after_quantity = Column(Integer, nullable=False)  # 变动后的库存量
+    remark = Column(String(500))  # 备注
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    __table_args__ = (
+        # 按门店、商品顺序遍历流水（对账、时点库存回放）
+        Index("ix_inventory_logs_store_product_id", "store_id", "product_id", "id"),
+        {"sqlite_autoincrement": True},
+    )
+
+class StockAlertStatus(str, enum.Enum):
+    OPEN = "open"
+    RESOLVED = "resolved"
+
+class StockAlert(Base):
+    __tablename__ = "stock_alerts"
+    id = Column(Integer, primary_key=True, index=True)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    threshold = Column(Integer, nullable=False)  # 触发时的补货阈值
+    quantity = Column(Integer, nullable=False)  # 触发时的库存量
+    status = Column(SQLEnum(StockAlertStatus), default=StockAlertStatus.OPEN, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    resolved_at = Column(DateTime)
+    __table_args__ = (
+        Index("ix_stock_alerts_status_store", "status", "store_id"),
+        Index("ix_stock_alerts_store_product_status", "store_id", "product_id", "status"),
+    )
+
+class ReplenishmentSuggestion(Base):
+    __tablename__ = "replenishment_suggestions"
+    id = Column(Integer, primary_key=True, index=True)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False, index=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    avg_daily_sales = Column(Float, nullable=False)  # 近期日均销量
+    forecast_quantity = Column(Float, nullable=False)  # 预测期内预计销量
+    safety_stock = Column(Float, nullable=False)  # 安全库存
+    on_hand = Column(Integer, nullable=False)  # 计算时的库存
+    suggested_quantity = Column(Integer, nullable=False)  # 建议补货量
+    generated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class MemberStats(Base):
+    __tablename__ = "member_stats"
+    member_id = Column(Integer, ForeignKey("members.id"), primary_key=True)
+    order_count = Column(Integer, default=0, nullable=False)  # 消费次数
+    total_spent = Column(Float, default=0.0, nullable=False)  # 累计消费
+    avg_ticket = Column(Float, default=0.0, nullable=False)  # 客单价
+    first_order_at = Column(DateTime)
+    last_order_at = Column(DateTime)
+    last_order_id = Column(Integer, default=0, nullable=False)  # 已统计的最大订单ID（增量水位）
+    recency_days = Column(Integer)  # 计算时距最近一次消费的天数
+    r_score = Column(Integer)  # 1-5分，越近越高
+    f_score = Column(Integer)  # 1-5分，越频繁越高
+    m_score = Column(Integer)  # 1-5分，消费越多越高
+    segment = Column(String(20))  # 会员分群
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class BalanceLogType(str, enum.Enum):
+    OPENING = "opening"  # 期初
+    TOPUP = "topup"  # 充值
+    SPEND = "spend"  # 消费
+    REFUND = "refund"  # 退款
+
+class MemberBalanceLog(Base):
+    __tablename__ = "member_balance_logs"
+    id = Column(Integer, primary_key=True, index=True)
+    member_id = Column(Integer, ForeignKey("members.id"), nullable=False, index=True)
+    log_type = Column(SQLEnum(BalanceLogType), nullable=False)
+    amount = Column(Float, nullable=False)  # 变动金额（正数增加，负数减少）
+    balance_after = Column(Float, nullable=False)  # 变动后余额
+    order_no = Column(String(50))  # 关联订单号
+    store_id = Column(Integer, ForeignKey("stores.id"))  # 余额支付的门店
+    remark = Column(String(500))
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class PricingRule(Base):
+    __tablename__ = "pricing_rules"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(100), nullable=False)
+    member_level = Column(SQLEnum(MemberLevel))  # 为空表示所有顾客（含散客）
+    store_id = Column(Integer, ForeignKey("stores.id"))  # 为空表示所有门店
+    category = Column(String(50))  # 为空表示所有分类
+    product_id = Column(Integer, ForeignKey("products.id"))  # 为空表示所有商品
+    discount_rate = Column(Float, nullable=False)  # 折扣率，0.9 即九折
+    priority = Column(Integer, default=0, server_default="0", nullable=False)  # 优先级，数值大者优先
+    start_at = Column(DateTime)  # 生效时间（本地时间），为空表示不限
+    end_at = Column(DateTime)  # 失效时间（本地时间），为空表示不限
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # 定价引擎据此发现规则修改
+
+class ReservationStatus(str, enum.Enum):
+    BOOKED = "booked"  # 已预约
+    SEATED = "seated"  # 已到店
+    CANCELLED = "cancelled"  # 已取消
+    NO_SHOW = "no_show"  # 未到店
+
+class Reservation(Base):
+    __tablename__ = "reservations"
+    id = Column(Integer, primary_key=True, index=True)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
+    table_id = Column(Integer, ForeignKey("tables.id"), nullable=False)
+    member_id = Column(Integer, ForeignKey("members.id"))
+    customer_name = Column(String(50), nullable=False)
+    phone = Column(String(20))
+    party_size = Column(Integer, default=1, nullable=False)
+    start_at = Column(DateTime, nullable=False)  # 预约开始时间（本地时间）
+    end_at = Column(DateTime, nullable=False)  # 预约结束时间（本地时间）
+    status = Column(SQLEnum(ReservationStatus), default=ReservationStatus.BOOKED, nullable=False)
+    locked_at = Column(DateTime)  # 预约扫描为该预约锁定桌台的时间，释放后清空
+    remark = Column(String(500))
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    __table_args__ = (
+        Index("ix_reservations_table_status_start", "table_id", "status", "start_at"),
+        Index("ix_reservations_store_start", "store_id", "start_at"),
+    )
+
+class IdempotentOperation(Base):
+    __tablename__ = "idempotent_operations"
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String(64), unique=True, nullable=False)  # 幂等键，进入确认步骤时生成
+    operation = Column(String(50), nullable=False)  # 操作类型
+    result_id = Column(Integer)  # 操作结果ID（订单ID/会话ID）
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class OutboxEvent(Base):
+    __tablename__ = "outbox_events"
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(50), nullable=False)  # 事件类型，对应 OUTBOX_HANDLERS
+    payload = Column(Text, nullable=False)  # JSON
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")  # 处理失败次数
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class ArchiveRun(Base):
+    __tablename__ = "archive_runs"
+    id = Column(Integer, primary_key=True, index=True)
+    table_name = Column(String(50), nullable=False, index=True)
+    cutoff = Column(DateTime, nullable=False)  # 本次归档的时间水位（早于该时间的数据已迁出）
+    rows_moved = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class InventoryCheckpoint(Base):
+    __tablename__ = "inventory_checkpoints"
+    id = Column(Integer, primary_key=True, index=True)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    quantity = Column(Integer, nullable=False)  # 截至 last_log_id 的台账库存量
+    last_log_id = Column(Integer, nullable=False)  # 快照包含的最后一条库存流水ID
+    checkpoint_at = Column(DateTime, nullable=False)  # 快照时间
+    __table_args__ = (
+        Index("ix_inventory_checkpoints_store_time", "store_id", "checkpoint_at"),
+    )
+
+class DailyStoreSummary(Base):
+    __tablename__ = "daily_store_summaries"
+    id = Column(Integer, primary_key=True, index=True)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
+    business_date = Column(Date, nullable=False)  # 营业日（UTC日期，与财务报表一致）
+    order_count = Column(Integer, default=0, nullable=False)
+    revenue = Column(Float, default=0.0, nullable=False)  # 营业额
+    balance_revenue = Column(Float, default=0.0, nullable=False)  # 其中会员余额支付
+    session_count = Column(Integer, default=0, nullable=False)  # 当天开台数
+    cancelled_sessions = Column(Integer, default=0, nullable=False)  # 当天开台后取消（含日结关闭）的会话数
+    unpaid_amount = Column(Float, default=0.0, nullable=False)  # 取消会话中未结账的消费金额
+    duration_minutes = Column(Integer, default=0, nullable=False)  # 已结账会话时长合计
+    closed_at = Column(DateTime, default=datetime.utcnow, nullable=False)  # 日结时间
+    __table_args__ = (
+        Index("ux_daily_store_summaries_store_date", "store_id", "business_date", unique=True),
+    )
+
+class DailyProductSales(Base):
+    __tablename__ = "daily_product_sales"
+    id = Column(Integer, primary_key=True, index=True)
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False)
+    business_date = Column(Date, nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    quantity = Column(Integer, default=0, nullable=False)
+    amount = Column(Float, default=0.0, nullable=False)
+    __table_args__ = (
+        Index("ux_daily_product_sales_store_date_product", "store_id", "business_date", "product_id", unique=True),
+    )
+
+class DayCloseRun(Base):
+    __tablename__ = "day_close_runs"
+    id = Column(Integer, primary_key=True, index=True)
+    business_date = Column(Date, nullable=False, index=True)
+    stage = Column(String(50), nullable=False)  # 日结阶段
+    seconds = Column(Float, nullable=False)  # 阶段耗时
+    detail = Column(Text)  # 阶段结果（JSON）
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+def get_db():
+    return SessionLocal()
+
+def get_read_db():
+    """报表页面的只读会话"""
+    return ReadSessionLocal()
+
+# ==================== 分库 ====================
+# 门店库中的表；其余表只在主库
+SHARD_TABLE_NAMES = [
+    "tables", "sessions", "session_items", "orders", "order_items", "inventory", "inventory_logs", "stock_alerts",
+    "inventory_checkpoints", "reservations", "idempotent_operations", "outbox_events", "daily_store_summaries",
+    "daily_product_sales",
+]
+# 主库数据迁入门店库的计划：(表, 明细表的 (外键字段, 主表))，主表按 store_id 划分，明细表随主表迁移
+SHARD_SPLIT_PLAN = [
+    ("tables", None), ("sessions", None), ("session_items", ("session_id", "sessions")),
+    ("orders", None), ("order_items", ("order_id", "orders")), ("inventory", None), ("inventory_logs", None),
+    ("stock_alerts", None), ("inventory_checkpoints", None), ("reservations", None),
+    ("daily_store_summaries", None), ("daily_product_sales", None),
+]
+SHARD_FANOUT_WORKERS = 8  # 跨门店查询的并发线程数
+
+class ShardRouter:
+    """分库路由：按门店ID找到门店库
+    
+    门店库连接以 catalog 库名挂载主库，门店库没有的表（商品、会员等）按表名直接访问主库，
+    业务函数无需区分单库与分库。门店库首次访问时创建并升级表结构。
+    """
+
+    def __init__(self, shard_dir):
+        self._dir = shard_dir
+        self._lock = threading.Lock()
+        self._shards = {}  # 门店ID -> (engine, sessionmaker, 只读sessionmaker)
+
+    def _open(self, store_id):
+        with engine.connect() as conn:
+            code = conn.execute(select(Store.code).where(Store.id == store_id)).scalar()
+        if code is None:
+            raise ValueError(f"门店 {store_id} 不存在")
+        path = os.path.join(self._dir, f"store_{code}.db")
+        archive_path = os.path.join(self._dir, f"store_{code}_archive.db")
+        shard_engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False, "timeout": 30},
+                                     echo=False)
+        
+        @event.listens_for(shard_engine, "connect")
+        def attach_databases(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("ATTACH DATABASE ? AS catalog", (DATABASE_PATH,))
+            cursor.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+            cursor.execute("PRAGMA archive.auto_vacuum=INCREMENTAL")
+            cursor.close()
+        
+        upgrade_schema(shard_engine, [Base.metadata.tables[name] for name in SHARD_TABLE_NAMES])
+        with shard_engine.begin() as conn:
+            ensure_archive_tables(conn)
+            ensure_archive_id_sequences(conn)
+        shard_read_engine = create_read_engine(path, [("catalog", DATABASE_PATH), ("archive", archive_path)])
+        return (shard_engine, sessionmaker(autocommit=False, autoflush=False, bind=shard_engine),
+                sessionmaker(autocommit=False, autoflush=False, bind=shard_read_engine))
+
+    def _shard(self, store_id):
+        with self._lock:
+            if store_id not in self._shards:
+                self._shards[store_id] = self._open(store_id)
+            return self._shards[store_id]
+
+    def engine(self, store_id):
+        return self._shard(store_id)[0]
+
+    def sessionmaker(self, store_id, read_only=False):
+        return self._shard(store_id)[2 if read_only else 1]
+
+@functools.cache
+def get_shard_router():
+    """进程内共享的分库路由"""
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    return ShardRouter(SHARD_DIR)
+
+def get_store_db(store_id, read_only=False):
+    """门店经营数据所在库的会话：分库模式为门店库，单库模式为主库；read_only 为报表用的只读会话"""
+    if SHARD_DIR:
+        return get_shard_router().sessionmaker(store_id, read_only)()
+    return ReadSessionLocal() if read_only else SessionLocal()
+
+def get_store_engine(store_id):
+    return get_shard_router().engine(store_id) if SHARD_DIR else engine
+
+def switch_store_db(db, store_id):
+    """页面选定门店后切换到门店库会话，单库模式原样返回"""
+    if not SHARD_DIR:
+        return db
+    db.close()
+    return get_store_db(store_id)
+
+def all_store_ids():
+    with engine.connect() as conn:
+        return conn.execute(select(Store.id).order_by(Store.id)).scalars().all()
+
+def store_db_factories():
+    """各门店库的会话工厂，单库模式只有主库"""
+    if not SHARD_DIR:
+        return [SessionLocal]
+    router = get_shard_router()
+    return [router.sessionmaker(store_id) for store_id in all_store_ids()]
+
+def map_stores(func, store_ids=None, read_only=False):
+    """跨门店执行 func(db, store_ids)，返回结果列表，store_ids 为空表示全部门店
+    
+    单库模式在主库执行一次；分库模式在线程池中并发查询各门店库，每个门店库传入 [门店ID]。
+    read_only 为 True 时使用只读会话。
+    """
+    if SHARD_DIR:
+        store_ids = store_ids or all_store_ids()
+    if not SHARD_DIR or not store_ids:
+        db = ReadSessionLocal() if read_only else SessionLocal()
+        try:
+            return [func(db, store_ids)]
+        finally:
+            db.close()
+    
+    def run(store_id):
+        db = get_store_db(store_id, read_only)
+        try:
+            return func(db, [store_id])
+        finally:
+            db.close()
+    
+    with ThreadPoolExecutor(max_workers=min(SHARD_FANOUT_WORKERS, len(store_ids))) as pool:
+        return list(pool.map(run, store_ids))
+
+def query_stores(func, store_ids=None):
+    """跨门店只读查询，func 返回 DataFrame，各门店结果按行合并"""
+    return pd.concat(map_stores(func, store_ids, read_only=True), ignore_index=True)
+
+def split_into_shards():
+    """把主库（含归档库）中的门店经营数据迁入各门店库并从主库删除，保留原ID，返回迁移行数
+    
+    先写入门店库再删除主库数据，中途失败重新执行时已迁移的行按主键忽略。
+    """
+    router = get_shard_router()
+    moved = 0
+    for store_id in all_store_ids():
+        with router.engine(store_id).connect() as conn:
+            conn.exec_driver_sql("ATTACH DATABASE ? AS catalog_archive", (ARCHIVE_DATABASE_PATH,))
+            conn.commit()
+            try:
+                with conn.begin():
+                    for name, parent in SHARD_SPLIT_PLAN:
+                        columns = ", ".join(c.name for c in Base.metadata.tables[name].columns)
+                        sources = [("main", "catalog")]
+                        if name in ARCHIVE_TABLE_NAMES:
+                            sources.append(("archive", "catalog_archive"))
+                        for target, source in sources:
+                            if parent is None:
+                                where = "store_id = ?"
+                            else:
+                                where = f"{parent[0]} IN (SELECT id FROM {source}.{parent[1]} WHERE store_id = ?)"
+                            moved += conn.exec_driver_sql(
+                                f"INSERT OR IGNORE INTO {target}.{name} ({columns}) "
+                                f"SELECT {columns} FROM {source}.{name} WHERE {where}", (store_id,)
+                            ).rowcount
+            finally:
+                conn.exec_driver_sql("DETACH DATABASE catalog_archive")
+                conn.commit()
+        with engine.begin() as conn:
+            for name, parent in reversed(SHARD_SPLIT_PLAN):
+                for schema in ("main", "archive") if name in ARCHIVE_TABLE_NAMES else ("main",):
+                    if parent is None:
+                        where = "store_id = ?"
+                    else:
+                        where = f"{parent[0]} IN (SELECT id FROM {schema}.{parent[1]} WHERE store_id = ?)"
+                    conn.exec_driver_sql(f"DELETE FROM {schema}.{name} WHERE {where}", (store_id,))
+    return moved
+
+# ==================== 历史数据归档 ====================
+# 归档计划：(主表, 时间字段, [(子表, 外键字段)])，子表随主表一起迁移
+ARCHIVE_PLAN = [
+    ("orders", "created_at", [("order_items", "order_id")]),
+    ("sessions", "start_time", [("session_items", "session_id")]),
+    ("inventory_logs", "created_at", []),
+]
+ARCHIVE_TABLE_NAMES = ["orders", "order_items", "sessions", "session_items", "inventory_logs"]
+
+# 归档表的Core映射（与热表同结构，位于 archive 库）
+archive_metadata = MetaData()
+ARCHIVE_TABLES = {
+    name: Base.metadata.tables[name].to_metadata(archive_metadata, schema="archive")
+    for name in ARCHIVE_TABLE_NAMES
+}
+
+def ensure_archive_tables(conn):
+    """在归档库中创建缺失的归档表，并补齐热表新增的字段"""
+    for name in ARCHIVE_TABLE_NAMES:
+        conn.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS archive.{name} AS SELECT * FROM main.{name} WHERE 0")
+        archive_columns = {row[1] for row in conn.exec_driver_sql(f"PRAGMA archive.table_info({name})")}
+        for column in Base.metadata.tables[name].columns:
+            if column.name not in archive_columns:
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.exec_driver_sql(f"ALTER TABLE archive.{name} ADD COLUMN {column.name} {column_type}")
+        conn.exec_driver_sql(f"CREATE UNIQUE INDEX IF NOT EXISTS archive.ux_{name}_id ON {name} (id)")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS archive.ix_inventory_logs_store_product_id ON inventory_logs (store_id, product_id, id)"
+    )
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS archive.ix_orders_store_created ON orders (store_id, created_at)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS archive.ix_sessions_store_start ON sessions (store_id, start_time)")
+    for name, time_column, children in ARCHIVE_PLAN:
+        conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS archive.ix_{name}_{time_column} ON {name} ({time_column})")
+        for child_name, foreign_key in children:
+            conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS archive.ix_{child_name}_{foreign_key} ON {child_name} ({foreign_key})")
+
+def ensure_archive_id_sequences(conn):
+    """会归档的热表改为 AUTOINCREMENT，并把自增序列推进到热表与归档表的最大 id，新行不复用已归档的 id
+    
+    SQLite 不能修改已有表的主键定义，旧库的表按新定义重建后拷回数据。
+    """
+    for name in ARCHIVE_TABLE_NAMES:
+        table = Base.metadata.tables[name]
+        create_sql = conn.exec_driver_sql(
+            "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (name,)
+        ).scalar()
+        if create_sql is None:
+            continue
+        if "AUTOINCREMENT" not in create_sql.upper():
+            columns = ", ".join(c.name for c in table.columns)
+            ddl = str(CreateTable(table).compile(dialect=conn.dialect))
+            # 上次重建中途退出留下的新表
+            conn.exec_driver_sql(f"DROP TABLE IF EXISTS main.{name}_rebuild")
+            conn.exec_driver_sql(ddl.replace(f"CREATE TABLE {name} (", f"CREATE TABLE main.{name}_rebuild (", 1))
+            conn.exec_driver_sql(f"INSERT INTO main.{name}_rebuild ({columns}) SELECT {columns} FROM main.{name}")
+            conn.exec_driver_sql(f"DROP TABLE main.{name}")
+            conn.exec_driver_sql(f"ALTER TABLE main.{name}_rebuild RENAME TO {name}")
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+        max_id = conn.exec_driver_sql(
+            f"SELECT max(coalesce((SELECT max(id) FROM main.{name}), 0), coalesce((SELECT max(id) FROM archive.{name}), 0))"
+        ).scalar()
+        sequence = conn.exec_driver_sql("SELECT seq FROM main.sqlite_sequence WHERE name = ?", (name,)).scalar()
+        if sequence is None:
+            conn.exec_driver_sql("INSERT INTO main.sqlite_sequence (name, seq) VALUES (?, ?)", (name, max_id))
+        elif sequence < max_id:
+            conn.exec_driver_sql("UPDATE main.sqlite_sequence SET seq = ? WHERE name = ?", (max_id, name))
+
+def _copy_rows(conn, name, key_column, ids):
+    """把指定行从热表复制到归档表，返回行数
+    
+    归档库中已有与热表完全相同的副本（上次两步之间崩溃留下）时跳过；同一 id 的归档行与热表不同
+    （id 被复用）时抛出 RuntimeError，不覆盖已归档的历史数据。
+    """
+    hot = Base.metadata.tables[name]
+    cold = ARCHIVE_TABLES[name]
+    columns = [c.name for c in hot.columns]
+    hot_rows = select(*[hot.c[c] for c in columns]).where(hot.c[key_column].in_(ids))
+    hot_ids = select(hot.c.id).where(hot.c[key_column].in_(ids))
+    expected = conn.execute(select(func.count()).select_from(hot_rows.subquery())).scalar()
+    conflicts = conn.execute(select(func.count()).select_from(except_(
+        select(*[cold.c[c] for c in columns]).where(cold.c.id.in_(hot_ids)), hot_rows
+    ).subquery())).scalar()
+    if conflicts:
+        raise RuntimeError(f"归档校验失败: {name} 有 {conflicts} 行与归档库中同一 id 的历史数据不同，已停止归档，未覆盖归档数据")
+    conn.execute(insert(cold).prefix_with("OR IGNORE").from_select(columns, hot_rows))
+    archived = conn.execute(select(func.count()).select_from(cold).where(cold.c.id.in_(hot_ids))).scalar()
+    if archived != expected:
+        raise RuntimeError(f"归档校验失败: {name} 应迁移 {expected} 行，归档库现有 {archived} 行")
+    return expected
+
+def _delete_rows(conn, name, key_column, ids, expected):
+    """删除已复制到归档表的热表行，删除前再次确认归档副本齐全"""
+    hot = Base.metadata.tables[name]
+    cold = ARCHIVE_TABLES[name]
+    archived = conn.execute(select(func.count()).select_from(cold).where(cold.c[key_column].in_(ids))).scalar()
+    if archived != expected:
+        raise RuntimeError(f"归档校验失败: {name} 删除前归档库应有 {expected} 行，实际 {archived} 行")
+    removed = conn.execute(delete(hot).where(hot.c[key_column].in_(ids))).rowcount
+    if removed != expected:
+        raise RuntimeError(f"归档校验失败: {name} 应删除 {expected} 行，实际删除 {removed} 行")
+    return removed
+
+def archive_history(cutoff=None, batch_size=1000, bind=None):
+    """将早于保留期限的订单、会话和库存流水分批迁移到归档库，返回各表迁移行数
+    
+    bind 为门店库引擎时迁移到该门店的归档库，默认主库。
+    """
+    bind = bind or engine
+    cutoff = cutoff or datetime.utcnow() - timedelta(days=ARCHIVE_RETENTION_DAYS)
+    moved = {name: 0 for name in ARCHIVE_TABLE_NAMES}
+    with bind.begin() as conn:
+        ensure_archive_tables(conn)
+    for name, time_column, children in ARCHIVE_PLAN:
+        hot = Base.metadata.tables[name]
+        condition = hot.c[time_column] < cutoff
+        if name == "sessions":
+            # 进行中的会话不归档
+            condition = condition & (hot.c.status != SessionStatus.IN_PROGRESS)
+        while True:
+            # 主库为WAL模式时SQLite不使用主日志（super-journal），跨主库与归档库的事务不是原子的：
+            # 先提交主库再提交归档库，两次提交之间崩溃会删掉热表行而丢失归档副本。
+            # 因此每批先在一个事务中复制并校验，提交后再在第二个事务中删除热表行；
+            # 两步之间崩溃只会留下两边都有的相同行，重新归档时跳过归档库中已有的副本
+            with bind.begin() as conn:
+                ids = conn.execute(select(hot.c.id).where(condition).order_by(hot.c.id).limit(batch_size)).scalars().all()
+                if not ids:
+                    break
+                copied = [(child_name, foreign_key, _copy_rows(conn, child_name, foreign_key, ids))
+                          for child_name, foreign_key in children]
+                copied.append((name, "id", _copy_rows(conn, name, "id", ids)))
+            with bind.begin() as conn:
+                for table_name, key_column, expected in copied:
+                    moved[table_name] += _delete_rows(conn, table_name, key_column, ids, expected)
+        with bind.begin() as conn:
+            conn.execute(insert(ArchiveRun.__table__).values(
+                table_name=name, cutoff=cutoff, rows_moved=moved[name], created_at=datetime.utcnow()
+            ))
+    return moved
+
+def get_archive_watermark(db, table_name):
+    """获取某张表的归档水位，未归档过返回None"""
+    return db.query(func.max(ArchiveRun.cutoff)).filter(
+        ArchiveRun.table_name == table_name, ArchiveRun.rows_moved > 0
+    ).scalar()
+
+def history_source(db, table, start=None):
+    """历史查询数据源：查询区间早于归档水位时，合并热表与归档表（UNION ALL），否则只读热表"""
+    watermark = get_archive_watermark(db, table.name)
+    if watermark is None or (start is not None and start >= watermark):
+        return table
+    return union_all(select(table), select(ARCHIVE_TABLES[table.name])).subquery(table.name)
+
+# ==================== 在线备份 ====================
+BACKUP_DIR = os.environ.get("TEA_HOUSE_BACKUP_DIR", os.path.join(BASE_DIR, "backups"))
+BACKUP_KEEP = int(os.environ.get("TEA_HOUSE_BACKUP_KEEP", "7"))  # 保留的快照个数
+BACKUP_PAGES_PER_STEP = 256  # 每批复制的页数
+BACKUP_STEP_SLEEP = 0.005  # 每批之间让出的秒数
+
+def backup_sources():
+    """需要备份的库文件：[(快照内文件名, 源路径)]，分库模式包括目录下的全部门店库及其归档库
+    
+    每个库排在其归档库之前（store_{编码}.db 按文件名排在 store_{编码}_archive.db 之前）。
+    """
+    sources = [(os.path.basename(DATABASE_PATH), DATABASE_PATH),
+               (os.path.basename(ARCHIVE_DATABASE_PATH), ARCHIVE_DATABASE_PATH)]
+    if SHARD_DIR and os.path.isdir(SHARD_DIR):
+        sources += [(os.path.join("shards", name), os.path.join(SHARD_DIR, name))
+                    for name in sorted(os.listdir(SHARD_DIR)) if name.endswith(".db")]
+    return sources
+
+def _file_signature(path):
+    """库文件及其WAL文件的修改时间和大小，两次相同视为内容未变"""
+    signature = []
+    for file_path in (path, path + "-wal"):
+        try:
+            stat = os.stat(file_path)
+            signature += [stat.st_mtime_ns, stat.st_size]
+        except FileNotFoundError:
+            signature += [None, None]
+    return signature
+
+def _snapshot_groups(sources):
+    """同一读事务中复制的库文件分组：挂载数不超过SQLite上限时全部一组，否则每个库与其归档库一组"""
+    probe = sqlite3.connect(":memory:")
+    limit = probe.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    probe.close()
+    if len(sources) <= limit + 1:
+        return [sources]
+    groups = defaultdict(list)
+    for name, path in sources:
+        # 主库与其归档库为一组；门店库按去掉 _archive 后的文件名分组
+        key = name.replace("_archive.db", ".db") if name.startswith("shards") else None
+        groups[key].append((name, path))
+    return list(groups.values())
+
+def _open_snapshot(sources):
+    """只读打开 sources 中的库文件（第一个为主连接，其余挂载为 s1、s2…），开启读事务并按顺序读取各库，返回 (连接, 库名列表)
+    
+    WAL模式下各库的读快照在事务中首次读取时建立，之后其他连接的写入对本连接不可见，
+    各文件复制的是同一事务内的数据。归档先提交复制、再提交删除，热库先于归档库建立快照，
+    快照中热表已删除的行一定已在归档库中，最多两边都有（与归档两步之间崩溃相同，重新归档时跳过）。
+    """
+    def uri(path):
+        return f"file:{quote(os.path.abspath(path))}?mode=ro"
+    
+    source = sqlite3.connect(uri(sources[0][1]), uri=True, timeout=30, isolation_level=None)
+    try:
+        schemas = ["main"]
+        for i, (_, path) in enumerate(sources[1:], 1):
+            source.execute(f"ATTACH DATABASE ? AS s{i}", (uri(path),))
+            schemas.append(f"s{i}")
+        source.execute("BEGIN")
+        for schema in schemas:
+            source.execute(f"SELECT COUNT(*) FROM {schema}.sqlite_master").fetchone()
+    except BaseException:
+        source.close()
+        raise
+    return source, schemas
+
+def backup_schema(source, schema, target_path, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP):
+    """用SQLite备份接口把 source 连接中的 schema 库复制到 target_path 并做完整性检查，返回统计信息
+    
+    source 持有读事务，复制的是事务开始时的快照，期间的写入不会打断复制，也不被写入阻塞；
+    每复制 pages 页暂停 sleep 秒，减少对结账的磁盘争用。
+    """
+    started = time.perf_counter()
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target, pages=pages, sleep=sleep, name=schema)
+        page_count = target.execute("PRAGMA page_count").fetchone()[0]
+        page_size = target.execute("PRAGMA page_size").fetchone()[0]
+        # 快照不需要WAL，转为单文件便于拷贝和恢复
+        target.execute("PRAGMA journal_mode=DELETE")
+        integrity = "; ".join(row[0] for row in target.execute("PRAGMA integrity_check"))
+    finally:
+        target.close()
+    seconds = time.perf_counter() - started
+    return {"pages": page_count, "bytes": page_count * page_size, "seconds": round(seconds, 3),
+            "integrity": integrity}
+
+def list_backups(backup_dir=None):
+    """已完成的快照目录（按时间从旧到新）及其清单"""
+    backup_dir = backup_dir or BACKUP_DIR
+    if not os.path.isdir(backup_dir):
+        return []
+    backups = []
+    for name in sorted(os.listdir(backup_dir)):
+        manifest_path = os.path.join(backup_dir, name, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                backups.append((os.path.join(backup_dir, name), json.load(f)))
+    return backups
+
+def backup_databases(backup_dir=None, keep=None, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP, progress=None):
+    """在线备份全部库文件到 backup_dir 下按时间命名的快照目录，返回清单
+    
+    全部库文件在同一个读事务中复制（超出SQLite挂载上限时每个库与其归档库同一事务），见 _open_snapshot。
+    增量：与上一个快照相比未变化的库文件直接硬链接，不再复制；新复制的文件逐个做完整性检查，
+    任一文件检查不通过则丢弃本次快照并抛出 RuntimeError。完成后只保留最近 keep 个快照。
+    progress(文件名, 统计信息) 在每个文件完成后调用。
+    """
+    backup_dir = backup_dir or BACKUP_DIR
+    keep = keep or BACKUP_KEEP
+    os.makedirs(backup_dir, exist_ok=True)
+    previous = list_backups(backup_dir)
+    previous_dir, previous_manifest = previous[-1] if previous else (None, {"files": {}})
+    
+    created_at = datetime.utcnow()
+    snapshot_dir = os.path.join(backup_dir, created_at.strftime("%Y%m%d-%H%M%S-%f"))
+    partial_dir = snapshot_dir + ".partial"
+    os.makedirs(partial_dir)
+    started = time.perf_counter()
+    files = {}
+    try:
+        sources = [(name, path) for name, path in backup_sources() if os.path.exists(path)]
+        for group in _snapshot_groups(sources):
+            # 清单记录快照建立之前的签名：建立之后才取的话，中间的写入会被记进签名却不在副本中，
+            # 下次签名相同时会沿用缺少这些写入的副本
+            signatures = {name: _file_signature(path) for name, path in group}
+            source, schemas = _open_snapshot(group)
+            try:
+                for (name, source_path), schema in zip(group, schemas):
+                    target_path = os.path.join(partial_dir, name)
+                    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                    last = previous_manifest["files"].get(name)
+                    # 快照建立后签名仍与上一快照相同，说明上一快照之后没有写入，快照内容与上一副本一致
+                    if last and last["signature"] == _file_signature(source_path) and last["integrity"] == "ok":
+                        try:
+                            os.link(os.path.join(previous_dir, name), target_path)
+                        except OSError:
+                            # 文件系统不支持硬链接时退回复制
+                            shutil.copy2(os.path.join(previous_dir, name), target_path)
+                        stats = dict(last, linked=True, seconds=0.0)
+                    else:
+                        stats = backup_schema(source, schema, target_path, pages, sleep)
+                        if stats["integrity"] != "ok":
+                            raise RuntimeError(f"备份校验失败: {name} integrity_check 返回 {stats['integrity']}")
+                        stats.update(signature=signatures[name], linked=False)
+                    files[name] = stats
+                    if progress:
+                        progress(name, stats)
+            finally:
+                source.close()
+    except BaseException:
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        raise
+    
+    seconds = time.perf_counter() - started
+    copied = sum(s["bytes"] for s in files.values() if not s["linked"])
+    manifest = {
+        "created_at": created_at.isoformat(), "files": files, "seconds": round(seconds, 3),
+        "copied_bytes": copied, "linked_files": sum(1 for s in files.values() if s["linked"]),
+        "mb_per_second": round(copied / 1024 / 1024 / seconds, 2) if seconds else None,
+    }
+    with open(os.path.join(partial_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.rename(partial_dir, snapshot_dir)
+    
+    for old_dir, _ in list_backups(backup_dir)[:-keep]:
+        shutil.rmtree(old_dir)
+    return manifest
+
+# ==================== 库存时点查询 ====================
+def _replay_inventory_logs(base, logs):
+    """在快照库存基础上按流水顺序累加变动量，返回 product_id -> 库存量"""
+    quantities = base.copy()
+    if not logs.empty:
+        logs = logs.sort_values("id")
+        logs["running"] = logs.groupby("product_id")["quantity"].cumsum()
+        tail = logs.groupby("product_id")["running"].last()
+        quantities = quantities.add(tail, fill_value=0)
+    return quantities.astype(int)
+
+def inventory_as_of(db, store_id, ts, until_log_id=None):
+    """查询门店在某一时刻的台账库存：取最近一次不晚于该时刻的快照，只回放其后的流水"""
+    checkpoint_at = db.query(func.max(InventoryCheckpoint.checkpoint_at)).filter(
+        InventoryCheckpoint.store_id == store_id,
+        InventoryCheckpoint.checkpoint_at <= ts
+    ).scalar()
+    if checkpoint_at is not None:
+        checkpoints = db.query(InventoryCheckpoint.product_id, InventoryCheckpoint.quantity, InventoryCheckpoint.last_log_id).filter(
+            InventoryCheckpoint.store_id == store_id,
+            InventoryCheckpoint.checkpoint_at == checkpoint_at
+        ).all()
+        base = pd.Series({c.product_id: c.quantity for c in checkpoints}, dtype="int64")
+        last_log_id = max(c.last_log_id for c in checkpoints)
+    else:
+        base = pd.Series(dtype="int64")
+        last_log_id = 0
+    
+    logs_src = history_source(db, InventoryLog.__table__, checkpoint_at)
+    query = select(logs_src.c.id, logs_src.c.product_id, logs_src.c.quantity).where(
+        logs_src.c.store_id == store_id,
+        logs_src.c.id > last_log_id,
+        logs_src.c.created_at <= ts
+    )
+    if until_log_id is not None:
+        query = query.where(logs_src.c.id <= until_log_id)
+    rows = db.execute(query).all()
+    logs = pd.DataFrame(rows, columns=["id", "product_id", "quantity"])
+    quantities = _replay_inventory_logs(base, logs)
+    return quantities.rename_axis("product_id").reset_index(name="quantity")
+
+def create_inventory_checkpoints(db, at=None, store_ids=None):
+    """为门店商品生成库存快照（上一次快照 + 之后的流水），store_ids 为空表示全部门店，返回快照行数"""
+    at = at or datetime.utcnow()
+    last_log_id = db.query(func.max(InventoryLog.id)).scalar() or 0
+    store_ids = store_ids or [s.id for s in db.query(Store.id).all()]
+    
+    rows = []
+    for store_id in store_ids:
+        quantities = inventory_as_of(db, store_id, at, until_log_id=last_log_id)
+        rows.extend({
+            "store_id": store_id,
+            "product_id": int(r.product_id),
+            "quantity": int(r.quantity),
+            "last_log_id": last_log_id,
+            "checkpoint_at": at
+        } for r in quantities.itertuples(index=False))
+    if rows:
+        db.execute(insert(InventoryCheckpoint), rows)
+    db.commit()
+    return len(rows)
+
+# ==================== 价格规则 ====================
+PRICING_RULE_CHECK_SECONDS = 2  # 检查规则是否被其他进程修改的间隔，修改最多延迟这么久生效
+
+def _pricing_rules_stamp(conn):
+    """规则表的变更标记：行数、最大ID、最近修改时间，增删改任一规则都会改变"""
+    return tuple(conn.execute(select(func.count(), func.max(PricingRule.id), func.max(PricingRule.updated_at))).one())
+
+class PricingEngine:
+    """会员价与促销价计算：价格规则预编译为字典，定价时按固定次数查表
+    
+    编译结果只包含当前生效的规则，并记录下一次有规则生效或失效的时间，届时自动重新编译。
+    页面、接口服务、运维脚本各自持有引擎，每隔 PRICING_RULE_CHECK_SECONDS 秒比对一次规则表的变更标记，
+    其他进程修改规则后自动重新编译；本进程修改规则后调用 invalidate() 立即生效。
+    """
+    # 规则匹配越具体越优先：指定商品 > 指定分类 > 全部商品，其次指定门店、指定会员等级
+    TARGET_SPECIFICITY = {"product": 2, "category": 1, None: 0}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rules = None
+        self._compiled_at = None
+        self._valid_until = None
+        self._stamp = None
+        self._checked_at = 0.0
+
+    def invalidate(self):
+        """规则变更后清空编译结果，下次定价时重新编译"""
+        with self._lock:
+            self._rules = None
+
+    def _compile(self, now):
+        with engine.connect() as conn:
+            stamp = _pricing_rules_stamp(conn)
+            rules = conn.execute(select(
+                PricingRule.id, PricingRule.member_level, PricingRule.store_id, PricingRule.category,
+                PricingRule.product_id, PricingRule.discount_rate, PricingRule.priority,
+                PricingRule.start_at, PricingRule.end_at
+            )).all()
+        compiled = {}
+        valid_until = datetime.max
+        for rule in rules:
+            # 记录下一个生效/失效边界，过了边界编译结果即作废
+            for boundary in (rule.start_at, rule.end_at):
+                if boundary is not None and boundary > now:
+                    valid_until = min(valid_until, boundary)
+            if (rule.start_at is not None and rule.start_at > now) or (rule.end_at is not None and rule.end_at <= now):
+                continue
+            if rule.product_id is not None:
+                target = ("product", rule.product_id)
+            elif rule.category:
+                target = ("category", rule.category)
+            else:
+                target = None
+            key = (rule.member_level, rule.store_id, target)
+            specificity = (self.TARGET_SPECIFICITY[target[0] if target else None],
+                           rule.store_id is not None, rule.member_level is not None)
+            # 同一键只保留最优规则：优先级高者优先，同优先级取折扣最大者
+            rank = (rule.priority, specificity, -rule.discount_rate)
+            if key not in compiled or rank > compiled[key][0]:
+                compiled[key] = (rank, rule.discount_rate, rule.id)
+        return compiled, valid_until, stamp
+
+    def _current(self, now):
+        """编译结果仍可用：未作废、仍在有效期内、距上次比对变更标记不足检查间隔"""
+        return self._rules is not None and self._compiled_at <= now < self._valid_until and \
+            time.monotonic() - self._checked_at < PRICING_RULE_CHECK_SECONDS
+
+    def _compiled(self, now):
+        rules = self._rules
+        if not self._current(now):
+            with self._lock:
+                if not self._current(now):
+                    stale = self._rules is None or not self._compiled_at <= now < self._valid_until
+                    if not stale:
+                        with engine.connect() as conn:
+                            stale = _pricing_rules_stamp(conn) != self._stamp
+                    if stale:
+                        self._rules, self._valid_until, self._stamp = self._compile(now)
+                        self._compiled_at = now
+                    self._checked_at = time.monotonic()
+                rules = self._rules
+        return rules
+
+    def lookup(self, product_id, category, store_id=None, member_level=None, now=None):
+        """返回 (折扣率, 规则ID)，无匹配规则时为 (1.0, None)"""
+        rules = self._compiled(now or datetime.now())
+        if not rules:
+            return 1.0, None
+        best = None
+        for level in ((member_level, None) if member_level is not None else (None,)):
+            for store in ((store_id, None) if store_id is not None else (None,)):
+                for target in (("product", product_id), ("category", category), None):
+                    hit = rules.get((level, store, target))
+                    if hit is not None and (best is None or hit[0] > best[0]):
+                        best = hit
+        return (best[1], best[2]) if best else (1.0, None)
+
+    def price(self, unit_price, product_id, category, store_id=None, member_level=None, now=None):
+        """计算成交单价"""
+        rate, _ = self.lookup(product_id, category, store_id, member_level, now)
+        return round(unit_price * rate, 2)
+
+@functools.cache
+def get_pricing_engine():
+    """进程内共享的定价引擎"""
+    return PricingEngine()
+
+# ==================== 预约 ====================
+RESERVATION_LEAD_MINUTES = 30  # 预约开始前多久锁定桌台
+RESERVATION_GRACE_MINUTES = 30  # 超过预约开始时间多久未到店记为爽约
+RESERVATION_SWEEP_SECONDS = int(os.environ.get("TEA_HOUSE_RESERVATION_SWEEP_SECONDS", "60"))
+ACTIVE_RESERVATION_STATUSES = (ReservationStatus.BOOKED, ReservationStatus.SEATED)
+
+class ReservationConflictError(ValueError):
+    """预约时间冲突或桌台不可用"""
+
+def create_reservation(db, table_id, start_at, end_at, customer_name, phone=None, party_size=1,
+                       member_id=None, remark=None):
+    """创建预约，返回预约ID；不在此提交事务
+    
+    冲突检查与写入在同一条 INSERT ... SELECT ... WHERE NOT EXISTS 中完成，并发预约同一时段只有一条成功。
+    """
+    if end_at <= start_at:
+        raise ValueError("结束时间必须晚于开始时间")
+    reservations = Reservation.__table__
+    values = {
+        "store_id": select(Table.store_id).where(Table.id == table_id).scalar_subquery(),
+        "table_id": table_id,
+        "member_id": member_id,
+        "customer_name": customer_name,
+        "phone": phone,
+        "party_size": party_size,
+        "start_at": start_at,
+        "end_at": end_at,
+        "status": ReservationStatus.BOOKED,
+        "remark": remark,
+        "created_at": datetime.utcnow()
+    }
+    overlap = select(reservations.c.id).where(
+        reservations.c.table_id == table_id,
+        reservations.c.status.in_(ACTIVE_RESERVATION_STATUSES),
+        reservations.c.start_at < end_at,
+        reservations.c.end_at > start_at
+    ).exists()
+    columns = [
+        value if key == "store_id" else literal(value, reservations.c[key].type)
+        for key, value in values.items()
+    ]
+    reservation_id = db.execute(
+        insert(reservations).from_select(list(values), select(*columns).where(~overlap)).returning(reservations.c.id)
+    ).scalar()
+    if reservation_id is None:
+        raise ReservationConflictError("该桌台在所选时段已有预约")
+    return reservation_id
+
+def cancel_reservation(db, reservation_id):
+    """取消预约，返回是否成功；不在此提交事务"""
+    reservations = Reservation.__table__
+    return db.execute(update(reservations).where(
+        reservations.c.id == reservation_id,
+        reservations.c.status == ReservationStatus.BOOKED
+    ).values(status=ReservationStatus.CANCELLED)).rowcount > 0
+
+def seat_reservation(db, reservation_id):
+    """预约到店：预约标记为已到店、桌台开台，返回新会话；不在此提交事务"""
+    reservations = Reservation.__table__
+    tables = Table.__table__
+    reservation = db.execute(update(reservations).where(
+        reservations.c.id == reservation_id,
+        reservations.c.status == ReservationStatus.BOOKED
+    ).values(status=ReservationStatus.SEATED).returning(
+        reservations.c.table_id, reservations.c.store_id, reservations.c.member_id
+    )).first()
+    if reservation is None:
+        raise ReservationConflictError("预约状态已变化，请刷新")
+    capacity = db.execute(update(tables).where(
+        tables.c.id == reservation.table_id,
+        tables.c.status.in_([TableStatus.FREE, TableStatus.RESERVED])
+    ).values(status=TableStatus.OCCUPIED, version=tables.c.version + 1).returning(tables.c.capacity)).scalar()
+    if capacity is None:
+        raise ReservationConflictError("桌台正在使用中")
+    run_after_commit(db, get_free_table_index().remove, reservation.store_id, reservation.table_id, capacity)
+    session = Session(table_id=reservation.table_id, store_id=reservation.store_id, member_id=reservation.member_id)
+    db.add(session)
+    return session
+
+def sweep_reservations(db, now=None):
+    """预约扫描：超时未到店的预约记为爽约，即将开始的预约锁定桌台，释放本扫描锁定、预约已结束且没有待到店预约的桌台
+    
+    扫描锁定桌台时在预约上记录 locked_at，只释放这类桌台，手工标记为已预约的桌台保持不变。
+    """
+    now = now or datetime.now()
+    reservations = Reservation.__table__
+    tables = Table.__table__
+    no_show = db.execute(update(reservations).where(
+        reservations.c.status == ReservationStatus.BOOKED,
+        reservations.c.start_at < now - timedelta(minutes=RESERVATION_GRACE_MINUTES)
+    ).values(status=ReservationStatus.NO_SHOW)).rowcount
+    is_due = (
+        (reservations.c.status == ReservationStatus.BOOKED)
+        & (reservations.c.start_at <= now + timedelta(minutes=RESERVATION_LEAD_MINUTES))
+        & (reservations.c.end_at > now)
+    )
+    due_tables = select(reservations.c.table_id).where(is_due)
+    locked_tables = select(reservations.c.table_id).where(reservations.c.locked_at.isnot(None))
+    reserved = db.execute(update(tables).where(
+        tables.c.status == TableStatus.FREE, tables.c.id.in_(due_tables)
+    ).values(status=TableStatus.RESERVED, version=tables.c.version + 1).returning(tables.c.id)).scalars().all()
+    # 新锁定的桌台，以及本扫描已锁定的桌台上接着到期的预约，都记为由扫描锁定
+    db.execute(update(reservations).where(
+        is_due, reservations.c.locked_at.is_(None),
+        reservations.c.table_id.in_(reserved) | reservations.c.table_id.in_(locked_tables)
+    ).values(locked_at=now))
+    expired = reservations.c.locked_at.isnot(None) & ~is_due
+    released = db.execute(update(tables).where(
+        tables.c.status == TableStatus.RESERVED,
+        tables.c.id.in_(select(reservations.c.table_id).where(expired)),
+        tables.c.id.not_in(due_tables)
+    ).values(status=TableStatus.FREE, version=tables.c.version + 1)).rowcount
+    db.execute(update(reservations).where(expired).values(locked_at=None))
+    db.commit()
+    if reserved or released:
+        get_free_table_index().invalidate()
+    return {"no_show": no_show, "reserved": len(reserved), "released": released}
+
+class ReservationIndex:
+    """门店预约的内存区间索引：每个桌台一组按开始时间排序的互不重叠区间，冲突检查为二分查找"""
+
+    def __init__(self, reservations):
+        self._starts = defaultdict(list)
+        self._ends = defaultdict(list)
+        self._reservations = defaultdict(list)
+        for r in sorted(reservations, key=lambda r: r.start_at):
+            self._starts[r.table_id].append(r.start_at)
+            self._ends[r.table_id].append(r.end_at)
+            self._reservations[r.table_id].append(r)
+
+    def find(self, table_id, start_at, end_at):
+        """返回与时段重叠的第一条预约，没有则为 None"""
+        ends = self._ends.get(table_id)
+        if not ends:
+            return None
+        i = bisect_right(ends, start_at)
+        if i < len(ends) and self._starts[table_id][i] < end_at:
+            return self._reservations[table_id][i]
+        return None
+
+    def is_free(self, table_id, start_at, end_at):
+        return self.find(table_id, start_at, end_at) is None
+
+    def free_tables(self, table_ids, start_at, end_at):
+        return [table_id for table_id in table_ids if self.is_free(table_id, start_at, end_at)]
+
+    def reservations(self, table_id):
+        return self._reservations.get(table_id, [])
+
+def load_reservation_index(db, store_id, day):
+    """一次查询载入门店当天的有效预约，构建区间索引"""
+    day_start = datetime.combine(day, datetime.min.time())
+    day_end = day_start + timedelta(days=1)
+    rows = db.execute(select(
+        Reservation.id, Reservation.table_id, Reservation.member_id, Reservation.customer_name, Reservation.phone,
+        Reservation.party_size, Reservation.start_at, Reservation.end_at, Reservation.status
+    ).where(
+        Reservation.store_id == store_id,
+        Reservation.status.in_(ACTIVE_RESERVATION_STATUSES),
+        Reservation.start_at < day_end,
+        Reservation.end_at > day_start
+    )).all()
+    return ReservationIndex(rows)
+
+@functools.cache
+def start_reservation_sweeper(interval=RESERVATION_SWEEP_SECONDS):
+    """启动后台预约扫描线程，每个进程只启动一次"""
+    stop = threading.Event()
+
+    def run():
+        while True:
+            for session_factory in store_db_factories():
+                db = session_factory()
+                try:
+                    sweep_reservations(db)
+                except Exception as e:
+                    db.rollback()
+                    print(f"预约扫描失败: {e}")
+                finally:
+                    db.close()
+            if stop.wait(interval):
+                break
+
+    threading.Thread(target=run, name="reservation-sweeper", daemon=True).start()
+    return stop
+
+# ==================== 桌台分配 ====================
+FREE_TABLE_INDEX_TTL_SECONDS = 60  # 空闲桌台索引最长缓存时间，兼顾其他进程对桌台状态的修改
+
+class FreeTableIndex:
+    """各门店空闲桌台按容量分桶的内存索引，用于按人数即时分配最合适的桌台
+    
+    索引只是分配提示，最终以带条件的 UPDATE 为准；门店索引按需从数据库载入，过期或冲突后重新载入。
+    开台、结账对索引的修改通过 run_after_commit 在事务提交后才应用，回滚的事务不会改动索引。
+    """
+
+    def __init__(self, ttl_seconds=FREE_TABLE_INDEX_TTL_SECONDS):
+        self._lock = threading.Lock()
+        self._ttl = timedelta(seconds=ttl_seconds)
+        self._stores = {}  # 门店ID -> (载入时间, {容量: [桌台ID...]}, [容量...])
+
+    def _load(self, store_id):
+        with get_store_engine(store_id).connect() as conn:
+            rows = conn.execute(select(Table.id, Table.capacity).where(
+                Table.store_id == store_id, Table.status == TableStatus.FREE
+            ).order_by(Table.id)).all()
+        buckets = defaultdict(list)
+        for table_id, capacity in rows:
+            buckets[capacity].append(table_id)
+        return datetime.utcnow(), dict(buckets), sorted(buckets)
+
+    def _store(self, store_id):
+        entry = self._stores.get(store_id)
+        if entry is None or datetime.utcnow() - entry[0] > self._ttl:
+            entry = self._stores[store_id] = self._load(store_id)
+        return entry
+
+    def best_fit(self, store_id, party_size):
+        """返回容量不小于人数的最小空闲桌台ID，没有则为 None"""
+        with self._lock:
+            _, buckets, capacities = self._store(store_id)
+            i = bisect_left(capacities, party_size)
+            return buckets[capacities[i]][0] if i < len(capacities) else None
+
+    def remove(self, store_id, table_id, capacity):
+        """桌台开台后移出索引"""
+        with self._lock:
+            entry = self._stores.get(store_id)
+            if entry is None:
+                return
+            _, buckets, capacities = entry
+            bucket = buckets.get(capacity)
+            if bucket and table_id in bucket:
+                bucket.remove(table_id)
+                if not bucket:
+                    del buckets[capacity]
+                    capacities.remove(capacity)
+
+    def add(self, store_id, table_id, capacity):
+        """桌台结账空闲后加入索引"""
+        with self._lock:
+            entry = self._stores.get(store_id)
+            if entry is None:
+                return
+            _, buckets, capacities = entry
+            if capacity not in buckets:
+                buckets[capacity] = []
+                insort(capacities, capacity)
+            if table_id not in buckets[capacity]:
+                insort(buckets[capacity], table_id)
+
+    def invalidate(self, store_id=None):
+        """清空索引，下次分配时重新载入"""
+        with self._lock:
+            if store_id is None:
+                self._stores.clear()
+            else:
+                self._stores.pop(store_id, None)
+
+@functools.cache
+def get_free_table_index():
+    """进程内共享的空闲桌台索引"""
+    return FreeTableIndex()
+
+def seat_party(db, store_id, party_size, member_id=None, idempotency_key=None, max_attempts=3):
+    """按人数分配最合适的空闲桌台并开台，返回 (桌台, 会话)，没有合适桌台返回 None；不在此提交事务
+    
+    重复提交同一幂等键返回原桌台和会话。
+    """
+    if idempotency_key:
+        existing = claim_idempotency_key(db, idempotency_key, "seat_party")
+        if existing is not None:
+            db.rollback()
+            session = db.get(Session, existing)
+            return db.get(Table, session.table_id), session
+    index = get_free_table_index()
+    tables = Table.__table__
+    for _ in range(max_attempts):
+        table_id = index.best_fit(store_id, party_size)
+        if table_id is None:
+            return None
+        claimed = db.execute(update(tables).where(
+            tables.c.id == table_id, tables.c.status == TableStatus.FREE
+        ).values(status=TableStatus.OCCUPIED, version=tables.c.version + 1).returning(tables.c.capacity)).scalar()
+        if claimed is None:
+            # 桌台已被占用，索引过期，重新载入后重试
+            index.invalidate(store_id)
+            continue
+        run_after_commit(db, index.remove, store_id, table_id, claimed)
+        session = Session(table_id=table_id, store_id=store_id, member_id=member_id)
+        db.add(session)
+        db.flush()
+        if idempotency_key:
+            complete_idempotent_operation(db, idempotency_key, session.id)
+        return db.get(Table, table_id, populate_existing=True), session
+    return None
+
+# ==================== 点单 ====================
+def submit_session_order(db, session_id, store_id, cart, member_level=None, version=None):
+    """购物车一次下单：批量写入点单明细、累加会话金额、按条件批量扣减库存；不在此提交事务
+    
+    cart 为 {商品ID: 数量}，成交单价按会员等级和价格规则计算。传入 version 时会话版本不一致抛出 StaleDataError。
+    库存只在充足时扣减，返回库存不足或无库存记录的商品ID列表。
+    """
+    cart = {product_id: quantity for product_id, quantity in cart.items() if quantity > 0}
+    if not cart:
+        return []
+    products = {p.id: p for p in db.execute(
+        select(Product.id, Product.category, Product.unit_price, Product.reorder_threshold).where(Product.id.in_(cart))
+    )}
+    cart = {product_id: quantity for product_id, quantity in cart.items() if product_id in products}
+    if not cart:
+        return []
+    
+    pricing = get_pricing_engine()
+    now = datetime.utcnow()
+    rows = []
+    for product_id, quantity in cart.items():
+        product = products[product_id]
+        unit_price = pricing.price(product.unit_price, product_id, product.category, store_id, member_level)
+        rows.append({
+            "session_id": session_id,
+            "product_id": product_id,
+            "quantity": quantity,
+            "unit_price": unit_price,
+            "subtotal": round(unit_price * quantity, 2),
+            "order_time": now
+        })
+    # 先按条件更新会话：已结账或已被其他终端修改的会话不再写入明细
+    sessions = Session.__table__
+    stmt = update(sessions).where(sessions.c.id == session_id, sessions.c.status == SessionStatus.IN_PROGRESS)
+    if version is not None:
+        stmt = stmt.where(sessions.c.version == version)
+    updated = db.execute(stmt.values(
+        total_amount=sessions.c.total_amount + sum(row["subtotal"] for row in rows),
+        version=sessions.c.version + 1
+    )).rowcount
+    if not updated:
+        if version is not None:
+            raise StaleDataError("消费信息已被其他终端修改，请核对后重新提交")
+        raise OperationConflictError("该会话已结账")
+    db.execute(insert(SessionItem.__table__), rows)
+    
+    # 一条 UPDATE 扣减所有商品：数量按商品ID取 CASE，库存不足的行不满足条件不会被更新
+    inventory = Inventory.__table__
+    quantity = case(cart, value=inventory.c.product_id)
+    deducted = db.execute(update(inventory).where(
+        inventory.c.store_id == store_id,
+        inventory.c.product_id.in_(cart),
+        inventory.c.quantity >= quantity
+    ).values(quantity=inventory.c.quantity - quantity).returning(
+        inventory.c.product_id, inventory.c.quantity
+    )).all()
+    for product_id, after_quantity in deducted:
+        evaluate_stock_alert(db, store_id, product_id, after_quantity + cart[product_id], after_quantity,
+                             threshold=products[product_id].reorder_threshold)
+    deducted_ids = {product_id for product_id, _ in deducted}
+    return [product_id for product_id in cart if product_id not in deducted_ids]
+
+# ==================== 开台与结账 ====================
+class OperationConflictError(ValueError):
+    """操作目标的状态已被其他操作改变"""
+
+def new_idempotency_key():
+    """生成幂等键"""
+    return uuid.uuid4().hex
+
+def claim_idempotency_key(db, key, operation):
+    """登记幂等键，须作为事务的第一条写操作：首次登记返回 None，已执行过返回原操作结果ID
+    
+    并发提交时后到的事务在唯一索引上等待先到的事务提交，随后命中冲突，直接取回原结果。
+    """
+    operations = IdempotentOperation.__table__
+    claimed = db.execute(sqlite_insert(operations).values(
+        key=key, operation=operation, created_at=datetime.utcnow()
+    ).on_conflict_do_nothing(index_elements=["key"]).returning(operations.c.id)).scalar()
+    if claimed is not None:
+        return None
+    return db.execute(select(operations.c.result_id).where(operations.c.key == key)).scalar()
+
+def complete_idempotent_operation(db, key, result_id):
+    """记录幂等操作结果，与操作本身同一事务提交"""
+    operations = IdempotentOperation.__table__
+    db.execute(update(operations).where(operations.c.key == key).values(result_id=result_id))
+
+def open_table(db, table_id, member_id=None, idempotency_key=None, version=None):
+    """开台，返回 (会话, 是否本次新建)；重复提交同一幂等键返回原会话；不在此提交事务
+    
+    传入 version 时桌台版本不一致抛出 StaleDataError。
+    """
+    if idempotency_key:
+        existing = claim_idempotency_key(db, idempotency_key, "open_table")
+        if existing is not None:
+            db.rollback()
+            return db.get(Session, existing), False
+    tables = Table.__table__
+    stmt = update(tables).where(tables.c.id == table_id, tables.c.status != TableStatus.OCCUPIED)
+    if version is not None:
+        stmt = stmt.where(tables.c.version == version)
+    table = db.execute(stmt.values(status=TableStatus.OCCUPIED, version=tables.c.version + 1).returning(
+        tables.c.store_id, tables.c.capacity
+    )).first()
+    if table is None:
+        if version is not None:
+            raise StaleDataError("桌台状态已被其他终端修改")
+        raise OperationConflictError("桌台正在使用中")
+    session = Session(table_id=table_id, store_id=table.store_id, member_id=member_id)
+    db.add(session)
+    db.flush()
+    if idempotency_key:
+        complete_idempotent_operation(db, idempotency_key, session.id)
+    run_after_commit(db, get_free_table_index().remove, table.store_id, table_id, table.capacity)
+    return session, True
+
+def checkout_session(db, session_id, payment_method, idempotency_key=None, version=None):
+    """结账：结束会话、释放桌台、生成订单与明细、扣减库存并记录流水，余额支付时扣减会员余额
+    
+    返回 (订单, 是否本次新建)；重复提交同一幂等键返回原订单。不在此提交事务，
+    余额支付时会员不存在抛出 MemberNotFoundError、余额不足抛出 InsufficientBalanceError，会话已结账抛出 OperationConflictError，
+    传入 version 时会话版本不一致（结账确认后又有点单或退单）抛出 StaleDataError。
+    """
+    if idempotency_key:
+        existing = claim_idempotency_key(db, idempotency_key, "checkout")
+        if existing is not None:
+            db.rollback()
+            return db.get(Order, existing), False
+    
+    # 会话状态按条件更新，同一会话只能结账一次
+    sessions = Session.__table__
+    now = datetime.utcnow()
+    stmt = update(sessions).where(sessions.c.id == session_id, sessions.c.status == SessionStatus.IN_PROGRESS)
+    if version is not None:
+        stmt = stmt.where(sessions.c.version == version)
+    session = db.execute(stmt.values(
+        status=SessionStatus.COMPLETED,
+        end_time=now,
+        duration_minutes=func.cast((func.julianday(now) - func.julianday(sessions.c.start_time)) * 1440, Integer),
+        version=sessions.c.version + 1
+    ).returning(sessions.c.table_id, sessions.c.store_id, sessions.c.member_id, sessions.c.total_amount)).first()
+    if session is None:
+        if version is not None:
+            raise StaleDataError("消费信息已被其他终端修改，请核对后重新结账")
+        raise OperationConflictError("该会话已结账")
+    
+    tables = Table.__table__
+    capacity = db.execute(update(tables).where(tables.c.id == session.table_id).values(
+        status=TableStatus.FREE, version=tables.c.version + 1
+    ).returning(tables.c.capacity)).scalar()
+    
+    order = Order(
+        # 分库模式各门店库的会话ID独立编号，订单号带上门店ID才能全局唯一
+        order_no=f"ORD{datetime.now().strftime('%Y%m%d%H%M%S')}{session.store_id:04d}{session_id:06d}",
+        store_id=session.store_id,
+        member_id=session.member_id,
+        total_amount=session.total_amount,
+        payment_method=payment_method,
+        status=OrderStatus.COMPLETED
+    )
+    db.add(order)
+    db.flush()
+    
+    items = db.execute(select(
+        SessionItem.product_id, SessionItem.quantity, SessionItem.unit_price, SessionItem.subtotal
+    ).where(SessionItem.session_id == session_id)).all()
+    if items:
+        db.execute(insert(OrderItem.__table__), [{
+            "order_id": order.id,
+            "product_id": item.product_id,
+            "quantity": item.quantity,
+            "unit_price": item.unit_price,
+            "subtotal": item.subtotal
+        } for item in items])
+        
+        # 一条 UPDATE 扣减所有商品库存；出库流水和库存预警不影响结账结果，由异步写入队列在事务外批量补写
+        consumed = defaultdict(int)
+        for item in items:
+            consumed[item.product_id] += item.quantity
+        inventory = Inventory.__table__
+        quantity = case(consumed, value=inventory.c.product_id)
+        deducted = db.execute(update(inventory).where(
+            inventory.c.store_id == session.store_id, inventory.c.product_id.in_(consumed)
+        ).values(quantity=inventory.c.quantity - quantity).returning(
+            inventory.c.product_id, inventory.c.quantity
+        )).all()
+        if deducted:
+            enqueue_outbox(db, "inventory_logs", {
+                "store_id": session.store_id,
+                "log_type": InventoryLogType.OUT.value,
+                # 在持有写锁时取流水时间，对账按时间排序时与其他库存变动的先后一致
+                "created_at": datetime.utcnow().isoformat(),
+                "rows": [(product_id, -consumed[product_id], after_quantity,
+                          f"订单 {order.order_no} 消耗 {consumed[product_id]} 件")
+                         for product_id, after_quantity in deducted]
+            })
+    
+    if idempotency_key:
+        complete_idempotent_operation(db, idempotency_key, order.id)
+    
+    # 余额放在最后扣减：分库模式在主库独立提交，之前的写入已不会再因冲突失败
+    if payment_method == PaymentMethod.BALANCE:
+        if SHARD_DIR:
+            spend_catalog_balance(db, session.member_id, session.total_amount, order.order_no, session.store_id)
+        else:
+            spend_member_balance(db, session.member_id, session.total_amount, order.order_no, store_id=session.store_id)
+    if capacity is not None:
+        run_after_commit(db, get_free_table_index().add, session.store_id, session.table_id, capacity)
+    return order, True
+
+def cancel_session_item(db, item_id, version=None):
+    """退单：删除点单明细、扣回会话金额、恢复库存；不在此提交事务
+    
+    传入 version 时会话版本不一致抛出 StaleDataError，会话已结账抛出 OperationConflictError。
+    """
+    item = db.execute(select(
+        SessionItem.session_id, SessionItem.product_id, SessionItem.quantity, SessionItem.subtotal
+    ).where(SessionItem.id == item_id)).first()
+    if item is None:
+        raise OperationConflictError("该点单已取消")
+    sessions = Session.__table__
+    stmt = update(sessions).where(sessions.c.id == item.session_id, sessions.c.status == SessionStatus.IN_PROGRESS)
+    if version is not None:
+        stmt = stmt.where(sessions.c.version == version)
+    store_id = db.execute(stmt.values(
+        total_amount=sessions.c.total_amount - item.subtotal, version=sessions.c.version + 1
+    ).returning(sessions.c.store_id)).scalar()
+    if store_id is None:
+        if version is not None:
+            raise StaleDataError("消费信息已被其他终端修改")
+        raise OperationConflictError("该会话已结账")
+    if not db.execute(delete(SessionItem.__table__).where(SessionItem.id == item_id)).rowcount:
+        raise OperationConflictError("该点单已取消")
+    
+    inventory = Inventory.__table__
+    after_quantity = db.execute(update(inventory).where(
+        inventory.c.store_id == store_id, inventory.c.product_id == item.product_id
+    ).values(quantity=inventory.c.quantity + item.quantity).returning(inventory.c.quantity)).scalar()
+    if after_quantity is not None:
+        evaluate_stock_alert(db, store_id, item.product_id, after_quantity - item.quantity, after_quantity)
+
+# ==================== 会员余额 ====================
+class InsufficientBalanceError(ValueError):
+    """会员余额不足"""
+
+class MemberNotFoundError(ValueError):
+    """会员不存在（含未关联会员的会话使用余额支付）"""
+
+def change_member_balance(db, member_id, amount, log_type, order_no=None, remark=None, store_id=None):
+    """原子变更会员余额并追加余额流水，返回变动后余额；不在此提交事务
+    
+    余额通过带条件的 UPDATE ... RETURNING 一步完成，扣减时要求余额充足，不做先读后写。
+    会员不存在抛出 MemberNotFoundError，余额不足抛出 InsufficientBalanceError。
+    """
+    if member_id is None:
+        raise MemberNotFoundError("会员不存在")
+    amount = round(amount, 2)
+    members = Member.__table__
+    stmt = update(members).where(members.c.id == member_id)
+    if amount < 0:
+        stmt = stmt.where(members.c.balance >= -amount)
+    balance_after = db.execute(
+        stmt.values(balance=func.round(members.c.balance + amount, 2)).returning(members.c.balance)
+    ).scalar()
+    if balance_after is None:
+        # 没有更新到行时再区分会员不存在与余额不足，正常路径不多查一次
+        if db.execute(select(members.c.id).where(members.c.id == member_id)).first() is None:
+            raise MemberNotFoundError("会员不存在")
+        raise InsufficientBalanceError(f"会员余额不足，需支付 ¥{-amount:.2f}")
+    db.execute(insert(MemberBalanceLog.__table__).values(
+        member_id=member_id,
+        log_type=log_type,
+        amount=amount,
+        balance_after=balance_after,
+        order_no=order_no,
+        store_id=store_id,
+        remark=remark,
+        created_at=datetime.utcnow()
+    ))
+    return balance_after
+
+def topup_member_balance(db, member_id, amount, remark=None):
+    """会员充值"""
+    return change_member_balance(db, member_id, amount, BalanceLogType.TOPUP, remark=remark or f"充值 ¥{amount:.2f}")
+
+def spend_member_balance(db, member_id, amount, order_no=None, store_id=None):
+    """余额支付，会员不存在抛出 MemberNotFoundError，余额不足抛出 InsufficientBalanceError"""
+    return change_member_balance(db, member_id, -amount, BalanceLogType.SPEND, order_no=order_no,
+                                 remark=f"订单 {order_no} 消费 ¥{amount:.2f}" if order_no else None, store_id=store_id)
+
+def refund_member_balance(db, member_id, amount, order_no=None, remark=None, store_id=None):
+    """退款到会员余额"""
+    return change_member_balance(db, member_id, amount, BalanceLogType.REFUND, order_no=order_no, remark=remark,
+                                 store_id=store_id)
+
+# 分库模式下结账事务在门店库，会员余额在主库。主库为WAL模式时跨库事务不是原子的，
+# 因此余额在主库的独立事务中扣减并提交，门店库事务未提交就结束时退回；
+# 进程在两次提交之间退出留下的扣款，由 settle_balance_spends 在启动时按订单是否存在退回
+BALANCE_SETTLE_MINUTES = 10  # 扣款后超过该时间门店库仍没有订单，视为结账未完成
+BALANCE_SETTLE_DAYS = 7  # 启动时检查的扣款时间范围
+
+def spend_catalog_balance(db, member_id, amount, order_no, store_id):
+    """分库模式余额支付：在主库独立事务中扣款并提交，门店库会话 db 的事务未提交就结束时自动退回"""
+    catalog_db = SessionLocal()
+    try:
+        spend_member_balance(catalog_db, member_id, amount, order_no, store_id=store_id)
+        catalog_db.commit()
+    finally:
+        catalog_db.close()
+    db.info.setdefault("catalog_spends", []).append((member_id, amount, order_no, store_id))
+
+def _refund_unfinished_spend(member_id, amount, order_no, store_id):
+    catalog_db = SessionLocal()
+    try:
+        refund_member_balance(catalog_db, member_id, amount, order_no,
+                              remark=f"订单 {order_no} 未完成，退回 ¥{amount:.2f}", store_id=store_id)
+        catalog_db.commit()
+    finally:
+        catalog_db.close()
+
+@event.listens_for(OrmSession, "after_commit")
+def _confirm_catalog_spends(session):
+    session.info.pop("catalog_spends", None)
+
+@event.listens_for(OrmSession, "after_transaction_end")
+def _refund_catalog_spends(session, transaction):
+    """门店库事务回滚或未提交就关闭：退回本事务已在主库扣减的余额"""
+    if transaction.parent is not None:
+        return
+    for spend in session.info.pop("catalog_spends", []):
+        try:
+            _refund_unfinished_spend(*spend)
+        except Exception as e:
+            # 退回失败留给 settle_balance_spends 处理
+            print(f"⚠️ 订单 {spend[2]} 余额退回失败: {e}")
+
+def settle_balance_spends(now=None):
+    """分库模式：退回主库已扣款、门店库却没有对应订单（也未退回过）的余额支付，返回退回笔数"""
+    now = now or datetime.utcnow()
+    logs = MemberBalanceLog.__table__
+    refunded = select(logs.c.order_no).where(logs.c.log_type == BalanceLogType.REFUND, logs.c.order_no.isnot(None))
+    with engine.connect() as conn:
+        spends = conn.execute(select(logs.c.member_id, logs.c.amount, logs.c.order_no, logs.c.store_id).where(
+            logs.c.log_type == BalanceLogType.SPEND, logs.c.store_id.isnot(None), logs.c.order_no.isnot(None),
+            logs.c.created_at < now - timedelta(minutes=BALANCE_SETTLE_MINUTES),
+            logs.c.created_at >= now - timedelta(days=BALANCE_SETTLE_DAYS), logs.c.order_no.notin_(refunded)
+        )).all()
+    by_store = defaultdict(list)
+    for spend in spends:
+        by_store[spend.store_id].append(spend)
+    settled = 0
+    for store_id, store_spends in by_store.items():
+        with get_store_engine(store_id).connect() as conn:
+            existing = set(conn.execute(select(Order.order_no).where(
+                Order.order_no.in_([spend.order_no for spend in store_spends])
+            )).scalars())
+        for spend in store_spends:
+            if spend.order_no not in existing:
+                _refund_unfinished_spend(spend.member_id, -spend.amount, spend.order_no, store_id)
+                settled += 1
+    return settled
+
+def verify_member_balances(db):
+    """核对会员余额与余额流水累计，返回不一致的会员"""
+    ledger = select(
+        MemberBalanceLog.member_id,
+        func.round(func.sum(MemberBalanceLog.amount), 2).label("ledger_balance")
+    ).group_by(MemberBalanceLog.member_id).subquery()
+    ledger_balance = func.coalesce(ledger.c.ledger_balance, 0.0)
+    result = db.execute(select(
+        Member.id.label("member_id"), Member.name, Member.balance, ledger_balance.label("ledger_balance")
+    ).outerjoin(ledger, ledger.c.member_id == Member.id).where(
+        func.abs(Member.balance - ledger_balance) > 0.005
+    ))
+    return pd.DataFrame(result.all(), columns=list(result.keys()))
+
+def create_opening_balance_logs(db):
+    """为尚无余额流水的会员补记期初余额，使缓存余额可与流水核对"""
+    has_logs = select(MemberBalanceLog.id).where(MemberBalanceLog.member_id == Member.id).exists()
+    members = db.query(Member.id, Member.balance).filter(Member.balance != 0, ~has_logs).all()
+    if members:
+        db.execute(insert(MemberBalanceLog.__table__), [{
+            "member_id": m.id,
+            "log_type": BalanceLogType.OPENING,
+            "amount": m.balance,
+            "balance_after": m.balance,
+            "remark": "期初余额",
+            "created_at": datetime.utcnow()
+        } for m in members])
+    db.commit()
+
+# ==================== 库存预警 ====================
+def evaluate_stock_alert(db, store_id, product_id, before_quantity, after_quantity, threshold=None):
+    """库存变动后检查补货阈值：向下跌破阈值时记录预警，回到阈值以上时关闭预警"""
+    if threshold is None:
+        threshold = db.query(Product.reorder_threshold).filter(Product.id == product_id).scalar()
+        if threshold is None:
+            return
+    if before_quantity >= threshold > after_quantity:
+        db.add(StockAlert(
+            store_id=store_id,
+            product_id=product_id,
+            threshold=threshold,
+            quantity=after_quantity
+        ))
+    elif before_quantity < threshold <= after_quantity:
+        db.query(StockAlert).filter(
+            StockAlert.store_id == store_id,
+            StockAlert.product_id == product_id,
+            StockAlert.status == StockAlertStatus.OPEN
+        ).update({StockAlert.status: StockAlertStatus.RESOLVED, StockAlert.resolved_at: datetime.utcnow()},
+                 synchronize_session=False)
+
+def evaluate_stock_alerts(db, store_id, changes, now=None):
+    """批量检查补货阈值，changes 为 [(商品ID, 变动前, 变动后)]；新预警一次写入，回补的预警一次关闭"""
+    if not changes:
+        return
+    now = now or datetime.utcnow()
+    thresholds = dict(db.execute(select(Product.id, Product.reorder_threshold).where(
+        Product.id.in_({product_id for product_id, _, _ in changes})
+    )).all())
+    opened, resolved = [], []
+    for product_id, before_quantity, after_quantity in changes:
+        threshold = thresholds.get(product_id)
+        if threshold is None:
+            continue
+        if before_quantity >= threshold > after_quantity:
+            opened.append({"store_id": store_id, "product_id": product_id, "threshold": threshold,
+                           "quantity": after_quantity, "status": StockAlertStatus.OPEN, "created_at": now})
+        elif before_quantity < threshold <= after_quantity:
+            resolved.append(product_id)
+    if opened:
+        db.execute(insert(StockAlert.__table__), opened)
+    if resolved:
+        db.execute(update(StockAlert.__table__).where(
+            StockAlert.store_id == store_id,
+            StockAlert.product_id.in_(resolved),
+            StockAlert.status == StockAlertStatus.OPEN
+        ).values(status=StockAlertStatus.RESOLVED, resolved_at=now))
+
+def reevaluate_stock_alerts(db, product_id, threshold, store_ids=None, now=None):
+    """补货阈值修改后按新阈值一次检查各门店该商品的库存：低于阈值且没有未关闭预警的记录预警，
+    已回到阈值以上的关闭预警；store_ids 为空表示全部门店，返回 (新增预警数, 关闭预警数)；不在此提交事务"""
+    now = now or datetime.utcnow()
+    inventory = Inventory.__table__
+    alerts = StockAlert.__table__
+    restocked = _in_stores(select(inventory.c.store_id).where(
+        inventory.c.product_id == product_id, inventory.c.quantity >= threshold
+    ), inventory.c.store_id, store_ids)
+    resolved = db.execute(update(alerts).where(
+        alerts.c.product_id == product_id, alerts.c.status == StockAlertStatus.OPEN,
+        alerts.c.store_id.in_(restocked)
+    ).values(status=StockAlertStatus.RESOLVED, resolved_at=now)).rowcount
+    open_alert = select(alerts.c.id).where(
+        alerts.c.store_id == inventory.c.store_id, alerts.c.product_id == product_id,
+        alerts.c.status == StockAlertStatus.OPEN
+    ).exists()
+    opened = db.execute(insert(alerts).from_select(
+        ["store_id", "product_id", "threshold", "quantity", "status", "created_at"],
+        _in_stores(select(
+            inventory.c.store_id, literal(product_id), literal(threshold), inventory.c.quantity,
+            literal(StockAlertStatus.OPEN, alerts.c.status.type), literal(now, alerts.c.created_at.type)
+        ).where(
+            inventory.c.product_id == product_id, inventory.c.quantity < threshold, ~open_alert
+        ), inventory.c.store_id, store_ids)
+    )).rowcount
+    return opened, resolved
+
+def update_reorder_threshold(product_id, threshold):
+    """修改商品补货阈值并按新阈值重新检查各门店的库存预警，返回 (新增预警数, 关闭预警数)；在此提交
+    
+    分库模式商品在主库、预警在各门店库，先提交阈值，再逐个门店库检查并提交。
+    """
+    db = SessionLocal()
+    try:
+        db.execute(update(Product.__table__).where(Product.id == product_id).values(reorder_threshold=threshold))
+        counts = (0, 0) if SHARD_DIR else reevaluate_stock_alerts(db, product_id, threshold)
+        db.commit()
+    finally:
+        db.close()
+    if SHARD_DIR:
+        def reevaluate(store_db, store_ids):
+            result = reevaluate_stock_alerts(store_db, product_id, threshold, store_ids)
+            store_db.commit()
+            return result
+        counts = tuple(map(sum, zip(*map_stores(reevaluate)))) or (0, 0)
+    return counts
+
+def count_open_stock_alerts(db):
+    """未关闭的库存预警数量"""
+    return db.query(func.count(StockAlert.id)).filter(StockAlert.status == StockAlertStatus.OPEN).scalar()
+
+# ==================== 批量入库与调拨 ====================
+class InsufficientStockError(ValueError):
+    """库存不足"""
+
+def apply_inventory_changes(db, store_id, changes, log_type, remark, require_stock=False):
+    """一个门店多商品库存变动：补齐库存记录、一条 UPDATE 批量变更、批量写流水；不在此提交事务
+    
+    changes 为 {商品ID: 变动数量}，remark 为备注或按商品ID生成备注的函数。
+    require_stock 为 True 时任一商品库存不足则整体抛出 InsufficientStockError。
+    """
+    changes = {product_id: quantity for product_id, quantity in changes.items() if quantity}
+    if not changes:
+        return 0
+    inventory = Inventory.__table__
+    
+    # 没有库存记录的商品先补一条0库存记录；NOT EXISTS 条件与插入在同一语句，并发时不会重复插入
+    if any(quantity > 0 for quantity in changes.values()):
+        existing = select(inventory.c.id).where(
+            inventory.c.store_id == bindparam("store_id"), inventory.c.product_id == bindparam("product_id")
+        ).exists()
+        db.execute(insert(inventory).from_select(
+            ["store_id", "product_id", "quantity"],
+            select(bindparam("store_id", type_=Integer), bindparam("product_id", type_=Integer), literal(0)).where(~existing)
+        ), [{"store_id": store_id, "product_id": product_id} for product_id, quantity in changes.items() if quantity > 0])
+    
+    delta = case(changes, value=inventory.c.product_id)
+    stmt = update(inventory).where(inventory.c.store_id == store_id, inventory.c.product_id.in_(changes))
+    if require_stock:
+        stmt = stmt.where(inventory.c.quantity + delta >= 0)
+    changed = db.execute(stmt.values(quantity=inventory.c.quantity + delta).returning(
+        inventory.c.product_id, inventory.c.quantity
+    )).all()
+    if require_stock and len({product_id for product_id, _ in changed}) < len(changes):
+        short = set(changes) - {product_id for product_id, _ in changed}
+        names = db.execute(select(Product.name).where(Product.id.in_(short))).scalars().all()
+        raise InsufficientStockError(f"库存不足：{'、'.join(names)}")
+    if not changed:
+        return 0
+    
+    now = datetime.utcnow()
+    db.execute(insert(InventoryLog.__table__), [{
+        "store_id": store_id,
+        "product_id": product_id,
+        "log_type": log_type,
+        "quantity": changes[product_id],
+        "before_quantity": after_quantity - changes[product_id],
+        "after_quantity": after_quantity,
+        "remark": remark(product_id) if callable(remark) else remark,
+        "created_at": now
+    } for product_id, after_quantity in changed])
+    
+    evaluate_stock_alerts(db, store_id, [
+        (product_id, after_quantity - changes[product_id], after_quantity) for product_id, after_quantity in changed
+    ], now)
+    return len(changed)
+
+def receive_stock(db, store_id, lines, remark=None):
+    """批量入库，lines 为 {商品ID: 数量}；不在此提交事务"""
+    return apply_inventory_changes(db, store_id, lines, InventoryLogType.IN,
+                                   remark or (lambda product_id: f"批量入库 {lines[product_id]} 件"))
+
+def _transfer_remarks(db, from_store_id, to_store_id, remark):
+    """调拨的 (调出备注, 调入备注)"""
+    if from_store_id == to_store_id:
+        raise ValueError("调出门店与调入门店不能相同")
+    if remark:
+        return remark, remark
+    store_names = dict(db.execute(select(Store.id, Store.name).where(Store.id.in_([from_store_id, to_store_id]))).all())
+    return (f"调拨至 {store_names.get(to_store_id, to_store_id)}",
+            f"由 {store_names.get(from_store_id, from_store_id)} 调入")
+
+def transfer_stock(db, from_store_id, to_store_id, lines, remark=None):
+    """门店间调拨，调出门店库存不足时整单失败；不在此提交事务（两个门店需在同一库）"""
+    out_remark, in_remark = _transfer_remarks(db, from_store_id, to_store_id, remark)
+    apply_inventory_changes(db, from_store_id, {product_id: -quantity for product_id, quantity in lines.items()},
+                            InventoryLogType.TRANSFER_OUT, out_remark, require_stock=True)
+    return apply_inventory_changes(db, to_store_id, lines, InventoryLogType.TRANSFER_IN, in_remark)
+
+def transfer_between_stores(from_store_id, to_store_id, lines, remark=None):
+    """门店间调拨并提交，返回调入商品数
+    
+    单库模式在一个事务内完成；分库模式两个门店库无法共用事务，先提交调出再调入，
+    调入失败时把调出数量退回调出门店（流水可追溯）后重新抛出异常。
+    """
+    if not SHARD_DIR:
+        db = get_db()
+        try:
+            count = transfer_stock(db, from_store_id, to_store_id, lines, remark)
+            db.commit()
+            return count
+        finally:
+            db.close()
+    
+    source = get_store_db(from_store_id)
+    try:
+        out_remark, in_remark = _transfer_remarks(source, from_store_id, to_store_id, remark)
+        apply_inventory_changes(source, from_store_id, {product_id: -quantity for product_id, quantity in lines.items()},
+                                InventoryLogType.TRANSFER_OUT, out_remark, require_stock=True)
+        source.commit()
+        target = get_store_db(to_store_id)
+        try:
+            count = apply_inventory_changes(target, to_store_id, lines, InventoryLogType.TRANSFER_IN, in_remark)
+            target.commit()
+            return count
+        except Exception:
+            target.rollback()
+            apply_inventory_changes(source, from_store_id, lines, InventoryLogType.TRANSFER_IN, "调拨失败，退回调出门店")
+            source.commit()
+            raise
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+# ==================== 异步写入队列 ====================
+# 结账等关键事务只写一条队列事件，流水、预警等次要写入由后台线程批量补写；
+# 事件与业务数据同一事务提交，补写与删除事件同一事务提交，进程崩溃重启后继续处理积压事件
+OUTBOX_POLL_SECONDS = float(os.environ.get("TEA_HOUSE_OUTBOX_POLL_SECONDS", "1"))
+OUTBOX_BATCH_SIZE = 200
+OUTBOX_MAX_ATTEMPTS = 5  # 超过失败次数的事件保留在队列中等待人工处理
+
+def enqueue_outbox(db, kind, payload):
+    """写入一条队列事件；不在此提交事务"""
+    db.execute(insert(OutboxEvent.__table__).values(
+        kind=kind, payload=json.dumps(payload, ensure_ascii=False), created_at=datetime.utcnow()
+    ))
+
+def apply_inventory_log_event(db, payload):
+    """补写库存流水并检查补货预警，rows 为 [(商品ID, 变动数量, 变动后库存, 备注)]"""
+    created_at = datetime.fromisoformat(payload["created_at"])
+    store_id = payload["store_id"]
+    rows = payload["rows"]
+    if not rows:
+        return
+    db.execute(insert(InventoryLog.__table__), [{
+        "store_id": store_id,
+        "product_id": product_id,
+        "log_type": InventoryLogType(payload["log_type"]),
+        "quantity": quantity,
+        "before_quantity": after_quantity - quantity,
+        "after_quantity": after_quantity,
+        "remark": remark,
+        "created_at": created_at
+    } for product_id, quantity, after_quantity, remark in rows])
+    evaluate_stock_alerts(db, store_id, [
+        (product_id, after_quantity - quantity, after_quantity) for product_id, quantity, after_quantity, _ in rows
+    ], created_at)
+
+OUTBOX_HANDLERS = {
+    "inventory_logs": apply_inventory_log_event,
+}
+
+def _take_outbox_events(db, event_ids=None, limit=OUTBOX_BATCH_SIZE):
+    """取出并删除待处理事件，多个进程同时处理时同一事件只会被一个事务取到"""
+    outbox = OutboxEvent.__table__
+    pending = select(outbox.c.id).where(outbox.c.attempts < OUTBOX_MAX_ATTEMPTS)
+    pending = pending.where(outbox.c.id.in_(event_ids)) if event_ids else pending.order_by(outbox.c.id).limit(limit)
+    return sorted(db.execute(delete(outbox).where(outbox.c.id.in_(pending)).returning(
+        outbox.c.id, outbox.c.kind, outbox.c.payload
+    )).all())
+
+def process_outbox_batch(db, limit=OUTBOX_BATCH_SIZE):
+    """处理一批事件，返回 (成功数, 失败数)；整批一个事务，出错时逐条重试以隔离失败事件"""
+    events = _take_outbox_events(db, limit=limit)
+    if not events:
+        return 0, 0
+    try:
+        for event in events:
+            OUTBOX_HANDLERS[event.kind](db, json.loads(event.payload))
+        db.commit()
+        return len(events), 0
+    except Exception:
+        db.rollback()
+    
+    applied = failed = 0
+    outbox = OutboxEvent.__table__
+    for event_id, _, _ in events:
+        try:
+            for event in _take_outbox_events(db, [event_id]):
+                OUTBOX_HANDLERS[event.kind](db, json.loads(event.payload))
+                applied += 1
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            db.execute(update(outbox).where(outbox.c.id == event_id).values(attempts=outbox.c.attempts + 1))
+            db.commit()
+            failed += 1
+            print(f"异步写入事件 {event_id} 处理失败: {e}")
+    return applied, failed
+
+def drain_outbox(session_factory=SessionLocal, limit=OUTBOX_BATCH_SIZE):
+    """处理一个库中所有积压事件直到队列为空，返回成功处理的事件数"""
+    total = 0
+    while True:
+        db = session_factory()
+        try:
+            applied, failed = process_outbox_batch(db, limit)
+        finally:
+            db.close()
+        total += applied
+        # 本批全部失败时停止，下次轮询再重试
+        if applied == 0:
+            return total
+
+def drain_all_outboxes():
+    """处理主库或全部门店库的积压事件"""
+    return sum(drain_outbox(session_factory) for session_factory in store_db_factories())
+
+def count_pending_outbox(db):
+    """待处理的队列事件数"""
+    return db.query(func.count(OutboxEvent.id)).scalar()
+
+@functools.cache
+def start_outbox_worker(interval=OUTBOX_POLL_SECONDS):
+    """启动后台异步写入线程，每个进程只启动一次"""
+    stop = threading.Event()
+
+    def run():
+        while True:
+            try:
+                drain_all_outboxes()
+            except Exception as e:
+                print(f"异步写入失败: {e}")
+            if stop.wait(interval):
+                break
+
+    threading.Thread(target=run, name="outbox-worker", daemon=True).start()
+    return stop
+
+# ==================== 库存估值 ====================
+def inventory_overview(db, store_id, as_of=None):
+    """门店库存明细：库存与商品一次联表查询，返回数量、库存价值和低库存标记；指定as_of时取历史台账库存"""
+    if as_of is None:
+        result = db.execute(select(
+            Inventory.product_id,
+            Product.name,
+            Product.code,
+            Product.category,
+            Product.unit_price,
+            Product.reorder_threshold,
+            Inventory.quantity,
+            (Inventory.quantity * Product.unit_price).label("stock_value"),
+            (Inventory.quantity < Product.reorder_threshold).label("is_low")
+        ).join(Product, Product.id == Inventory.product_id).where(
+            Inventory.store_id == store_id
+        ).order_by(Inventory.product_id))
+        return pd.DataFrame(result.all(), columns=list(result.keys()))
+    
+    quantities = inventory_as_of(db, store_id, as_of)
+    result = db.execute(select(
+        Product.id.label("product_id"), Product.name, Product.code, Product.category,
+        Product.unit_price, Product.reorder_threshold
+    ).where(Product.id.in_(quantities["product_id"].tolist())))
+    products = pd.DataFrame(result.all(), columns=list(result.keys()))
+    df = products.merge(quantities, on="product_id").sort_values("product_id", ignore_index=True)
+    df["stock_value"] = df["quantity"] * df["unit_price"]
+    df["is_low"] = df["quantity"] < df["reorder_threshold"]
+    return df
+
+def inventory_valuation_by_store(db, store_ids=None):
+    """门店库存估值：一次分组查询汇总各门店库存数量、价值和低库存商品数，store_ids 为空表示全部门店"""
+    stmt = select(
+        Store.id.label("store_id"),
+        Store.name,
+        func.count(Inventory.id).label("product_count"),
+        func.coalesce(func.sum(Inventory.quantity), 0).label("total_quantity"),
+        func.coalesce(func.sum(Inventory.quantity * Product.unit_price), 0.0).label("total_value"),
+        func.coalesce(func.sum((Inventory.quantity < Product.reorder_threshold).cast(Integer)), 0).label("low_stock_count")
+    ).select_from(Store).outerjoin(Inventory, Inventory.store_id == Store.id).outerjoin(
+        Product, Product.id == Inventory.product_id
+    ).group_by(Store.id, Store.name).order_by(Store.id)
+    if store_ids:
+        stmt = stmt.where(Store.id.in_(store_ids))
+    result = db.execute(stmt)
+    return pd.DataFrame(result.all(), columns=list(result.keys()))
+
+# ==================== 跨门店报表 ====================
+# 以下查询都接受 store_ids（为空表示全部门店），可直接交给 query_stores 在各门店库并发执行
+
+def _frame(db, stmt):
+    result = db.execute(stmt)
+    return pd.DataFrame(result.all(), columns=list(result.keys()))
+
+def _in_stores(stmt, column, store_ids):
+    return stmt.where(column.in_(store_ids)) if store_ids else stmt
+
+def _store_revenue_query(store_ids, since):
+    return _in_stores(select(
+        Order.store_id.label("store_id"), func.sum(Order.total_amount).label("revenue"),
+        func.count().label("order_count")
+    ).where(Order.created_at >= since), Order.store_id, store_ids).group_by(Order.store_id)
+
+def store_activity_summary(db, store_ids, since, orders=True):
+    """各门店 since 之后的营业额、订单数、开台数，以及当前进行中台位和未处理库存预警数
+    
+    orders 为 False 时不统计营业额、订单数（控制台改从订单列存缓存汇总）。
+    """
+    def per_store(stmt, column):
+        return _in_stores(stmt, column, store_ids).group_by(column)
+    
+    frames = [_frame(db, _store_revenue_query(store_ids, since))] if orders else []
+    frames += [
+        _frame(db, per_store(select(
+            Session.store_id.label("store_id"), func.count().label("session_count")
+        ).where(Session.start_time >= since), Session.store_id)),
+        _frame(db, per_store(select(
+            Session.store_id.label("store_id"), func.count().label("active_sessions")
+        ).where(Session.status == SessionStatus.IN_PROGRESS), Session.store_id)),
+        _frame(db, per_store(select(
+            StockAlert.store_id.label("store_id"), func.count().label("open_alerts")
+        ).where(StockAlert.status == StockAlertStatus.OPEN), StockAlert.store_id)),
+    ]
+    summary = pd.DataFrame({"store_id": pd.Series(dtype=int)})
+    for frame in frames:
+        summary = summary.merge(frame, on="store_id", how="outer")
+    return summary.fillna(0)
+
+def active_sessions_report(db, store_ids):
+    """进行中的台位及会员"""
+    return _frame(db, _in_stores(select(
+        Session.store_id, Table.name.label("table_name"), Member.name.label("member_name"),
+        Session.start_time, Session.total_amount
+    ).join(Table, Table.id == Session.table_id).outerjoin(Member, Member.id == Session.member_id).where(
+        Session.status == SessionStatus.IN_PROGRESS
+    ).order_by(Session.start_time), Session.store_id, store_ids))
+
+def open_alerts_report(db, store_ids, limit=50):
+    """未处理的库存预警（每个门店库最多 limit 条）"""
+    return _frame(db, _in_stores(select(
+        Store.name.label("store_name"), Product.name.label("product_name"),
+        StockAlert.quantity, StockAlert.threshold, StockAlert.created_at
+    ).join(Store, Store.id == StockAlert.store_id).join(Product, Product.id == StockAlert.product_id).where(
+        StockAlert.status == StockAlertStatus.OPEN
+    ).order_by(StockAlert.created_at.desc()).limit(limit), StockAlert.store_id, store_ids))
+
+def recent_orders_report(db, store_ids, limit=50):
+    """最近订单（每个门店库最多 limit 条，合并后需重新排序截取）"""
+    return _frame(db, _in_stores(select(
+        Order.store_id, Order.order_no, Order.member_id, Order.total_amount, Order.status, Order.created_at
+    ).order_by(Order.created_at.desc()).limit(limit), Order.store_id, store_ids))
+
+# ==================== 并行报表 ====================
+# 连锁报表按 (门店, 日期区间) 切分，各分区用独立的数据库连接在线程池中执行聚合查询，再合并部分聚合结果。
+# SQLite 执行查询时释放 GIL，分区可在多核上并行；分库模式下各分区落在不同的门店库文件
+REPORT_WORKERS = int(os.environ.get("TEA_HOUSE_REPORT_WORKERS", "8"))
+REPORT_PARTITION_DAYS = 31  # 每个分区的天数
+
+def report_partitions(store_ids, start=None, end=None, days=REPORT_PARTITION_DAYS):
+    """切分报表任务，返回 [(门店ID, 开始, 结束)]，结束不含；不指定日期时每个门店一个分区"""
+    if start is None or end is None:
+        return [(store_id, start, end) for store_id in store_ids]
+    bounds = []
+    lower = start
+    while lower < end:
+        upper = min(lower + timedelta(days=days), end)
+        bounds.append((lower, upper))
+        lower = upper
+    return [(store_id, lower, upper) for store_id in store_ids for lower, upper in bounds]
+
+def run_report_partitions(func, partitions, workers=REPORT_WORKERS, progress=None):
+    """每个分区用独立的只读会话执行 func(db, 门店ID, 开始, 结束)，按分区顺序返回结果；workers 为 1 时串行执行
+    
+    progress(已完成分区数, 分区总数) 在每个分区完成后调用。
+    """
+    done = [0]
+    lock = threading.Lock()
+    
+    def run(partition):
+        db = get_store_db(partition[0], read_only=True)
+        try:
+            return func(db, *partition)
+        finally:
+            db.close()
+            if progress:
+                with lock:
+                    done[0] += 1
+                    progress(done[0], len(partitions))
+    
+    if workers <= 1 or len(partitions) <= 1:
+        return [run(partition) for partition in partitions]
+    with ThreadPoolExecutor(max_workers=min(workers, len(partitions))) as pool:
+        return list(pool.map(run, partitions))
+
+def _in_range(column, start, end):
+    conditions = []
+    if start is not None:
+        conditions.append(column >= start)
+    if end is not None:
+        conditions.append(column < end)
+    return conditions
+
+def _revenue_partition(db, store_id, start, end):
+    """一个分区的按日营业额"""
+    orders_src = history_source(db, Order.__table__, start)
+    day = func.date(orders_src.c.created_at)
+    return db.execute(select(
+        day, func.count(), func.sum(orders_src.c.total_amount)
+    ).where(orders_src.c.store_id == store_id, *_in_range(orders_src.c.created_at, start, end)).group_by(day)).all()
+
+def revenue_report(start, end, store_ids=None, workers=REPORT_WORKERS, progress=None):
+    """按日汇总营业额，返回 date、order_count、revenue 三列，end 不含"""
+    parts = run_report_partitions(_revenue_partition, report_partitions(store_ids or all_store_ids(), start, end),
+                                  workers, progress)
+    df = pd.DataFrame([row for part in parts for row in part], columns=["date", "order_count", "revenue"])
+    return df.groupby("date", as_index=False).sum().sort_values("date", ignore_index=True)
+
+def _table_usage_partition(db, store_id, start, end):
+    """一个分区各桌台的开台数、已结账数、时长合计"""
+    sessions_src = history_source(db, Session.__table__, start)
+    return db.execute(select(
+        sessions_src.c.store_id, sessions_src.c.table_id, func.count(),
+        func.sum((sessions_src.c.status == SessionStatus.COMPLETED).cast(Integer)),
+        func.coalesce(func.sum(sessions_src.c.duration_minutes), 0)
+    ).where(
+        sessions_src.c.store_id == store_id, *_in_range(sessions_src.c.start_time, start, end)
+    ).group_by(sessions_src.c.store_id, sessions_src.c.table_id)).all()
+
+def table_usage_report(start=None, end=None, store_ids=None, workers=REPORT_WORKERS, progress=None):
+    """各桌台开台统计，返回 store_id、table_id、table_name、session_count、completed_count、duration_minutes，
+    没有开台记录的桌台计 0；不指定日期时统计全部会话"""
+    store_ids = store_ids or all_store_ids()
+    parts = run_report_partitions(_table_usage_partition, report_partitions(store_ids, start, end), workers, progress)
+    columns = ["store_id", "table_id", "session_count", "completed_count", "duration_minutes"]
+    usage = pd.DataFrame([row for part in parts for row in part], columns=columns)
+    usage = usage.groupby(["store_id", "table_id"], as_index=False).sum()
+    tables = query_stores(lambda db, ids: _frame(db, _in_stores(select(
+        Table.store_id, Table.id.label("table_id"), Table.name.label("table_name")
+    ), Table.store_id, ids)), store_ids)
+    # 已删除桌台的历史会话也计入，桌台名称为空
+    report = tables.merge(usage, on=["store_id", "table_id"], how="outer")
+    report[columns[2:]] = report[columns[2:]].fillna(0).astype(int)
+    return report.sort_values(["store_id", "table_id"], ignore_index=True)
+
+# ==================== 后台报表任务 ====================
+REPORT_CACHE_DIR = os.environ.get("TEA_HOUSE_REPORT_CACHE_DIR", os.path.join(BASE_DIR, "report_cache"))
+REPORT_JOB_WORKERS = int(os.environ.get("TEA_HOUSE_REPORT_JOB_WORKERS", "2"))  # 报表进程数
+
+def _rows_watermark(db, table, time_column, start, end, store_ids, versioned=False):
+    """热表区间内的行数、最大ID（versioned 时加上版本号合计），加上该表最近一次有迁移的归档记录ID
+    
+    订单写入后不再修改，新增即改变行数和最大ID；会话结账、点单、退单时版本号加一。
+    归档库中的行不再修改，只在归档时增加，用归档记录代替扫描归档表，水位只读热表；归档后报表重算一次。
+    """
+    columns = [func.count(), func.max(table.c.id)] + ([func.total(table.c.version)] if versioned else [])
+    hot = db.execute(_in_stores(
+        select(*columns).where(*_in_range(table.c[time_column], start, end)), table.c.store_id, store_ids
+    )).one()
+    archived = db.execute(select(func.max(ArchiveRun.id)).where(
+        ArchiveRun.table_name == table.name, ArchiveRun.rows_moved > 0
+    )).scalar()
+    return list(hot) + [archived]
+
+def revenue_watermark(start, end, store_ids=None):
+    return map_stores(lambda db, ids: _rows_watermark(db, Order.__table__, "created_at", start, end, ids),
+                      store_ids, read_only=True)
+
+def table_usage_watermark(start=None, end=None, store_ids=None):
+    def watermark(db, ids):
+        tables = db.execute(_in_stores(select(Table.id, Table.name), Table.store_id, ids).order_by(Table.id)).all()
+        return _rows_watermark(db, Session.__table__, "start_time", start, end, ids, versioned=True) + \
+            [[list(row) for row in tables]]
+    return map_stores(watermark, store_ids, read_only=True)
+
+# 可在后台进程计算的报表：类型 -> (报表函数, 数据水位函数)，两者参数相同
+REPORT_JOBS = {
+    "revenue": (revenue_report, revenue_watermark),
+    "table_usage": (table_usage_report, table_usage_watermark),
+}
+
+@functools.cache
+def get_report_jobs():
+    """进程内共享的后台报表任务管理器"""
+    return ReportJobManager(REPORT_CACHE_DIR, REPORT_JOB_WORKERS)
+
+def submit_report_job(kind, **params):
+    """按当前数据水位提交报表任务，数据未变化时命中缓存，返回缓存键"""
+    return get_report_jobs().submit(kind, params, REPORT_JOBS[kind][1](**params))
+
+# ==================== 订单列存缓存 ====================
+# 进程内缓存订单、订单明细的列式副本（NumPy 类型的 DataFrame，门店、商品、支付方式、状态为分类编码），
+# 控制台和报表直接在内存中向量化汇总。订单写入后不再修改，且 id 按提交顺序递增，
+# 刷新时只读取 id 大于水位的新行追加；数据按月分区，超出内存上限时淘汰最早的月份
+ORDER_CACHE_MAX_MB = int(os.environ.get("TEA_HOUSE_ORDER_CACHE_MB", "256"))  # 缓存内存上限
+ORDER_CACHE_REFRESH_SECONDS = 1.0  # 两次刷新的最小间隔，页面频繁重跑时不重复查库
+ORDER_CACHE_BATCH_SIZE = 100000  # 每次读取的行数
+
+# 各表读取新行的查询；订单明细带上所属订单的门店、状态、下单时间，便于按门店、时间筛选
+ORDER_CACHE_SQL = {
+    "orders": """
+        SELECT id, store_id, COALESCE(member_id, 0), total_amount, payment_method, status, created_at
+        FROM orders WHERE id > ? ORDER BY id LIMIT ?""",
+    "order_items": """
+        SELECT i.id, i.order_id, o.store_id, i.product_id, i.quantity, i.unit_price, i.subtotal, o.status, o.created_at
+        FROM order_items i JOIN orders o ON o.id = i.order_id WHERE i.id > ? ORDER BY i.id LIMIT ?""",
+}
+ORDER_CACHE_COLUMNS = {
+    "orders": ["id", "store_id", "member_id", "total_amount", "payment_method", "status", "created_at"],
+    "order_items": ["id", "order_id", "store_id", "product_id", "quantity", "unit_price", "subtotal", "status",
+                    "created_at"],
+}
+# 取值固定的分类列：库中存枚举名，缓存中为枚举值
+ORDER_CACHE_ENUMS = {"payment_method": PaymentMethod, "status": OrderStatus}
+
+class OrderColumnCache:
+    """订单、订单明细的列存缓存
+    
+    单库模式只有主库一个数据源，分库模式每个门店库一个数据源，各自记录两张表已读到的最大 id。
+    首次加载只读热表，覆盖范围从归档水位（且不早于热数据保留期）开始；淘汰月份后从淘汰的月份之后开始。
+    区间早于覆盖范围的查询由调用方改走 SQL。member_id 为 0 表示散客。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sources = {}  # 数据源（门店ID，单库模式为 None）-> {"orders": 水位, "order_items": 水位, "floor": 覆盖起点}
+        self._partitions = {}  # 月份 -> {"orders": DataFrame, "order_items": DataFrame}
+        self._dtypes = {column: pd.CategoricalDtype(pd.Index([], dtype=np.int64)) for column in ("store_id", "product_id")}
+        self._dtypes.update({column: pd.CategoricalDtype([member.value for member in enum_type])
+                             for column, enum_type in ORDER_CACHE_ENUMS.items()})
+        self._evicted_before = None  # 已淘汰月份的结束时间
+        self._refreshed_at = 0.0
+
+    def _read_new_rows(self, db, source):
+        """读取数据源中 id 大于水位的新行，返回 (覆盖起点, {表: DataFrame})"""
+        state = self._sources.get(source)
+        if state is None:
+            watermark = get_archive_watermark(db, "orders")
+            floor = datetime.utcnow() - timedelta(days=ARCHIVE_RETENTION_DAYS)
+            state = {"orders": 0, "order_items": 0, "floor": max(floor, watermark) if watermark else floor}
+        cursor = db.connection().connection.cursor()
+        frames = {}
+        try:
+            for name, sql in ORDER_CACHE_SQL.items():
+                rows = []
+                while True:
+                    cursor.execute(sql, (state[name] if not rows else rows[-1][0], ORDER_CACHE_BATCH_SIZE))
+                    batch = cursor.fetchall()
+                    rows += batch
+                    if len(batch) < ORDER_CACHE_BATCH_SIZE:
+                        break
+                frames[name] = pd.DataFrame(rows, columns=ORDER_CACHE_COLUMNS[name])
+        finally:
+            cursor.close()
+        return state, frames
+
+    def _to_columnar(self, frame):
+        """转换为缓存的列类型；门店、商品出现新编码时扩展分类并同步到已有分区"""
+        frame["created_at"] = pd.to_datetime(frame["created_at"], format="ISO8601")
+        for column, enum_type in ORDER_CACHE_ENUMS.items():
+            if column not in frame:
+                continue
+            frame[column] = frame[column].map({member.name: member.value for member in enum_type}).astype(
+                self._dtypes[column])
+        for column in ("store_id", "product_id"):
+            if column not in frame:
+                continue
+            known = self._dtypes[column].categories
+            added = np.setdiff1d(frame[column].unique(), known)
+            if added.size:
+                self._dtypes[column] = pd.CategoricalDtype(known.append(pd.Index(added)))
+                # 替换为新的 DataFrame，正在读取旧分区的查询不受影响
+                for partition in self._partitions.values():
+                    for name, part in partition.items():
+                        if column in part:
+                            partition[name] = part.assign(**{
+                                column: part[column].cat.set_categories(self._dtypes[column].categories)})
+            frame[column] = frame[column].astype(self._dtypes[column])
+        return frame
+
+    def _append(self, name, frame):
+        if self._evicted_before is not None:
+            frame = frame[frame["created_at"] >= self._evicted_before]
+        for month, rows in frame.groupby(frame["created_at"].dt.to_period("M")):
+            partition = self._partitions.setdefault(month, {})
+            old = partition.get(name)
+            partition[name] = rows if old is None else pd.concat([old, rows], ignore_index=True)
+
+    def _evict(self):
+        """超出内存上限时淘汰最早的月份，至少保留最近一个月"""
+        while len(self._partitions) > 1 and self.memory_bytes() > self.max_bytes:
+            month = min(self._partitions)
+            del self._partitions[month]
+            self._evicted_before = month.end_time.normalize() + timedelta(days=1)
+
+    def refresh(self, max_age=ORDER_CACHE_REFRESH_SECONDS):
+        """读取各数据源的新行追加到缓存，返回新增行数；距上次刷新不足 max_age 秒时跳过"""
+        with self._lock:
+            if time.monotonic() - self._refreshed_at < max_age:
+                return 0
+            def read(db, ids):
+                source = ids[0] if SHARD_DIR and ids else None
+                return (source, *self._read_new_rows(db, source))
+            
+            # 分库模式在各门店库并发读取
+            results = map_stores(read, read_only=True)
+            added = 0
+            for source, state, frames in results:
+                for name, frame in frames.items():
+                    if not frame.empty:
+                        state[name] = int(frame["id"].iloc[-1])
+                        self._append(name, self._to_columnar(frame))
+                        added += len(frame)
+                self._sources[source] = state
+            self._evict()
+            self._refreshed_at = time.monotonic()
+            return added
+
+    def _floor(self, store_ids=None):
+        floors = [state["floor"] for source, state in self._sources.items()
+                  if source is None or not store_ids or source in store_ids]
+        if self._evicted_before is not None:
+            floors.append(self._evicted_before)
+        return max(floors) if floors else None
+
+    def floor(self, store_ids=None):
+        """缓存覆盖范围的起点（早于该时间的数据可能不在缓存中）"""
+        with self._lock:
+            return self._floor(store_ids)
+
+    def covers(self, start, store_ids=None):
+        """区间 [start, ∞) 是否全部在缓存中"""
+        with self._lock:
+            if not self._sources or start is None:
+                return False
+            floor = self._floor(store_ids)
+        return floor is None or start >= floor
+
+    def frame(self, name, start=None, end=None, store_ids=None):
+        """合并各月份分区中 [start, end) 区间、指定门店的行"""
+        with self._lock:
+            parts = [partition[name] for month, partition in sorted(self._partitions.items())
+                     if name in partition and (start is None or month.end_time >= start)
+                     and (end is None or month.start_time < end)]
+        if not parts:
+            return self._to_columnar(pd.DataFrame(columns=ORDER_CACHE_COLUMNS[name]))
+        frame = pd.concat(parts, ignore_index=True)
+        mask = np.ones(len(frame), dtype=bool)
+        if start is not None:
+            mask &= (frame["created_at"] >= start).to_numpy()
+        if end is not None:
+            mask &= (frame["created_at"] < end).to_numpy()
+        if store_ids:
+            mask &= frame["store_id"].isin(store_ids).to_numpy()
+        return frame[mask]
+
+    def memory_bytes(self):
+        return int(sum(part.memory_usage(index=True).sum()
+                       for partition in self._partitions.values() for part in partition.values()))
+
+    def stats(self):
+        """各表行数、分区数、内存占用与覆盖起点"""
+        with self._lock:
+            rows = {name: sum(len(partition[name]) for partition in self._partitions.values() if name in partition)
+                    for name in ORDER_CACHE_SQL}
+            return {**rows, "partitions": len(self._partitions), "bytes": self.memory_bytes(), "floor": self._floor()}
+
+@functools.cache
+def get_order_cache():
+    """进程内共享的订单列存缓存"""
+    return OrderColumnCache(ORDER_CACHE_MAX_MB * 1024 * 1024)
+
+def cached_frame(name, start, end=None, store_ids=None):
+    """刷新缓存后返回区间内的订单或订单明细；缓存不覆盖该区间时返回 None，调用方改走 SQL"""
+    cache = get_order_cache()
+    cache.refresh()
+    if not cache.covers(start, store_ids):
+        return None
+    return cache.frame(name, start, end, store_ids)
+
+def store_revenue_since(since, store_ids=None):
+    """各门店 since 之后的营业额、订单数，优先在列存缓存中汇总"""
+    orders = cached_frame("orders", pd.Timestamp(since), store_ids=store_ids)
+    if orders is None:
+        return query_stores(lambda db, ids: _frame(db, _store_revenue_query(ids, since)), store_ids)
+    summary = orders.groupby("store_id", observed=True).agg(
+        revenue=("total_amount", "sum"), order_count=("id", "size")).reset_index()
+    summary["store_id"] = summary["store_id"].astype(int)
+    return summary
+
+def cached_revenue_report(start, end, store_ids=None):
+    """与 revenue_report 结果相同的按日营业额，在列存缓存中汇总；缓存不覆盖该区间时返回 None"""
+    orders = cached_frame("orders", start, end, store_ids)
+    if orders is None:
+        return None
+    daily = orders.groupby(orders["created_at"].dt.normalize()).agg(
+        order_count=("id", "size"), revenue=("total_amount", "sum"))
+    return pd.DataFrame({"date": daily.index.strftime("%Y-%m-%d"), "order_count": daily["order_count"].to_numpy(),
+                         "revenue": daily["revenue"].to_numpy()})
+
+def cached_daily_sales(start, end):
+    """各门店商品日销量 (门店, 商品, 天, 数量)，同 DAILY_SALES_SQL；缓存不覆盖该区间时返回 None"""
+    start = pd.Timestamp(start)
+    items = cached_frame("order_items", start, pd.Timestamp(end))
+    if items is None:
+        return None
+    items = items[items["status"] != OrderStatus.CANCELLED.value]
+    day = ((items["created_at"].dt.normalize() - start).dt.days).to_numpy()
+    sales = pd.DataFrame({"store_id": items["store_id"].astype(np.int64).to_numpy(),
+                          "product_id": items["product_id"].astype(np.int64).to_numpy(),
+                          "day": day, "quantity": items["quantity"].to_numpy()})
+    sales = sales.groupby(["store_id", "product_id", "day"], as_index=False)["quantity"].sum()
+    return sales.to_numpy(dtype=np.int64).reshape(-1, 4)
+
+# ==================== 变更订阅 ====================
+# 可订阅的表：各表 id 单调递增，写入按事务串行提交，id 顺序即提交顺序
+CHANGE_STREAMS = ["orders", "order_items", "inventory_logs"]
+CHANGE_BATCH_SIZE = 1000  # 每批默认行数
+CHANGE_MAX_BATCH_SIZE = 50000  # 每批行数上限
+
+def read_changes(db, stream, after=0, limit=CHANGE_BATCH_SIZE, store_id=None):
+    """读取 stream 表中 id 大于 after 的至多 limit 行，按 id 升序返回 DataFrame
+    
+    消费方保存上一批的最大 id 作为下次的 after，只按主键范围扫描新行；已归档的行从归档库读取，
+    落后超过保留期也不会漏数。分库模式各门店库独立编号，须传入门店ID并使用该门店库的会话。
+    """
+    if stream not in CHANGE_STREAMS:
+        raise ValueError(f"不支持订阅 {stream}，可选 {CHANGE_STREAMS}")
+    if SHARD_DIR and store_id is None:
+        raise ValueError("分库模式各门店库独立编号，须按门店订阅变更")
+    if not 0 < limit <= CHANGE_MAX_BATCH_SIZE:
+        raise ValueError(f"每批行数须在 1 到 {CHANGE_MAX_BATCH_SIZE} 之间")
+    hot = Base.metadata.tables[stream]
+    sources = [hot]
+    # 归档库最大 id 不超过游标时只读热表
+    cold = ARCHIVE_TABLES[stream]
+    if (db.execute(select(func.max(cold.c.id))).scalar() or 0) > after:
+        sources.append(cold)
+    
+    def batch(table):
+        stmt = select(table).where(table.c.id > after)
+        # 分库模式门店库只有本门店的数据，无需按门店过滤
+        if store_id is not None and not SHARD_DIR:
+            if "store_id" in table.c:
+                stmt = stmt.where(table.c.store_id == store_id)
+            else:
+                stmt = stmt.where(table.c.order_id.in_(union_all(*[
+                    select(orders.c.id).where(orders.c.store_id == store_id)
+                    for orders in (Order.__table__, ARCHIVE_TABLES["orders"])
+                ])))
+        return stmt.order_by(table.c.id).limit(limit)
+    
+    if len(sources) == 1:
+        frame = _frame(db, batch(hot))
+    else:
+        # 两边各取 limit 行再合并，避免排序全部历史行
+        merged = union_all(*[select(batch(table).subquery()) for table in sources]).subquery()
+        frame = _frame(db, select(merged).order_by(merged.c.id).limit(limit))
+    for column in hot.columns:
+        if isinstance(column.type, SQLEnum):
+            frame[column.name] = frame[column.name].map(lambda value: getattr(value, "value", value))
+        elif isinstance(column.type, Integer):
+            # 可空整数列（如会员ID）保持整数，不因空值转为浮点
+            frame[column.name] = frame[column.name].astype("Int64")
+    return frame
+
+def changes_to_ndjson(frame):
+    """每行一个JSON对象，时间为ISO格式"""
+    return "".join(
+        json.dumps(row, ensure_ascii=False, default=lambda value: value.isoformat()) + "\n"
+        for row in frame.astype(object).where(frame.notna(), None).to_dict("records")
+    ).encode("utf-8")
+
+def changes_to_parquet(frame):
+    """Parquet 文件内容，需要安装 pyarrow"""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ValueError("Parquet 格式需要安装 pyarrow（pip install pyarrow）")
+    buffer = io.BytesIO()
+    frame.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+CHANGE_FORMATS = {"ndjson": changes_to_ndjson, "parquet": changes_to_parquet}
+
+# ==================== 补货预测 ====================
+FORECAST_HISTORY_DAYS = 56  # 参与预测的历史天数（8周）
+FORECAST_HORIZON_DAYS = 7  # 预测未来天数
+
+def forecast_demand(sales, weekdays, future_weekdays, method="ses", alpha=0.3, window=28):
+    """按周季节性预测需求，sales为(序列数, 天数)的日销量矩阵，所有序列同时计算
+    
+    method: "ses" 季节性指数平滑；"ma" 季节性移动平均
+    返回 (预测期销量, 日均销量, 日销量标准差)
+    """
+    sales = np.asarray(sales, dtype=float)
+    mean = sales.mean(axis=1, keepdims=True)
+    # 周内季节指数：各星期几的平均销量 / 总平均销量，无销量的序列指数为1
+    season = np.ones((sales.shape[0], 7))
+    for weekday in range(7):
+        mask = weekdays == weekday
+        if mask.any():
+            season[:, weekday] = np.divide(sales[:, mask].mean(axis=1), mean[:, 0],
+                                           out=np.ones(sales.shape[0]), where=mean[:, 0] > 0)
+    season = np.where(season > 0, season, 1.0)
+    deseasonalized = sales / season[:, weekdays]
+    
+    if method == "ma":
+        level = deseasonalized[:, -window:].mean(axis=1)
+    else:
+        level = deseasonalized[:, 0].copy()
+        for t in range(1, deseasonalized.shape[1]):
+            level = alpha * deseasonalized[:, t] + (1 - alpha) * level
+    
+    forecast = (level[:, None] * season[:, future_weekdays]).sum(axis=1)
+    return forecast, mean[:, 0], sales.std(axis=1)
+
+# 各门店商品日销量：day 为相对起始日期的天数偏移
+DAILY_SALES_SQL = """
+SELECT o.store_id, i.product_id,
+       CAST(julianday(date(o.created_at)) - julianday(:start) AS INTEGER) AS day,
+       SUM(i.quantity) AS quantity
+FROM order_items i JOIN orders o ON o.id = i.order_id
+WHERE o.created_at >= :start AND o.created_at < :end AND o.status != :cancelled
+GROUP BY o.store_id, i.product_id, day
+"""
+
+def _load_forecast_rows(db, start, end, sales=True):
+    """读取日销量 (门店, 商品, 天, 数量) 与库存 (门店, 商品, 数量)，直接读入NumPy数组（跳过ORM行对象）
+    
+    sales 为 False 时只读库存，日销量为空数组。
+    """
+    cursor = db.connection().connection.cursor()
+    try:
+        sales_rows = np.empty((0, 4), dtype=np.int64)
+        if sales:
+            cursor.execute(DAILY_SALES_SQL, {
+                "start": start.isoformat(), "end": end.isoformat(), "cancelled": OrderStatus.CANCELLED.name
+            })
+            sales_rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 4)
+        cursor.execute("SELECT store_id, product_id, SUM(quantity) FROM inventory GROUP BY store_id, product_id")
+        stock_rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+    finally:
+        cursor.close()
+    return sales_rows, stock_rows
+
+def generate_replenishment_suggestions(db, history_days=FORECAST_HISTORY_DAYS, horizon_days=FORECAST_HORIZON_DAYS, method="ses",
+                                       use_order_cache=False):
+    """根据订单明细预测各门店商品需求，生成补货建议并覆盖上一次结果，返回建议条数
+    
+    use_order_cache 为 True 时日销量优先从订单列存缓存汇总（页面进程中使用，运维命令不加载缓存）。
+    """
+    today = date.today()
+    start = today - timedelta(days=history_days)
+    cached_sales = cached_daily_sales(start, today) if use_order_cache else None
+    
+    # 一次查询取出所有门店商品的日销量；分库模式各门店库并发读取后拼接
+    if SHARD_DIR:
+        parts = map_stores(lambda store_db, store_ids: _load_forecast_rows(store_db, start, today,
+                                                                           sales=cached_sales is None), read_only=True)
+        sales_rows = np.vstack([sales for sales, _ in parts])
+        stock_rows = np.vstack([stock for _, stock in parts])
+    else:
+        sales_rows, stock_rows = _load_forecast_rows(db, start, today, sales=cached_sales is None)
+    if cached_sales is not None:
+        sales_rows = cached_sales
+    
+    # 预测范围：有库存记录或有销量的门店商品，以 (门店, 商品) 组合键定位矩阵行
+    stock_keys = (stock_rows[:, 0] << 32) | stock_rows[:, 1]
+    sales_keys = (sales_rows[:, 0] << 32) | sales_rows[:, 1]
+    keys = np.union1d(stock_keys, sales_keys)
+    if keys.size == 0:
+        return 0
+    on_hand = np.zeros(keys.size, dtype=np.int64)
+    on_hand[np.searchsorted(keys, stock_keys)] = stock_rows[:, 2]
+    
+    # 组装 (序列, 天) 日销量矩阵
+    sales = np.zeros((keys.size, history_days))
+    np.add.at(sales, (np.searchsorted(keys, sales_keys), sales_rows[:, 2]), sales_rows[:, 3])
+    weekdays = (start.weekday() + np.arange(history_days)) % 7
+    future_weekdays = (today.weekday() + np.arange(horizon_days)) % 7
+    
+    forecast, avg_daily, std_daily = forecast_demand(sales, weekdays, future_weekdays, method=method)
+    safety = std_daily * np.sqrt(horizon_days)
+    suggested = np.ceil(np.maximum(forecast + safety - on_hand, 0)).astype(int)
+    
+    generated_at = datetime.utcnow()
+    rows = [{
+        "store_id": store_id,
+        "product_id": product_id,
+        "avg_daily_sales": avg,
+        "forecast_quantity": fc,
+        "safety_stock": ss,
+        "on_hand": oh,
+        "suggested_quantity": sq,
+        "generated_at": generated_at
+    } for store_id, product_id, avg, fc, ss, oh, sq in zip(
+        (keys >> 32).tolist(), (keys & 0xFFFFFFFF).tolist(), avg_daily.round(2).tolist(),
+        forecast.round(2).tolist(), safety.round(2).tolist(), on_hand.tolist(), suggested.tolist()
+    )]
+    conn = db.connection()
+    conn.execute(delete(ReplenishmentSuggestion.__table__))
+    conn.execute(insert(ReplenishmentSuggestion.__table__), rows)
+    db.commit()
+    return len(rows)
+
+# ==================== 会员RFM分析 ====================
+MEMBER_SEGMENTS = {
+    "important": "重要价值会员",
+    "retain": "重要挽留会员",
+    "potential": "潜力会员",
+    "at_risk": "流失风险会员"
+}
+
+def _quintile_score(values, reference):
+    """按参考分布的百分位打1-5分（参考分布为自身时即全量分位打分）"""
+    reference = np.sort(np.asarray(reference, dtype=float))
+    pct = np.searchsorted(reference, np.asarray(values, dtype=float), side="right") / max(len(reference), 1)
+    return np.clip(np.ceil(pct * 5), 1, 5).astype(int)
+
+def _score_member_stats(stats, reference, now):
+    """为会员统计打RFM分并分群，reference 为打分所参照的会员统计"""
+    stats["avg_ticket"] = (stats["total_spent"] / stats["order_count"]).round(2)
+    stats["recency_days"] = (now - pd.to_datetime(stats["last_order_at"])).dt.days
+    reference_recency = (now - pd.to_datetime(reference["last_order_at"])).dt.days
+    # 最近消费天数越小得分越高，取负数后与频次、金额同向打分
+    stats["r_score"] = _quintile_score(-stats["recency_days"], -reference_recency)
+    stats["f_score"] = _quintile_score(stats["order_count"], reference["order_count"])
+    stats["m_score"] = _quintile_score(stats["total_spent"], reference["total_spent"])
+    recent = stats["r_score"] >= 3
+    valuable = (stats["f_score"] + stats["m_score"]) >= 6
+    stats["segment"] = np.select(
+        [recent & valuable, ~recent & valuable, recent & ~valuable],
+        [MEMBER_SEGMENTS["important"], MEMBER_SEGMENTS["retain"], MEMBER_SEGMENTS["potential"]],
+        default=MEMBER_SEGMENTS["at_risk"]
+    )
+    stats["updated_at"] = now
+    return stats
+
+MEMBER_STATS_COLUMNS = ["member_id", "order_count", "total_spent", "first_order_at", "last_order_at", "last_order_id"]
+
+def _upsert_member_stats(conn, stats):
+    """批量写入会员统计（按member_id覆盖）"""
+    columns = MEMBER_STATS_COLUMNS + ["avg_ticket", "recency_days", "r_score", "f_score", "m_score", "segment", "updated_at"]
+    rows = [dict(zip(columns, values)) for values in zip(*[
+        stats[c].dt.to_pydatetime().tolist() if pd.api.types.is_datetime64_any_dtype(stats[c]) else stats[c].tolist()
+        for c in columns
+    ])]
+    stmt = sqlite_insert(MemberStats.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["member_id"],
+        set_={c: stmt.excluded[c] for c in columns if c != "member_id"}
+    )
+    conn.execute(stmt, rows)
+
+def refresh_member_stats(db, full=False):
+    """计算会员RFM统计：full=True全量重算；否则只累加水位之后的新订单，只更新有新订单的会员，返回更新的会员数"""
+    if SHARD_DIR:
+        # 各门店库订单ID各自编号，无法作为统一的增量水位
+        raise ValueError("分库模式下订单分散在各门店库，暂不支持会员消费分析")
+    now = datetime.utcnow()
+    conn = db.connection()
+    watermark = 0 if full else (db.query(func.max(MemberStats.last_order_id)).scalar() or 0)
+    orders_src = history_source(db, Order.__table__) if full else Order.__table__
+    
+    # 一次分组查询汇总每个会员的订单
+    result = conn.execute(select(
+        orders_src.c.member_id,
+        func.count().label("order_count"),
+        func.sum(orders_src.c.total_amount).label("total_spent"),
+        func.min(orders_src.c.created_at).label("first_order_at"),
+        func.max(orders_src.c.created_at).label("last_order_at"),
+        func.max(orders_src.c.id).label("last_order_id")
+    ).where(
+        orders_src.c.member_id.isnot(None),
+        orders_src.c.status != OrderStatus.CANCELLED,
+        orders_src.c.id > watermark
+    ).group_by(orders_src.c.member_id))
+    delta = pd.DataFrame(result.all(), columns=MEMBER_STATS_COLUMNS)
+    if delta.empty:
+        db.commit()
+        return 0
+    
+    if full:
+        stats = delta
+        reference = delta
+        conn.execute(delete(MemberStats.__table__))
+    else:
+        # 增量：与已有统计累加，打分参照全部会员的现有分布
+        existing = pd.DataFrame(
+            conn.execute(select(*[MemberStats.__table__.c[c] for c in MEMBER_STATS_COLUMNS])).all(),
+            columns=MEMBER_STATS_COLUMNS
+        )
+        stats = delta.merge(existing, on="member_id", how="left", suffixes=("", "_old"))
+        stats["order_count"] += stats["order_count_old"].fillna(0).astype(int)
+        stats["total_spent"] += stats["total_spent_old"].fillna(0.0)
+        stats["first_order_at"] = stats["first_order_at_old"].fillna(stats["first_order_at"])
+        stats = stats[MEMBER_STATS_COLUMNS]
+        reference = pd.concat([existing[~existing["member_id"].isin(stats["member_id"])], stats], ignore_index=True)
+    
+    stats = _score_member_stats(stats.copy(), reference, now)
+    _upsert_member_stats(conn, stats)
+    db.commit()
+    return len(stats)
+
+# ==================== 库存对账 ====================
+# 单门店一次扫描：当前库存 vs 最后一条流水的变动后库存 vs 流水变动量累计，并用窗口函数检查前后衔接
+RECONCILE_SQL = text("""
+WITH logs AS (
+    SELECT id, product_id, quantity, before_quantity, after_quantity, created_at
+    FROM main.inventory_logs WHERE store_id = :store_id
+    UNION ALL
+    SELECT id, product_id, quantity, before_quantity, after_quantity, created_at
+    FROM archive.inventory_logs WHERE store_id = :store_id
+),
+chained AS (
+    SELECT product_id, quantity, before_quantity, after_quantity,
+           LAG(after_quantity) OVER w AS prev_after,
+           LEAD(id) OVER w IS NULL AS is_last,
+           COUNT(*) OVER w AS running_count,
+           SUM(quantity) OVER w AS running_sum
+    FROM logs
+    -- 异步补写的流水 ID 晚于变动发生顺序，按变动时间排序衔接
+    WINDOW w AS (PARTITION BY product_id ORDER BY created_at, id ROWS UNBOUNDED PRECEDING)
+),
+ledger AS MATERIALIZED (
+    -- 只保留每个商品的最后一条流水和异常流水，再按商品汇总
+    SELECT product_id,
+           MAX(CASE WHEN is_last THEN running_count END) AS log_count,
+           MAX(CASE WHEN is_last THEN running_sum END) AS delta_sum,
+           MAX(CASE WHEN is_last THEN after_quantity END) AS last_after,
+           SUM(prev_after IS NOT NULL AND prev_after <> before_quantity) AS broken_links,
+           SUM(before_quantity + quantity <> after_quantity) AS bad_rows
+    FROM chained
+    WHERE is_last OR prev_after <> before_quantity OR before_quantity + quantity <> after_quantity
+    GROUP BY product_id
+),
+stock AS (
+    SELECT product_id, quantity FROM main.inventory WHERE store_id = :store_id
+)
+SELECT s.product_id, s.quantity AS stock_quantity,
+       l.log_count, l.delta_sum, l.last_after, l.broken_links, l.bad_rows
+FROM stock s LEFT JOIN ledger l ON l.product_id = s.product_id
+UNION ALL
+SELECT l.product_id, NULL,
+       l.log_count, l.delta_sum, l.last_after, l.broken_links, l.bad_rows
+FROM ledger l WHERE l.product_id NOT IN (SELECT product_id FROM stock)
+""")
+
+RECONCILE_COLUMNS = ["product_id", "stock_quantity", "log_count", "delta_sum", "last_after", "broken_links", "bad_rows"]
+
+def reconcile_inventory(db, store_id):
+    """对账单个门店的库存，返回每个商品的对账结果及差异标记"""
+    rows = db.execute(RECONCILE_SQL, {"store_id": store_id}).all()
+    df = pd.DataFrame(rows, columns=RECONCILE_COLUMNS)
+    df.insert(0, "store_id", store_id)
+    df[["log_count", "broken_links", "bad_rows"]] = df[["log_count", "broken_links", "bad_rows"]].fillna(0).astype(int)
+    stock = df["stock_quantity"].fillna(0)
+    df["last_mismatch"] = df["log_count"].gt(0) & stock.ne(df["last_after"])
+    df["sum_mismatch"] = stock.ne(df["delta_sum"].fillna(0))
+    df["has_issue"] = df["last_mismatch"] | df["sum_mismatch"] | df["broken_links"].gt(0) | df["bad_rows"].gt(0)
+    return df
+
+def reconcile_all_stores(db, store_ids=None):
+    """逐门店对账并合并结果；分库模式各门店库并发对账，db 不使用"""
+    if SHARD_DIR:
+        return query_stores(_reconcile_stores, store_ids)
+    return _reconcile_stores(db, store_ids)
+
+def _reconcile_stores(db, store_ids=None):
+    """在一个库内逐门店对账并合并结果"""
+    store_ids = store_ids or [s.id for s in db.query(Store.id).all()]
+    frames = [reconcile_inventory(db, store_id) for store_id in store_ids]
+    if not frames:
+        return pd.DataFrame(columns=["store_id"] + RECONCILE_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+# ==================== 日结 ====================
+STALE_SESSION_HOURS = int(os.environ.get("TEA_HOUSE_STALE_SESSION_HOURS", "12"))  # 开台超过该时长仍未结账视为遗留会话
+IDEMPOTENCY_RETENTION_DAYS = 7  # 幂等键保留天数，客户端只在提交后几分钟内重试
+ANALYZE_ROW_LIMIT = 1000  # ANALYZE 每个索引抽样的行数，大表只需近似统计
+
+def close_stale_sessions(db, store_id, stale_before):
+    """关闭 stale_before 之前开台仍未结账的会话并释放桌台，返回关闭数；不在此提交事务
+    
+    会话标记为已取消，未结账的消费金额保留在会话上，计入日结汇总的未结金额。
+    """
+    sessions = Session.__table__
+    table_ids = db.execute(update(sessions).where(
+        sessions.c.store_id == store_id, sessions.c.status == SessionStatus.IN_PROGRESS,
+        sessions.c.start_time < stale_before
+    ).values(
+        status=SessionStatus.CANCELLED, end_time=datetime.utcnow(), version=sessions.c.version + 1
+    ).returning(sessions.c.table_id)).scalars().all()
+    if table_ids:
+        tables = Table.__table__
+        active = select(sessions.c.id).where(
+            sessions.c.table_id == tables.c.id, sessions.c.status == SessionStatus.IN_PROGRESS
+        ).exists()
+        freed = db.execute(update(tables).where(
+            tables.c.id.in_(set(table_ids)), tables.c.status == TableStatus.OCCUPIED, ~active
+        ).values(status=TableStatus.FREE, version=tables.c.version + 1).returning(tables.c.id, tables.c.capacity)).all()
+        for table_id, capacity in freed:
+            run_after_commit(db, get_free_table_index().add, store_id, table_id, capacity)
+    return len(table_ids)
+
+def summarize_store_day(db, store_id, business_date):
+    """把门店一个营业日的营业额、开台和商品销量写入日结汇总表，重复执行覆盖当天结果；不在此提交事务"""
+    start = datetime.combine(business_date, datetime.min.time())
+    end = start + timedelta(days=1)
+    orders_src = history_source(db, Order.__table__, start)
+    # 订单已归档时明细也可能在归档库
+    items_src = OrderItem.__table__ if orders_src is Order.__table__ else union_all(
+        select(OrderItem.__table__), select(ARCHIVE_TABLES["order_items"])
+    ).subquery("order_items")
+    sessions_src = history_source(db, Session.__table__, start)
+    
+    order_count, revenue, balance_revenue = db.execute(select(
+        func.count(), func.coalesce(func.sum(orders_src.c.total_amount), 0.0),
+        func.coalesce(func.sum(case((orders_src.c.payment_method == PaymentMethod.BALANCE, orders_src.c.total_amount),
+                                    else_=0.0)), 0.0)
+    ).where(orders_src.c.store_id == store_id, *_in_range(orders_src.c.created_at, start, end))).one()
+    cancelled = sessions_src.c.status == SessionStatus.CANCELLED
+    session_count, cancelled_sessions, unpaid_amount, duration_minutes = db.execute(select(
+        func.count(), func.coalesce(func.sum(cancelled.cast(Integer)), 0),
+        func.coalesce(func.sum(case((cancelled, sessions_src.c.total_amount), else_=0.0)), 0.0),
+        func.coalesce(func.sum(case((sessions_src.c.status == SessionStatus.COMPLETED, sessions_src.c.duration_minutes),
+                                    else_=0)), 0)
+    ).where(sessions_src.c.store_id == store_id, *_in_range(sessions_src.c.start_time, start, end))).one()
+    product_rows = db.execute(select(
+        items_src.c.product_id, func.sum(items_src.c.quantity), func.sum(items_src.c.subtotal)
+    ).join(orders_src, orders_src.c.id == items_src.c.order_id).where(
+        orders_src.c.store_id == store_id, *_in_range(orders_src.c.created_at, start, end)
+    ).group_by(items_src.c.product_id)).all()
+    
+    summaries = DailyStoreSummary.__table__
+    product_sales = DailyProductSales.__table__
+    for table in (summaries, product_sales):
+        db.execute(delete(table).where(table.c.store_id == store_id, table.c.business_date == business_date))
+    summary = {
+        "store_id": store_id, "business_date": business_date, "order_count": order_count,
+        "revenue": round(revenue, 2), "balance_revenue": round(balance_revenue, 2), "session_count": session_count,
+        "cancelled_sessions": cancelled_sessions, "unpaid_amount": round(unpaid_amount, 2),
+        "duration_minutes": duration_minutes, "closed_at": datetime.utcnow(),
+    }
+    db.execute(insert(summaries).values(**summary))
+    if product_rows:
+        db.execute(insert(product_sales), [{
+            "store_id": store_id, "business_date": business_date, "product_id": product_id,
+            "quantity": quantity, "amount": round(amount, 2)
+        } for product_id, quantity, amount in product_rows])
+    return summary
+
+def archive_all_stores(cutoff=None, batch_size=1000):
+    """归档主库；分库模式逐个门店库归档到各自的归档库，返回各表迁移行数"""
+    if not SHARD_DIR:
+        return archive_history(cutoff, batch_size)
+    moved = {}
+    for store_id in all_store_ids():
+        for table_name, rows in archive_history(cutoff, batch_size, get_store_engine(store_id)).items():
+            moved[table_name] = moved.get(table_name, 0) + rows
+    return moved
+
+def prune_idempotent_operations(db, before):
+    """删除 before 之前登记的幂等键，返回删除行数；不在此提交事务"""
+    operations = IdempotentOperation.__table__
+    return db.execute(delete(operations).where(operations.c.created_at < before)).rowcount
+
+def _maintenance_targets():
+    """需要维护的库文件：[(名称, 引擎, 库名列表)]；门店库连接挂载的主库由主库引擎维护"""
+    targets = [("main", engine, ["main", "archive"])]
+    if SHARD_DIR:
+        router = get_shard_router()
+        targets += [(f"store_{store_id}", router.engine(store_id), ["main", "archive"]) for store_id in all_store_ids()]
+    return targets
+
+def _run_pragmas(bind, statements, script=False):
+    """在一个连接上依次执行维护语句（事务外），返回每条语句的全部结果行
+    
+    script 为 True 时整体按脚本执行、不返回结果：incremental_vacuum 每执行一步只回收一页，
+    execute 对无结果列的语句只执行一步，脚本方式会执行到结束。
+    """
+    connection = bind.raw_connection()
+    try:
+        cursor = connection.cursor()
+        try:
+            if script:
+                cursor.executescript(";".join(statements))
+                return []
+            results = []
+            for statement in statements:
+                cursor.execute(statement)
+                results.append(cursor.fetchall())
+            return results
+        finally:
+            cursor.close()
+    finally:
+        connection.close()
+
+def analyze_databases():
+    """更新查询规划器的统计信息（ANALYZE 抽样 + PRAGMA optimize），返回维护的库文件数"""
+    targets = _maintenance_targets()
+    for _, bind, schemas in targets:
+        _run_pragmas(bind, [f"PRAGMA analysis_limit={ANALYZE_ROW_LIMIT}"] + [f"ANALYZE {schema}" for schema in schemas]
+                     + ["PRAGMA optimize"])
+    return len(targets)
+
+def vacuum_databases(full=False):
+    """增量回收各库的空闲页，返回 {库: 回收页数}
+    
+    未启用增量回收的已有库（早于此功能创建）默认跳过并返回 None；full 为 True 时执行一次完整 VACUUM 转换，
+    期间该库写入会等待，宜在闭店后执行。
+    """
+    freed = {}
+    for name, bind, schemas in _maintenance_targets():
+        for schema in schemas:
+            (mode,), (before,) = (rows[0] for rows in _run_pragmas(bind, [
+                f"PRAGMA {schema}.auto_vacuum", f"PRAGMA {schema}.freelist_count"
+            ]))
+            if mode == 2:
+                _run_pragmas(bind, [f"PRAGMA {schema}.incremental_vacuum"], script=True)
+            elif full:
+                _run_pragmas(bind, [f"PRAGMA {schema}.auto_vacuum=INCREMENTAL", f"VACUUM {schema}"], script=True)
+            else:
+                freed[f"{name}.{schema}"] = None
+                continue
+            (after,), = _run_pragmas(bind, [f"PRAGMA {schema}.freelist_count"])[0]
+            freed[f"{name}.{schema}"] = before - after
+    return freed
+
+def checkpoint_wal():
+    """把WAL中的页写回库文件并截断WAL，返回未能写回的库（有长读事务未结束时）"""
+    busy = []
+    for name, bind, _ in _maintenance_targets():
+        for is_busy, _, _ in _run_pragmas(bind, ["PRAGMA wal_checkpoint(TRUNCATE)"])[0]:
+            if is_busy:
+                busy.append(name)
+    return busy
+
+def close_day(business_date=None, stale_hours=STALE_SESSION_HOURS, archive=True, full_vacuum=False, progress=None):
+    """日结：补写队列、关闭遗留会话、生成日结汇总、库存快照、归档、清理、更新统计、回收空间、截断WAL
+    
+    business_date 默认为前一天（UTC）；每个阶段的耗时和结果写入 day_close_runs，progress(阶段, 秒, 结果) 在每个阶段后调用。
+    返回 [(阶段, 秒, 结果)]。
+    """
+    business_date = business_date or datetime.utcnow().date() - timedelta(days=1)
+    now = datetime.utcnow()
+    runs = []
+    
+    def each_store(func):
+        results = []
+        for store_id in all_store_ids():
+            db = get_store_db(store_id)
+            try:
+                results.append(func(db, store_id))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+        return results
+    
+    def stage(name, func):
+        started = time.perf_counter()
+        detail = func()
+        seconds = time.perf_counter() - started
+        runs.append((name, seconds, detail))
+        if progress:
+            progress(name, seconds, detail)
+    
+    stage("drain_outbox", drain_all_outboxes)
+    stage("close_stale_sessions", lambda: sum(each_store(
+        lambda db, store_id: close_stale_sessions(db, store_id, now - timedelta(hours=stale_hours))
+    )))
+    
+    def summaries():
+        rows = each_store(lambda db, store_id: summarize_store_day(db, store_id, business_date))
+        return {"stores": len(rows), "order_count": sum(r["order_count"] for r in rows),
+                "revenue": round(sum(r["revenue"] for r in rows), 2)}
+    stage("daily_summaries", summaries)
+    stage("inventory_checkpoints", lambda: sum(map_stores(
+        lambda db, store_ids: create_inventory_checkpoints(db, store_ids=store_ids)
+    )))
+    if archive:
+        stage("archive", archive_all_stores)
+    
+    def prune():
+        before = now - timedelta(days=IDEMPOTENCY_RETENTION_DAYS)
+        pruned = 0
+        for session_factory in store_db_factories():
+            db = session_factory()
+            try:
+                pruned += prune_idempotent_operations(db, before)
+                db.commit()
+            finally:
+                db.close()
+        return pruned
+    stage("prune_idempotency_keys", prune)
+    stage("analyze", analyze_databases)
+    stage("incremental_vacuum", lambda: vacuum_databases(full_vacuum))
+    stage("wal_checkpoint", checkpoint_wal)
+    
+    with engine.begin() as conn:
+        conn.execute(insert(DayCloseRun.__table__), [{
+            "business_date": business_date, "stage": name, "seconds": round(seconds, 3),
+            "detail": json.dumps(detail, ensure_ascii=False), "created_at": now
+        } for name, seconds, detail in runs])
+    return runs
+
+# 数据库初始化和升级
+def init_sample_data_auto():
+    """自动初始化示例数据"""
+    db = SessionLocal()
+    try:
+        # 检查是否已有数据（以门店为标准）
+        store_count = db.query(Store).count()
+        
+        if store_count == 0:
+            print("检测到空数据库，开始初始化示例数据...")
+            
+            # 1. 创建门店
+            store_data = [
+                {"name": "茶楼总店", "code": "ST001", "address": "市中心商业街1号", "phone": "010-88888888"},
+                {"name": "茶楼东城店", "code": "ST002", "address": "东城区朝阳路88号", "phone": "010-66666666"},
+                {"name": "茶楼西城店", "code": "ST003", "address": "西城区复兴路123号", "phone": "010-77777777"},
+                {"name": "茶楼南山店", "code": "ST004", "address": "南山区科技大道66号", "phone": "0755-99999999"},
+                {"name": "茶楼北湖店", "code": "ST005", "address": "北湖区环湖路88号", "phone": "027-55555555"},
+                {"name": "茶楼新城店", "code": "ST006", "address": "新城开发区金桥路66号", "phone": "020-44444444"},
+            ]
+            
+            stores = []
+            for data in store_data:
+                store = Store(name=data["name"], code=data["code"], 
+                            address=data["address"], phone=data["phone"], 
+                            status=StoreStatus.ACTIVE)
+                db.add(store)
+                db.flush()
+                stores.append(store)
+            
+            # 2. 创建员工
+            employee_data = [
+                {"name": "张经理", "phone": "13800138001", "position": EmployeePosition.MANAGER, "store_id": stores[0].id},
+                {"name": "李店长", "phone": "13800138002", "position": EmployeePosition.MANAGER, "store_id": stores[1].id},
+                {"name": "王员工", "phone": "13800138003", "position": EmployeePosition.STAFF, "store_id": stores[0].id},
+                {"name": "赵员工", "phone": "13800138004", "position": EmployeePosition.STAFF, "store_id": stores[1].id},
+                {"name": "孙员工", "phone": "13800138005", "position": EmployeePosition.STAFF, "store_id": stores[2].id},
+                {"name": "周员工", "phone": "13800138006", "position": EmployeePosition.CASHIER, "store_id": stores[0].id},
+            ]
+            
+            for data in employee_data:
+                employee = Employee(**data)
+                db.add(employee)
+            
+            # 3. 创建商品
+            product_data = [
+                {"name": "龙井绿茶", "code": "P001", "category": "茶叶", "unit_price": 68.00, "unit": "壶"},
+                {"name": "普洱熟茶", "code": "P002", "category": "茶叶", "unit_price": 88.00, "unit": "壶"},
+                {"name": "铁观音", "code": "P003", "category": "茶叶", "unit_price": 78.00, "unit": "壶"},
+                {"name": "大红袍", "code": "P004", "category": "茶叶", "unit_price": 128.00, "unit": "壶"},
+                {"name": "茉莉花茶", "code": "P005", "category": "茶叶", "unit_price": 58.00, "unit": "壶"},
+                {"name": "菊花茶", "code": "P006", "category": "花茶", "unit_price": 48.00, "unit": "杯"},
+                {"name": "玫瑰花茶", "code": "P007", "category": "花茶", "unit_price": 58.00, "unit": "杯"},
+                {"name": "柠檬茶", "code": "P008", "category": "花茶", "unit_price": 38.00, "unit": "杯"},
+                {"name": "瓜子", "code": "S001", "category": "零食", "unit_price": 18.00, "unit": "份"},
+                {"name": "花生", "code": "S002", "category": "零食", "unit_price": 18.00, "unit": "份"},
+                {"name": "开心果", "code": "S003", "category": "零食", "unit_price": 38.00, "unit": "份"},
+                {"name": "腰果", "code": "S004", "category": "零食", "unit_price": 32.00, "unit": "份"},
+                {"name": "话梅", "code": "S005", "category": "零食", "unit_price": 15.00, "unit": "份"},
+                {"name": "薯片", "code": "S006", "category": "零食", "unit_price": 12.00, "unit": "份"},
+                {"name": "水煮鱼", "code": "D001", "category": "菜品", "unit_price": 88.00, "unit": "份"},
+                {"name": "宫保鸡丁", "code": "D002", "category": "菜品", "unit_price": 58.00, "unit": "份"},
+                {"name": "麻婆豆腐", "code": "D003", "category": "菜品", "unit_price": 38.00, "unit": "份"},
+                {"name": "鱼香肉丝", "code": "D004", "category": "菜品", "unit_price": 48.00, "unit": "份"},
+            ]
+            
+            products = []
+            for data in product_data:
+                product = Product(**data)
+                db.add(product)
+                db.flush()
+                products.append(product)
+            
+            # 4. 创建桌台
+            for i, store in enumerate(stores):
+                for j in range(8):
+                    table = Table(
+                        name=f"{store.name}桌台{j+1}号",
+                        code=f"T{i+1:02d}{j+1:02d}",
+                        store_id=store.id,
+                        capacity=[2, 4, 6, 8][j % 4],
+                        status=TableStatus.FREE
+                    )
+                    db.add(table)
+            
+            # 5. 创建库存和库存流水
+            for store in stores:
+                for product in products:
+                    quantity = 20 + (product.id * 5) % 80
+                    inv = Inventory(store_id=store.id, product_id=product.id, quantity=quantity)
+                    db.add(inv)
+                    db.flush()
+                    
+                    # 创建初始入库流水
+                    log = InventoryLog(
+                        store_id=store.id,
+                        product_id=product.id,
+                        log_type=InventoryLogType.IN,
+                        quantity=quantity,
+                        before_quantity=0,
+                        after_quantity=quantity,
+                        remark=f"初始入库 {quantity} 件"
+                    )
+                    db.add(log)
+            
+            # 6. 创建会员
+            member_data = [
+                {"name": "王先生", "phone": "13900139001", "level": MemberLevel.GOLD, "balance": 500.00},
+                {"name": "李女士", "phone": "13900139002", "level": MemberLevel.DIAMOND, "balance": 1000.00},
+                {"name": "张先生", "phone": "13900139003", "level": MemberLevel.SILVER, "balance": 300.00},
+                {"name": "赵女士", "phone": "13900139004", "level": MemberLevel.NORMAL, "balance": 100.00},
+                {"name": "陈先生", "phone": "13900139005", "level": MemberLevel.GOLD, "balance": 800.00},
+                {"name": "刘女士", "phone": "13900139006", "level": MemberLevel.SILVER, "balance": 250.00},
+                {"name": "黄先生", "phone": "13900139007", "level": MemberLevel.NORMAL, "balance": 0.00},
+                {"name": "周女士", "phone": "13900139008", "level": MemberLevel.DIAMOND, "balance": 2000.00},
+            ]
+            
+            members = []
+            for data in member_data:
+                member = Member(**data)
+                db.add(member)
+                db.flush()
+                members.append(member)
+            
+            # 7. 创建订单和会话
+            for i in range(20):
+                store = stores[i % len(stores)]
+                member = members[i % len(members)]
+                
+                order_no = f"ORD{datetime.now() - timedelta(days=i):%Y%m%d%H%M%S}{i:02d}"
+                order = Order(
+                    order_no=order_no,
+                    store_id=store.id,
+                    member_id=member.id,
+                    total_amount=150.0 + (i * 10),
+                    payment_method=[PaymentMethod.WECHAT, PaymentMethod.ALIPAY, PaymentMethod.CASH][i % 3],
+                    status=OrderStatus.COMPLETED,
+                    created_at=datetime.now() - timedelta(days=i)
+                )
+                db.add(order)
+                db.flush()
+                
+                for j in range(3):
+                    product = products[(i + j) % len(products)]
+                    quantity = 1 + j % 2
+                    subtotal = product.unit_price * quantity
+                    
+                    order_item = OrderItem(
+                        order_id=order.id,
+                        product_id=product.id,
+                        quantity=quantity,
+                        unit_price=product.unit_price,
+                        subtotal=subtotal
+                    )
+                    db.add(order_item)
+            
+            # 8. 创建会话
+            tables = db.query(Table).limit(10).all()
+            for i, table in enumerate(tables):
+                store = db.query(Store).get(table.store_id)
+                member = members[i % len(members)]
+                
+                duration = 60 + i * 15
+                start_time = datetime.now() - timedelta(days=i, hours=duration // 60)
+                end_time = start_time + timedelta(minutes=duration)
+                
+                session = Session(
+                    table_id=table.id,
+                    store_id=store.id,
+                    member_id=member.id,
+                    start_time=start_time,
+                    end_time=end_time,
+                    status=SessionStatus.COMPLETED,
+                    duration_minutes=duration,
+                    total_amount=100.0 + i * 20
+                )
+                db.add(session)
+                db.flush()
+                
+                for j in range(2):
+                    product = products[(i + j) % len(products)]
+                    quantity = 1
+                    subtotal = product.unit_price * quantity
+                    
+                    session_item = SessionItem(
+                        session_id=session.id,
+                        product_id=product.id,
+                        quantity=quantity,
+                        unit_price=product.unit_price,
+                        subtotal=subtotal,
+                        order_time=start_time + timedelta(minutes=j * 10)
+                    )
+                    db.add(session_item)
+            
+            db.commit()
+            print("✅ 示例数据初始化完成！")
+        else:
+            print(f"✅ 数据库已有数据（{store_count}家门店），跳过初始化")
+    except Exception as e:
+        print(f"❌ 初始化失败: {str(e)}")
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def upgrade_schema(bind, tables):
+    """创建缺失的表，已有表补齐新增的字段和索引"""
+    # 检查是否需要添加新字段或新表
+    inspector = inspect(bind)
+    existing_tables = inspector.get_table_names()
+    
+    # 创建所有表（如果不存在）
+    Base.metadata.create_all(bind=bind, tables=tables)
+    
+    # 已有表补齐新增的字段
+    for table in tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=bind.dialect)
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+            if column.server_default is not None:
+                ddl += f" NOT NULL DEFAULT {column.server_default.arg}" if not column.nullable else f" DEFAULT {column.server_default.arg}"
+            with bind.begin() as conn:
+                conn.exec_driver_sql(ddl)
+    
+    # 已有表补建新增的索引
+    for table in tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
+def init_database():
+    """初始化和升级数据库"""
+    upgrade_schema(engine, Base.metadata.sorted_tables)
+    
+    # 归档库表结构与热表保持一致，热表新行的 id 不与归档库重复
+    with engine.begin() as conn:
+        ensure_archive_tables(conn)
+        ensure_archive_id_sequences(conn)
+    
+    # 自动初始化示例数据（如果数据库为空）
+    init_sample_data_auto()
+    
+    # 会员余额期初流水
+    db = SessionLocal()
+    try:
+        create_opening_balance_logs(db)
+    finally:
+        db.close()
+    
+    # 上次退出前未处理完的异步写入事件
+    drain_outbox()
+    
+    # 分库模式：主库中的门店经营数据（示例数据或切换前的数据）迁入各门店库
+    if SHARD_DIR:
+        moved = split_into_shards()
+        if moved:
+            print(f"✅ 已将 {moved} 行门店数据迁入门店库")
+        drain_all_outboxes()
+        settled = settle_balance_spends()
+        if settled:
+            print(f"✅ 已退回 {settled} 笔未完成结账的余额扣款")